@@ -0,0 +1,466 @@
+import asyncio
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from display_pool import RESET_TIMEOUT
+from display_queue import DISPLAY_QUEUE_SIZE, DisplayQueue
+from metrics import DEFAULT_METRICS_INTERVAL, ConnectionStats, write_metrics_file
+from rooms import OUTBOUND_QUEUE_SIZE, WRITER_CLOSE_TIMEOUT, Room
+from server import HOST, PORT, DrawingServer
+from sessions import SESSION_TIMEOUT, Session
+from utils.protocol import (
+    DEFAULT_COMPRESS_THRESHOLD, JSON_CODEC, LEGACY_VERSION, RESET_VERSION,
+    answer_hello_async, decode_event, event_type, pack_frame, read_frame,
+    read_payload, write_frame,
+)
+
+BACKLOG = 1024
+# Threads for clients waiting on the pool for a display.  Each one can wait
+# up to ACQUIRE_TIMEOUT, so they get threads of their own rather than the
+# loop's default executor, which everything else shares.
+ACQUIRE_WORKERS = 64
+
+
+class AsyncMember:
+    """asyncio counterpart of :class:`rooms.Member`, with a writer task."""
+
+    def __init__(self, client_id, writer, codec, version, compression=None,
+                 queue_size=OUTBOUND_QUEUE_SIZE, stats=None):
+        self.client_id = client_id
+        self.writer = writer
+        self.codec = codec
+        self.version = version
+        self.compression = compression
+        # (frame, when it was queued)
+        self.queue = asyncio.Queue(queue_size)
+        self.stats = stats if stats is not None else ConnectionStats()
+        self.stats.depth = self.queue.qsize
+        self.stats.compression = compression
+        self.dropped = False
+        self.task = asyncio.create_task(self._write())
+
+    def send(self, frame):
+        try:
+            self.queue.put_nowait((frame, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.drop()
+
+    def send_body(self, body):
+        self.send(pack_frame(body) if self.compression is None else self.compression.pack(body))
+
+    def drop(self):
+        if self.dropped:
+            return
+        self.dropped = True
+        print(f"[SERVER] Client {self.client_id} fell too far behind, disconnecting")
+        self.disconnect()
+
+    def disconnect(self):
+        # The client's read loop sees the connection end and leaves the room.
+        self.writer.transport.abort()
+
+    async def close(self):
+        """Let the writer send what is already queued, then stop it."""
+        try:
+            self.queue.put_nowait(None)
+            await asyncio.wait_for(self.task, WRITER_CLOSE_TIMEOUT)
+        except (asyncio.QueueFull, asyncio.TimeoutError):
+            self.task.cancel()
+
+    async def _write(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    break
+                self.writer.write(item[0])
+                await self.writer.drain()
+                self.stats.written((item,))
+        except OSError:
+            pass
+
+
+class AsyncDisplayWriter:
+    """asyncio counterpart of :class:`display_queue.DisplayWriter`.
+
+    ``put`` never waits; client loops await :meth:`wait_for_room` between
+    events instead.
+    """
+
+    def __init__(self, writer, codec, version, compression=None, maxsize=DISPLAY_QUEUE_SIZE, stats=None):
+        self.writer = writer
+        self.compression = compression
+        self.queue = DisplayQueue(codec, version, maxsize)
+        self.stats = stats if stats is not None else ConnectionStats()
+        self.stats.depth = self.depth
+        self.pending = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closed = False
+        self.task = asyncio.create_task(self._write())
+
+    def put(self, body, client_id=None):
+        if self.closed:
+            raise ConnectionError("Display connection closed")
+        self.queue.push(body, client_id)
+        self.pending.set()
+        if self.queue.full():
+            self.space.clear()
+
+    async def wait_for_room(self):
+        if not self.space.is_set():
+            self.queue.stalls += 1
+            await self.space.wait()
+
+    def queue_stats(self):
+        return self.queue.stats()
+
+    def depth(self):
+        return len(self.queue)
+
+    async def close(self):
+        """Let the writer send what is already queued, then stop it."""
+        self.closed = True
+        self.pending.set()
+        try:
+            await asyncio.wait_for(self.task, WRITER_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _write(self):
+        try:
+            while True:
+                await self.pending.wait()
+                self.pending.clear()
+                while self.queue:
+                    pack = pack_frame if self.compression is None else self.compression.pack
+                    items = [(pack(body), queued) for body, queued in self.queue.take()]
+                    for frame, queued in items:
+                        self.writer.write(frame)
+                    self.space.set()
+                    await self.writer.drain()
+                    self.stats.written(items)
+                if self.closed:
+                    break
+        except OSError:
+            self.closed = True
+            self.queue.clear()
+            self.space.set()
+
+
+class AsyncDrawingServer(DrawingServer):
+    """Runs every client on one asyncio event loop instead of a thread each.
+
+    Displays are taken from the pool in an executor of their own so a slow
+    display never holds up other clients, and frames are read with
+    ``readexactly``.  Giving a display back never waits, so it happens on
+    the loop: were it queued behind waiting acquires, it could not wake
+    them.
+    ``connections`` holds stream writers here instead of sockets.
+    """
+
+    mode = "asyncio"
+
+    def __init__(self, host=HOST, port=PORT, pool=None, compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 metrics_file=None, metrics_interval=DEFAULT_METRICS_INTERVAL):
+        super().__init__(host, port, pool, compress_threshold, metrics_file, metrics_interval)
+        # room -> (display writer, task reading the display)
+        self.display_streams = {}
+        self.acquirers = ThreadPoolExecutor(ACQUIRE_WORKERS, thread_name_prefix="acquire")
+
+    def start(self):
+        self.pool.start()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("\n[SERVER] Shutting down...")
+        finally:
+            self.pool.close()
+            self.acquirers.shutdown(wait=False)
+            self.close_journals()
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, backlog=BACKLOG
+        )
+        if self.metrics_file:
+            # Kept so the task is not garbage collected while it sleeps.
+            self.metrics_task = asyncio.create_task(self.write_metrics_async())
+        print(f"[SERVER] Listening on {self.host}:{self.port} (asyncio)...")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for writer in list(self.connections.values()):
+                writer.close()
+
+    async def handle_connection(self, reader, writer):
+        client_id = next(self.client_ids)
+        print(f"[SERVER] Connected by {writer.get_extra_info('peername')} (ID: {client_id})")
+        self.connections[client_id] = writer
+        stats = self.metrics.connect(client_id)
+        client_codec = JSON_CODEC
+        client_version = LEGACY_VERSION
+        compression = None
+        session = None
+        member = None
+
+        try:
+            data = await read_frame(reader, stats=stats)
+            if data is not None and event_type(data) == "hello":
+                client_codec, client_version, compression = await answer_hello_async(
+                    writer, decode_event(data), self.compress_threshold
+                )
+                data = await read_frame(reader, compression, stats)
+
+            if data is not None and event_type(data) == "stats":
+                # Only asking for stats: no session, room or display.
+                while data is not None and event_type(data) == "stats":
+                    write_frame(writer, client_codec.encode(self.stats()), compression)
+                    await writer.drain()
+                    data = await read_frame(reader, compression, stats)
+                return
+
+            resumed = False
+            if data is not None and event_type(data) == "session":
+                session, resumed = self.attach_session(decode_event(data).get("token"), client_id)
+                write_frame(writer, client_codec.encode({
+                    "type": "session",
+                    "token": session.token,
+                    "last_seq": session.last_seq,
+                    "resumed": resumed
+                }), compression)
+                await writer.drain()
+            elif data is not None:
+                session = Session(client_id, resumable=False)
+                session.connection = client_id
+            else:
+                return
+
+            stats.info["client"] = session.client_id
+            member = AsyncMember(session.client_id, writer, client_codec, client_version, compression,
+                                 stats=stats)
+            if resumed:
+                if not session.room.add(member):
+                    # Closed since the session was attached; the client
+                    # reconnects and then gets a new session.
+                    print(f"[SERVER] Client {session.client_id} could not resume, its room has closed")
+                    return
+                print(f"[SERVER] Client {session.client_id} resumed after event {session.last_seq}")
+                data = await read_frame(reader, compression, stats)
+            else:
+                if event_type(data) == "session":
+                    data = await read_frame(reader, compression, stats)
+                room_name = None
+                if data is not None and event_type(data) == "join":
+                    room_name = decode_event(data)["room"]
+                elif data is None:
+                    return
+
+                room = await self.join_room_async(room_name, member)
+                if room is None:
+                    print(f"[SERVER] No display available for client {client_id}")
+                    return
+                session.room = room
+                if room_name is not None:
+                    print(f"[SERVER] Client {session.client_id} joined room {room_name!r}")
+                    data = await read_frame(reader, compression, stats)
+            session.member = member
+            stats.info["room"] = session.room.name
+            display = session.room.display
+
+            while data is not None:
+                received = time.perf_counter()
+                if not self.apply_event(session, client_id, data):
+                    break
+                stats.relay.observe(time.perf_counter() - received)
+                # Only waits when the display's queue is full.
+                await display.wait_for_room()
+                data = await read_frame(reader, compression, stats)
+
+        except Exception as e:
+            print(f"[SERVER] Error handling client {client_id}: {e}")
+        finally:
+            await self.close_client(client_id, member, session)
+
+    async def join_room_async(self, name, member):
+        """asyncio counterpart of :meth:`DrawingServer.join_room`."""
+        while True:
+            room = self.rooms.get(name) if name is not None else None
+            if room is None:
+                room = Room(name, asyncio.Event(), asyncio.Event())
+                if name is not None:
+                    room.journal = self.journal_for(name)
+                    self.rooms[name] = room
+                await self.open_room_async(room)
+            else:
+                await room.ready.wait()
+
+            if room.worker is None:
+                return None
+            if room.add(member):
+                return room
+            # The room closed while we waited for it; open a new one.
+
+    async def open_room_async(self, room):
+        """Take a worker from the pool and open a stream on its connection.
+
+        The stream gets its own duplicate of the worker's socket so closing
+        it leaves the pool's connection to the display open.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            worker = await loop.run_in_executor(self.acquirers, self.pool.acquire)
+            if worker is not None:
+                display_writer = None
+                try:
+                    display_reader, display_writer = await asyncio.open_connection(sock=worker.sock.dup())
+                    room.display = AsyncDisplayWriter(
+                        display_writer, worker.codec, worker.version, worker.compression, stats=worker.stats
+                    )
+                    relay_task = asyncio.create_task(self.relay_display_async(room, display_reader))
+                except Exception as e:
+                    print(f"[SERVER] Could not open display {worker.name} for room {room.name!r}: {e}")
+                    room.display = None
+                    if display_writer is not None:
+                        display_writer.close()
+                    # Nothing has been sent to the display, so it can go
+                    # back to the pool as it is.
+                    self.pool.release(worker, True)
+                    return
+                room.worker = worker
+                self.display_streams[room] = (display_writer, relay_task)
+                try:
+                    room.replay_to_display()
+                    await room.display.wait_for_room()
+                except Exception as e:
+                    print(f"[SERVER] Could not replay room {room.name!r}: {e}")
+        finally:
+            if room.worker is None and self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+            room.ready.set()
+
+    async def leave_room_async(self, room, client_id):
+        if not room.remove(client_id):
+            return
+        if self.rooms.get(room.name) is room:
+            del self.rooms[room.name]
+
+        display_writer, relay_task = self.display_streams.pop(room)
+        clean = await self.reset_display_async(room)
+        await room.display.close()
+        self.report_display_queue(room)
+        relay_task.cancel()
+        display_writer.close()
+        try:
+            await display_writer.wait_closed()
+        except OSError:
+            pass
+        self.pool.release(room.worker, clean)
+
+    async def relay_display_async(self, room, display_reader):
+        """asyncio counterpart of :meth:`DrawingServer.relay_display`."""
+        try:
+            while True:
+                data = await read_frame(display_reader, room.worker.compression, room.worker.stats)
+                if data is None:
+                    break
+
+                response = decode_event(data)
+                if response["type"] == "save_response":
+                    filepath = await self.save_drawing_async(response, display_reader, room.worker.stats)
+                    self.finish_save(room, response, filepath)
+                elif response["type"] == "reset_done":
+                    room.reset_done.set()
+                    break
+
+        except Exception as e:
+            print(f"[SERVER] Error reading from display {room.worker.name}: {e}")
+
+    async def save_drawing_async(self, response, display_reader, stats=None):
+        """asyncio counterpart of :meth:`DrawingServer.save_drawing`."""
+        loop = asyncio.get_running_loop()
+        filepath = self.save_path(response['filename'])
+        partial = f"{filepath}.{uuid.uuid4().hex}.part"
+        f = await loop.run_in_executor(None, open, partial, 'wb')
+        try:
+            if "size" in response:
+                async for chunk in read_payload(display_reader, response["size"], stats):
+                    await loop.run_in_executor(None, f.write, chunk)
+            else:
+                await loop.run_in_executor(None, f.write, bytes(response["data"]))
+        finally:
+            f.close()
+        os.replace(partial, filepath)
+        print(f"[SERVER] Saved drawing to {filepath}")
+        return filepath
+
+    async def reset_display_async(self, room):
+        """asyncio counterpart of :meth:`DrawingServer.reset_display`."""
+        worker = room.worker
+        try:
+            if worker.version < RESET_VERSION:
+                room.send(worker.codec.encode({"type": "exit"}))
+                return False
+            room.send(worker.codec.encode({"type": "reset"}))
+            await asyncio.wait_for(room.reset_done.wait(), RESET_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        return True
+
+    def schedule_expiry(self, session, detached):
+        asyncio.get_running_loop().call_later(
+            SESSION_TIMEOUT,
+            lambda: asyncio.ensure_future(self.expire_session_async(session, detached)),
+        )
+
+    async def expire_session_async(self, session, detached):
+        if self.session_expired(session, detached):
+            await self.leave_room_async(session.room, session.client_id)
+
+    async def close_client(self, client_id, member=None, session=None):
+        if session is not None:
+            if session.room is None:
+                self.forget_session(session)
+            elif self.detach_session(session, client_id):
+                self.forget_session(session)
+                await self.leave_room_async(session.room, session.client_id)
+        if member is not None:
+            await member.close()
+            if member.compression is not None:
+                print(f"[SERVER] Compression saved {member.compression.saved_bytes} of "
+                      f"{member.compression.raw_bytes} bytes for client {client_id}")
+
+        writer = self.connections.pop(client_id, None)
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self.metrics.disconnect(client_id)
+
+    def stats(self):
+        snapshot = super().stats()
+        snapshot["tasks"] = len(asyncio.all_tasks())
+        return snapshot
+
+    async def write_metrics_async(self):
+        """asyncio counterpart of :meth:`DrawingServer.write_metrics`.
+
+        Snapshots are taken on the event loop, which owns what they read,
+        and written out in an executor.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            try:
+                await loop.run_in_executor(None, write_metrics_file, self.metrics_file, self.stats())
+            except Exception as e:
+                print(f"[SERVER] Could not write metrics to {self.metrics_file}: {e}")
+
+
+if __name__ == "__main__":
+    AsyncDrawingServer(HOST, PORT).start()
@@ -0,0 +1,57 @@
+"""Micro-benchmarks for the drawing hot paths.
+
+Run from the source directory:
+
+    python -m benchmarks run -o before.json
+    python -m benchmarks run -o after.json
+    python -m benchmarks compare before.json after.json
+
+``compare`` exits with status 1 if any case got slower than the threshold.
+"""
+import argparse
+import sys
+
+from benchmarks import hot_paths  # noqa: F401 (registers the benchmarks)
+from benchmarks.runner import (
+    DEFAULT_REPEAT, DEFAULT_THRESHOLD, compare, load_results, run_benchmarks,
+    save_results,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Drawing hot path benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument('-o', '--output', help="write the results to this JSON file")
+    run.add_argument('-k', '--filter', help="only run cases whose name matches this wildcard")
+    run.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="timed runs per case; the best counts")
+    run.add_argument('--quick', action='store_true', help="skip the largest inputs")
+
+    diff = commands.add_parser("compare", help="compare two results files")
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help="slowdown, as a fraction, that counts as a regression"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == "run":
+        results = run_benchmarks(args.filter, args.repeat, args.quick)
+        if args.output:
+            save_results(results, args.output)
+        return 0
+
+    regressions = compare(load_results(args.baseline), load_results(args.current), args.threshold)
+    if regressions:
+        print(f"{len(regressions)} case(s) slower by more than {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+"""Synthetic strokes for the benchmarks.
+
+Every generator returns a flat ``[x0, y0, x1, y1, ...]`` list and takes a
+``random.Random`` so a run draws the same canvas every time.
+"""
+import math
+
+CANVAS_SIZE = (1920, 1080)
+
+
+def random_walk(rng, count, step=4.0, start=None):
+    """Points a fixed step apart in a direction that wanders a little."""
+    x, y = start or (rng.uniform(0, CANVAS_SIZE[0]), rng.uniform(0, CANVAS_SIZE[1]))
+    heading = rng.uniform(0, 2 * math.pi)
+    points = [x, y]
+    for _ in range(count - 1):
+        heading += rng.gauss(0, 0.3)
+        x += step * math.cos(heading)
+        y += step * math.sin(heading)
+        points += (x, y)
+    return points
+
+
+def handwriting(rng, count, size=40.0, start=None):
+    """Loops drifting to the right, like cursive, sampled as a touch would be."""
+    x0, y0 = start or (rng.uniform(0, CANVAS_SIZE[0] - 400), rng.uniform(0, CANVAS_SIZE[1]))
+    # Each letter stroke is a loop of its own width and height.
+    width = size * rng.uniform(0.4, 0.8)
+    height = size * rng.uniform(0.8, 1.2)
+    speed = rng.uniform(0.15, 0.3)
+    points = []
+    for i in range(count):
+        t = i * speed
+        jitter = rng.gauss(0, 0.3)
+        points += (x0 + t * width / (2 * math.pi) + width * 0.5 * math.sin(t) + jitter,
+                   y0 + height * 0.5 * math.cos(t * 1.5) + jitter)
+    return points
+
+
+def scribble(rng, count, radius=60.0, start=None):
+    """Fast back-and-forth strokes packed into a small area."""
+    cx, cy = start or (rng.uniform(radius, CANVAS_SIZE[0] - radius),
+                       rng.uniform(radius, CANVAS_SIZE[1] - radius))
+    angle = rng.uniform(0, math.pi)
+    points = []
+    for i in range(count):
+        # Sweeps along one axis while slowly turning and drifting.
+        reach = radius * math.sin(i * 0.9)
+        angle += 0.05
+        points += (cx + reach * math.cos(angle) + rng.gauss(0, 2),
+                   cy + reach * math.sin(angle) + rng.gauss(0, 2))
+    return points
+
+
+GENERATORS = {
+    "random_walk": random_walk,
+    "handwriting": handwriting,
+    "scribble": scribble,
+}
+
+
+def strokes(rng, count, points=64, kinds=tuple(GENERATORS)):
+    """``count`` strokes of ``points`` points each, cycling through ``kinds``."""
+    return [GENERATORS[kinds[i % len(kinds)]](rng, points) for i in range(count)]
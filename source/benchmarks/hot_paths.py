@@ -0,0 +1,185 @@
+"""Benchmarks for the paths every stroke goes through.
+
+Hit-testing runs against ``StrokeStore``, which is what the eraser does on
+the client and ``erase_at_point`` on the display.  Canvas ingest needs Kivy and runs it headless on the mock GL
+backend; it is skipped where Kivy is not installed.  The save path is
+measured from the pixels on, since grabbing them needs a real window.
+"""
+import os
+import random
+import socket
+import threading
+
+from benchmarks.generators import CANVAS_SIZE, random_walk, strokes
+from benchmarks.runner import Case, Skipped, benchmark
+from utils.png import encode_png
+from utils.protocol import (
+    BINARY_CODEC, DELTA_CODEC, JSON_CODEC, decode_event, send_frame,
+    send_payload,
+)
+from utils.strokes import Stroke, StrokeStore
+
+SEED = 1234
+ERASER_RADIUS = 30
+PROBES = 500
+CODECS = (JSON_CODEC, BINARY_CODEC, DELTA_CODEC)
+
+
+def load_kivy():
+    """Import Kivy without a window or command line parsing."""
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ.setdefault("KIVY_NO_CONSOLELOG", "1")
+    os.environ.setdefault("KIVY_GL_BACKEND", "mock")
+    try:
+        import kivy  # noqa: F401
+    except ImportError:
+        raise Skipped("Kivy is not installed")
+
+
+def filled_store(count, rng):
+    store = StrokeStore()
+    for key, points in enumerate(strokes(rng, count)):
+        store.add(key, points[0], points[1])
+        store.extend(key, points[2:])
+    return store
+
+
+def random_probes(rng, count=PROBES):
+    return [(rng.uniform(0, CANVAS_SIZE[0]), rng.uniform(0, CANVAS_SIZE[1])) for _ in range(count)]
+
+
+@benchmark
+def hit_testing(quick):
+    """Eraser queries as the canvas fills up."""
+    rng = random.Random(SEED)
+    probes = random_probes(rng)
+    # Drags of five samples, 40 px apart: a fast eraser.
+    paths = [random_walk(rng, 5, step=40.0) for _ in range(PROBES)]
+    for count in (100, 1000) if quick else (100, 1000, 10000):
+        store = filled_store(count, rng)
+
+        def query(store=store):
+            for x, y in probes:
+                store.query(x, y, ERASER_RADIUS)
+
+        def query_path(store=store):
+            for path in paths:
+                store.query_path(path, ERASER_RADIUS)
+
+        yield Case(f"erase.query[strokes={count}]", query, len(probes), "probes")
+        yield Case(f"erase.query_path[strokes={count}]", query_path, len(paths), "paths")
+
+    for length in (16, 256, 4096):
+        points = random_walk(rng, length)
+        stroke = Stroke(points[0], points[1])
+        stroke.coords.extend(points[2:])
+
+        def hits_circle(stroke=stroke):
+            for probe in probes:
+                stroke.hits_circle(probe, ERASER_RADIUS)
+
+        yield Case(f"erase.hits_circle[points={length}]", hits_circle, len(probes), "probes")
+
+
+@benchmark
+def codecs(quick):
+    """Encoding and decoding of the events a stroke is made of."""
+    rng = random.Random(SEED)
+    walk = random_walk(rng, 1000)
+    moves = [{"type": "move", "x": walk[i], "y": walk[i + 1]} for i in range(0, len(walk), 2)]
+    batches = [{"type": "points", "points": walk[i:i + 128]} for i in range(0, len(walk), 128)]
+    for codec in CODECS:
+        move_bodies = [codec.encode(event) for event in moves]
+        batch_bodies = [codec.encode(event) for event in batches]
+
+        def encode_moves(codec=codec):
+            for event in moves:
+                codec.encode(event)
+
+        def decode_moves(bodies=move_bodies):
+            for body in bodies:
+                decode_event(body)
+
+        def encode_points(codec=codec):
+            for event in batches:
+                codec.encode(event)
+
+        def decode_points(bodies=batch_bodies):
+            for body in bodies:
+                decode_event(body)
+
+        yield Case(f"codec.encode.move[{codec.name}]", encode_moves, len(moves), "events")
+        yield Case(f"codec.decode.move[{codec.name}]", decode_moves, len(moves), "events")
+        yield Case(f"codec.encode.points[{codec.name}]", encode_points, len(walk) // 2, "points")
+        yield Case(f"codec.decode.points[{codec.name}]", decode_points, len(walk) // 2, "points")
+
+
+@benchmark
+def canvas_ingest(quick):
+    """How fast a display's canvas takes in strokes."""
+    load_kivy()
+    from display_manager import CanvasWidget
+
+    rng = random.Random(SEED)
+    widget = CanvasWidget()
+    count = 50 if quick else 200
+    moves = []
+    batched = []
+    for stroke_id, points in enumerate(strokes(rng, count)):
+        down = {"type": "down", "id": stroke_id, "x": points[0], "y": points[1]}
+        moves.append(down)
+        batched.append(down)
+        moves += ({"type": "move", "id": stroke_id, "x": points[i], "y": points[i + 1]}
+                  for i in range(2, len(points), 2))
+        # What a display gets from a client batching its points.
+        batched += ({"type": "points", "id": stroke_id, "points": points[i:i + 16]}
+                    for i in range(2, len(points), 16))
+        moves.append({"type": "up", "id": stroke_id})
+        batched.append({"type": "up", "id": stroke_id})
+    point_count = sum(1 for event in moves if event["type"] == "move")
+
+    def draw_line():
+        widget.clear()
+        for event in moves:
+            widget.draw_line(event)
+
+    def draw_events():
+        widget.clear()
+        widget.draw_events(batched)
+
+    yield Case("canvas.draw_line[move]", draw_line, point_count, "points")
+    yield Case("canvas.draw_events[points]", draw_events, point_count, "points")
+
+
+@benchmark
+def save_path(quick):
+    """Encoding a saved canvas and streaming it to the server."""
+    width, height = (640, 360) if quick else (1280, 720)
+    rng = random.Random(SEED)
+    # Black with a few hundred white marks, roughly what a drawing looks like.
+    pixels = bytearray(width * height * 4)
+    for _ in range(width * height // 100):
+        offset = (rng.randrange(height) * width + rng.randrange(width)) * 4
+        pixels[offset:offset + 4] = b'\xff\xff\xff\xff'
+
+    def encode():
+        encode_png(width, height, pixels)
+
+    def send():
+        data = encode_png(width, height, pixels)
+        header = {"type": "save_response", "size": len(data), "filename": "benchmark.png"}
+        send_frame(display, BINARY_CODEC.encode(header))
+        send_payload(display, data)
+
+    display, server = socket.socketpair()
+    # Reads whatever the display sends, as the server would.
+    threading.Thread(target=_drain, args=(server,), daemon=True).start()
+    yield Case(f"save.encode_png[{width}x{height}]", encode, 1, "saves")
+    yield Case(f"save.send[{width}x{height}]", send, 1, "saves")
+    display.close()
+
+
+def _drain(sock):
+    with sock:
+        while sock.recv(1 << 16):
+            pass
@@ -0,0 +1,362 @@
+"""Headless end-to-end load on a drawing server.
+
+Opens ``--clients`` simulated clients that speak the protocol the drawing
+app does, puts them in rooms of ``--room-size`` and has each draw strokes
+at ``--rate`` events a second, now and then erasing one of its strokes or
+asking for a save.  Run from the source directory:
+
+    python -m benchmarks.loadgen --spawn threaded --clients 40 --duration 20
+
+``--spawn`` starts a server of that mode on a free port, with displays that
+only count frames (stub_display.py), in a scratch directory; otherwise the
+clients connect to ``--host`` and ``--port``.  The report gives:
+
+* events sent a second, over all clients;
+* relay latency: from a client sending a ``down`` to each other member of
+  its room receiving it;
+* time to first display: from connecting to the first save being written,
+  which needs the room's display to be up;
+* save turnaround: from asking for a save to its ``save_done``.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.generators import GENERATORS
+from utils.framing import FrameReader
+from utils.protocol import (
+    DEFAULT_COMPRESS_THRESHOLD, ROOMS_VERSION, SESSION_VERSION, STATS_VERSION,
+    STROKE_STREAM_VERSION, decode_event, offer_hello, request_session,
+    request_stats, send_frame, without_stroke_ids,
+)
+from utils.strokes import stroke_ids
+
+SEED = 1234
+DEFAULT_PORT = 9999
+# Points per ``points`` event, about what the client's batcher sends.
+DEFAULT_BATCH = 8
+ERASER_RADIUS = 30
+# How long a spawned server gets to start listening.
+SERVER_START_TIMEOUT = 10.0
+# How long to wait for saves still in flight once the run is over.
+DRAIN_TIMEOUT = 5.0
+PERCENTILES = (50, 90, 99)
+# Sent right after connecting, so its answer times the display coming up.
+FIRST_SAVE = 1
+
+
+def percentile(samples, p):
+    """The ``p``-th percentile of sorted ``samples``, nearest rank."""
+    if not samples:
+        return None
+    rank = max(0, min(len(samples) - 1, round(p / 100 * len(samples)) - 1))
+    return samples[rank]
+
+
+class Results:
+    """What every client measured; shared between their threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+        self.latencies = []
+        self.first_display = []
+        self.save_turnaround = []
+        # When each ``down`` was sent, by stroke ID, for the room to look up.
+        self.downs = {}
+
+    def add(self, name, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+    def summary(self, elapsed):
+        def spread(samples):
+            samples = sorted(samples)
+            result = {"count": len(samples)}
+            for p in PERCENTILES:
+                value = percentile(samples, p)
+                result[f"p{p}"] = None if value is None else value * 1000
+            result["max"] = samples[-1] * 1000 if samples else None
+            return result
+
+        return {
+            "seconds": elapsed,
+            "events_sent": self.sent,
+            "events_per_second": self.sent / elapsed if elapsed else 0.0,
+            "events_received": self.received,
+            "errors": self.errors,
+            "relay_latency_ms": spread(self.latencies),
+            "time_to_first_display_ms": spread(self.first_display),
+            "save_turnaround_ms": spread(self.save_turnaround),
+        }
+
+
+class SimulatedClient:
+    def __init__(self, index, args, results, stop):
+        self.index = index
+        self.args = args
+        self.results = results
+        self.stop = stop
+        self.rng = random.Random(SEED + index)
+        self.room = f"load-{index // args.room_size}" if args.room_size > 1 else None
+        self.stroke_ids = stroke_ids()
+        self.strokes = []
+        self.save_ids = itertools.count(FIRST_SAVE)
+        # When each save still waiting for its ``save_done`` was sent.
+        self.saves = {}
+        self.sock = None
+
+    def run(self):
+        try:
+            self.connect()
+            threading.Thread(target=self.receive, daemon=True).start()
+            self.draw()
+        except OSError as e:
+            print(f"[LOADGEN] Client {self.index}: {e}")
+            with self.results.lock:
+                self.results.errors += 1
+
+    def connect(self):
+        self.connected = time.perf_counter()
+        sock = socket.create_connection((self.args.host, self.args.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threshold = None if self.args.no_compression else DEFAULT_COMPRESS_THRESHOLD
+        self.codec, self.version, self.compression = offer_hello(sock, compress_threshold=threshold)
+        if self.version >= SESSION_VERSION:
+            request_session(sock, self.codec, compression=self.compression)
+        if self.room and self.version >= ROOMS_VERSION:
+            send_frame(sock, self.codec.encode({"type": "join", "room": self.room}), self.compression)
+        self.sock = sock
+        # Answered once the room's display is up.
+        self.send(self.save_event())
+
+    def draw(self):
+        interval = 1.0 / self.args.rate
+        # Spread the clients' first events over one interval.
+        deadline = time.perf_counter() + self.rng.uniform(0, interval)
+        for event in self.events():
+            if self.stop.is_set():
+                return
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.send(event)
+            deadline += interval
+
+    def events(self):
+        kinds = tuple(GENERATORS)
+        batch = self.args.batch * 2
+        while True:
+            points = GENERATORS[self.rng.choice(kinds)](self.rng, self.rng.randint(16, 128))
+            stroke_id = next(self.stroke_ids)
+            yield {"type": "down", "id": stroke_id, "x": points[0], "y": points[1],
+                   "color": [1, 1, 1, 1], "width": 2}
+            for i in range(2, len(points), batch):
+                yield {"type": "points", "id": stroke_id, "points": points[i:i + batch]}
+            yield {"type": "up", "id": stroke_id}
+            self.strokes.append((stroke_id, points[0], points[1]))
+            if self.rng.random() < self.args.erase_ratio:
+                erased, x, y = self.strokes.pop(self.rng.randrange(len(self.strokes)))
+                yield {"type": "remove_strokes", "ids": [erased], "x": x, "y": y, "radius": ERASER_RADIUS}
+            if self.rng.random() < self.args.save_ratio:
+                yield self.save_event()
+
+    def save_event(self):
+        return {"type": "save", "filename": f"loadgen-{self.index}", "request_id": next(self.save_ids)}
+
+    def send(self, event):
+        now = time.perf_counter()
+        if event["type"] == "down":
+            self.results.downs[event["id"]] = now
+        elif event["type"] == "save":
+            self.saves[event["request_id"]] = now
+        if self.version < STROKE_STREAM_VERSION:
+            event = without_stroke_ids(event, self.version)
+        send_frame(self.sock, self.codec.encode(event), self.compression)
+        with self.results.lock:
+            self.results.sent += 1
+
+    def receive(self):
+        reader = FrameReader(self.sock, self.compression)
+        try:
+            while True:
+                data = reader.read_frame()
+                if data is None:
+                    return
+                now = time.perf_counter()
+                event = decode_event(data)
+                if event["type"] == "save_done":
+                    sent = self.saves.pop(event["request_id"], None)
+                    if sent is not None:
+                        self.results.add("save_turnaround", now - sent)
+                    if event["request_id"] == FIRST_SAVE:
+                        self.results.add("first_display", now - self.connected)
+                    continue
+                with self.results.lock:
+                    self.results.received += 1
+                if event["type"] == "down" and event.get("id") in self.results.downs:
+                    self.results.add("latencies", now - self.results.downs[event["id"]])
+        except OSError:
+            pass
+
+    def pending_saves(self):
+        return len(self.saves)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_server(args):
+    """Start a server with stub displays; returns the process and its log."""
+    source = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    log_path = os.path.join(workdir, "server.log")
+    rooms = -(-args.clients // args.room_size)
+    command = [
+        sys.executable, os.path.join(source, "server.py"),
+        "--host", args.host, "--port", str(args.port), "--mode", args.spawn,
+        "--display-script", os.path.join(source, "stub_display.py"),
+        "--max-displays", str(max(rooms, 1)),
+    ]
+    if args.no_compression:
+        command.append("--no-compression")
+    log = open(log_path, 'w')
+    process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError(f"Server did not start; see {log_path}")
+            time.sleep(0.1)
+    print(f"[LOADGEN] Started the {args.spawn} server on port {args.port}, logging to {log_path}")
+    return process, log
+
+
+def run_load(args):
+    results = Results()
+    stop = threading.Event()
+    clients = [SimulatedClient(i, args, results, stop) for i in range(args.clients)]
+    threads = [threading.Thread(target=client.run, daemon=True) for client in clients]
+    start = time.perf_counter()
+    for i, thread in enumerate(threads):
+        thread.start()
+        if args.ramp:
+            time.sleep(args.ramp / len(threads))
+    time.sleep(max(0.0, start + args.duration - time.perf_counter()))
+    stop.set()
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join(DRAIN_TIMEOUT)
+    # Saves still being written are part of the run.
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while time.monotonic() < deadline and any(c.pending_saves() for c in clients if c.sock):
+        time.sleep(0.05)
+    for client in clients:
+        client.close()
+    return results.summary(elapsed)
+
+
+def server_stats(args):
+    """The server's own counters after the run, or None if it has none."""
+    try:
+        with socket.create_connection((args.host, args.port)) as sock:
+            codec, version, compression = offer_hello(sock)
+            if version < STATS_VERSION:
+                return None
+            return request_stats(sock, codec, compression)
+    except OSError:
+        return None
+
+
+def report(summary):
+    print(f"[LOADGEN] {summary['events_sent']} events in {summary['seconds']:.1f}s: "
+          f"{summary['events_per_second']:,.0f} events/s sent, "
+          f"{summary['events_received']} relayed to room members, {summary['errors']} client errors")
+    for name, label in (("relay_latency_ms", "relay latency"),
+                        ("time_to_first_display_ms", "time to first display"),
+                        ("save_turnaround_ms", "save turnaround")):
+        spread = summary[name]
+        if not spread["count"]:
+            print(f"[LOADGEN] {label:<22} no samples")
+            continue
+        values = "  ".join(f"p{p} {spread[f'p{p}']:8.2f}" for p in PERCENTILES)
+        print(f"[LOADGEN] {label:<22} {values}  max {spread['max']:8.2f} ms  ({spread['count']} samples)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.loadgen",
+                                     description="End-to-end load on a drawing server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=None,
+                        help=f"server port; defaults to {DEFAULT_PORT}, or a free one with --spawn")
+    parser.add_argument('--spawn', choices=('threaded', 'asyncio'),
+                        help="start a server of this mode, with stub displays, for the run")
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--room-size', type=int, default=2,
+                        help="clients per room; 1 gives each client a board of its own")
+    parser.add_argument('--rate', type=float, default=60.0, help="events a second per client")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to draw for")
+    parser.add_argument('--ramp', type=float, default=0.0, help="seconds over which clients connect")
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH, help="points per points event")
+    parser.add_argument('--erase-ratio', type=float, default=0.1, help="chance a stroke is followed by an erase")
+    parser.add_argument('--save-ratio', type=float, default=0.02, help="chance a stroke is followed by a save")
+    parser.add_argument('--no-compression', action='store_true')
+    parser.add_argument('-o', '--output', help="also write the report to this JSON file")
+    args = parser.parse_args()
+    if args.port is None:
+        args.port = free_port() if args.spawn else DEFAULT_PORT
+    args.room_size = max(1, args.room_size)
+    return args
+
+
+def main():
+    args = parse_args()
+    server = None
+    if args.spawn:
+        server, log = spawn_server(args)
+    try:
+        summary = run_load(args)
+        stats = server_stats(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            log.close()
+    report(summary)
+    if stats is not None:
+        print(f"[LOADGEN] Server: {stats['threads']} threads, {stats['processes']} processes, "
+              f"{stats['displays']['busy']} displays busy")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"arguments": vars(args), "summary": summary, "server": stats}, f, indent=2)
+            f.write('\n')
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Timing, result files and comparisons for the benchmark suite.
+
+A benchmark is a generator function registered with :func:`benchmark`.  It
+builds its inputs and yields :class:`Case` objects whose ``run`` performs
+``ops`` operations of a hot path.  Each case runs once to warm up, then
+``repeat`` times, and the fastest run is kept: it is the one least disturbed
+by whatever else the machine was doing.
+"""
+import datetime
+import fnmatch
+import importlib.metadata
+import json
+import platform
+import subprocess
+import sys
+import time
+
+RESULTS_FORMAT = 1
+DEFAULT_REPEAT = 5
+# A case this much slower than the baseline counts as a regression.
+DEFAULT_THRESHOLD = 0.10
+
+BENCHMARKS = []
+
+
+class Skipped(Exception):
+    """Raised by a benchmark that cannot run here, e.g. without Kivy."""
+
+
+class Case:
+    def __init__(self, name, run, ops, unit="ops"):
+        self.name = name
+        self.run = run
+        self.ops = ops
+        self.unit = unit
+
+
+def benchmark(function):
+    BENCHMARKS.append(function)
+    return function
+
+
+def measure(case, repeat=DEFAULT_REPEAT):
+    """Return the best rate of ``case``, in its units per second."""
+    case.run()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run()
+        best = min(best, time.perf_counter() - start)
+    return case.ops / best
+
+
+def run_benchmarks(pattern=None, repeat=DEFAULT_REPEAT, quick=False):
+    """Run every registered benchmark whose case names match ``pattern``.
+
+    ``pattern`` is a shell-style wildcard; ``quick`` asks benchmarks to
+    skip their largest inputs.
+    """
+    results = {}
+    skipped = {}
+    for function in BENCHMARKS:
+        try:
+            for case in function(quick):
+                if pattern and not fnmatch.fnmatch(case.name, pattern):
+                    continue
+                rate = measure(case, repeat)
+                results[case.name] = {"rate": rate, "unit": f"{case.unit}/s"}
+                print(f"{case.name:<44} {rate:>16,.1f} {case.unit}/s")
+        except Skipped as e:
+            skipped[function.__name__] = str(e)
+            print(f"{function.__name__:<44} skipped: {e}")
+    return {
+        "format": RESULTS_FORMAT,
+        "environment": environment(),
+        "repeat": repeat,
+        "quick": quick,
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+def environment():
+    """What a result depends on besides the code: versions and machine."""
+    versions = {}
+    for package in ("numpy", "kivy"):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "packages": versions,
+    }
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def load_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get("format") != RESULTS_FORMAT:
+        raise ValueError(f"{path} is not a benchmark results file this version can read")
+    return results
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, out=sys.stdout):
+    """Print how each case changed; returns the names of the regressions.
+
+    Every rate is higher-is-better, so a case is a regression when its
+    rate dropped by more than ``threshold``.
+    """
+    before = baseline["results"]
+    after = current["results"]
+    regressions = []
+    print(f"{'case':<44} {'baseline':>14} {'current':>14} {'change':>9}", file=out)
+    for name in sorted(set(before) | set(after)):
+        if name not in after:
+            print(f"{name:<44} {before[name]['rate']:>14,.1f} {'-':>14}", file=out)
+            continue
+        if name not in before:
+            print(f"{name:<44} {'-':>14} {after[name]['rate']:>14,.1f}", file=out)
+            continue
+        change = after[name]["rate"] / before[name]["rate"] - 1
+        note = ""
+        if change < -threshold:
+            note = "  regression"
+            regressions.append(name)
+        elif change > threshold:
+            note = "  faster"
+        print(f"{name:<44} {before[name]['rate']:>14,.1f} {after[name]['rate']:>14,.1f} "
+              f"{change:>+9.1%}{note}", file=out)
+    for side, results in (("baseline", baseline), ("current", current)):
+        for name, reason in results.get("skipped", {}).items():
+            print(f"{name} was skipped in the {side} run: {reason}", file=out)
+    return regressions
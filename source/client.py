@@ -2,19 +2,52 @@ from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager
 from screens.canvas_screen import CanvasScreen
 from utils.constants import HOST
+from utils.batching import PointBatcher
+from utils.protocol import (
+    DEFAULT_COMPRESS_THRESHOLD, JSON_CODEC, LEGACY_VERSION, POINTS_VERSION,
+    ROOMS_VERSION, SESSION_VERSION, STROKE_STREAM_VERSION, decode_event,
+    offer_hello, request_session, send_frame, without_stroke_ids,
+)
+from utils.framing import FrameReader
+from collections import deque
+import random
 import socket
+import sys
 import threading
-import json
 import time
 from kivy.clock import Clock
-import struct
 
 PORT = 9999
+# Events kept for resending after a reconnect.
+OUTBOX_SIZE = 4096
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+# Smallest frame worth compressing; None turns compression off.
+COMPRESS_THRESHOLD = DEFAULT_COMPRESS_THRESHOLD
 
 class DrawingApp(App):
+    def __init__(self, room=None, **kwargs):
+        super().__init__(**kwargs)
+        # Clients in the same room share a board; without one the server
+        # gives this client a board of its own.
+        self.room = room
+
     def build(self):
-        self.socket = None
+        self.sock = None
+        self.codec = JSON_CODEC
+        self.server_version = LEGACY_VERSION
+        self.compression = None
+        self.batcher = PointBatcher(
+            self._send_event,
+            schedule=lambda delay, callback: Clock.schedule_once(callback, delay)
+        )
         self.send_buffer = []
+        # (sequence number, event) of recent events, oldest first.
+        self.outbox = deque(maxlen=OUTBOX_SIZE)
+        self.seq = 0
+        self.sent_seq = 0
+        self.session_token = None
+        self.send_lock = threading.Lock()
         self.connect_to_server()
         
         sm = ScreenManager()
@@ -26,78 +59,141 @@ class DrawingApp(App):
         def _connect():
             try:
                 print(f"[CLIENT] Connecting to server at {HOST}:{PORT}...")
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((HOST, PORT))
-                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock = self._open_socket()
                 print("[CLIENT] Connected to server.")
-                
-                # Start receive thread
-                threading.Thread(target=self._receive_data, daemon=True).start()
             except Exception as e:
                 print(f"[CLIENT] Could not connect to server: {e}")
+                self.reconnect()
+                return
+                
+            # Start receive thread
+            threading.Thread(target=self._receive_data, args=(sock,), daemon=True).start()
 
         t = threading.Thread(target=_connect, daemon=True)
         t.start()
 
-    def _receive_data(self):
+    def _open_socket(self):
+        """Connect, agree on a codec and pick the session up again.
+        
+        Events the server has not applied yet are sent again before the
+        socket is used for new ones.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((HOST, PORT))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        codec, version, compression = offer_hello(sock, compress_threshold=COMPRESS_THRESHOLD)
+        
+        resumed = False
+        last_seq = 0
+        if version >= SESSION_VERSION:
+            answer = request_session(sock, codec, self.session_token, compression)
+            self.session_token = answer["token"]
+            resumed = answer["resumed"]
+            last_seq = answer["last_seq"]
+        if self.room and version >= ROOMS_VERSION and not resumed:
+            send_frame(sock, codec.encode({"type": "join", "room": self.room}), compression)
+            
+        with self.send_lock:
+            if resumed:
+                missing = [event for seq, event in self.outbox if seq > last_seq]
+                if self.outbox and self.outbox[0][0] > last_seq + 1:
+                    print("[CLIENT] Some events were lost while disconnected")
+            else:
+                # A new session counts from the start again and only gets
+                # what never reached the old one.
+                missing = [event for seq, event in self.outbox if seq > self.sent_seq]
+                self.outbox = deque(enumerate(missing, 1), maxlen=OUTBOX_SIZE)
+                self.seq = len(missing)
+            for event in missing:
+                send_frame(sock, self._encode(codec, version, event), compression)
+            self.sent_seq = self.seq
+            self.codec = codec
+            self.server_version = version
+            self.compression = compression
+            self.sock = sock
+        return sock
+
+    def _receive_data(self, sock):
         """Receive data from server."""
+        compression = self.compression
+        reader = FrameReader(sock, compression)
         while True:
             try:
-                # First receive the message length
-                length_data = self.sock.recv(4)
-                if not length_data:
+                data = reader.read_frame()
+                if data is None:
+                    print("[CLIENT] Server closed the connection")
                     break
                     
-                message_length = struct.unpack('!I', length_data)[0]
-                
-                # Then receive the actual message
-                received_data = b''
-                while len(received_data) < message_length:
-                    chunk = self.sock.recv(message_length - len(received_data))
-                    if not chunk:
-                        break
-                    received_data += chunk
-                
-                if received_data:
-                    event = json.loads(received_data.decode('utf-8'))
-                    current_screen = self.root.current_screen
+                event = decode_event(data)
+                if event["type"] == "save_done":
+                    # Saves run in the background; this is where they finish.
+                    print(f"[CLIENT] Save {event['request_id']} written to {event['path']}")
+                    continue
+                    
+                current_screen = self.root.current_screen
                 if hasattr(current_screen, 'draw_input'):
                     Clock.schedule_once(
-                        lambda dt: current_screen.draw_input.draw_received_line(event)
+                        lambda dt, e=event: current_screen.draw_input.draw_received_line(e)
                     )
                     
             except Exception as e:
                 print(f"[CLIENT] Error receiving data: {e}")
-                self.reconnect()
                 break
+        if compression is not None:
+            print(f"[CLIENT] Compression saved {compression.saved_bytes} of "
+                  f"{compression.raw_bytes} bytes on the last connection")
+        self.reconnect()
 
     def reconnect(self):
-        """Try to reconnect to server"""
+        """Try to reconnect to server, backing off exponentially with jitter"""
+        with self.send_lock:
+            # Events drawn meanwhile wait in the outbox.
+            self.sock = None
+        delay = RECONNECT_BASE_DELAY
         while True:
             try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.connect((HOST, PORT))
-                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock = self._open_socket()
                 print("[CLIENT] Reconnected to server")
                 # Start receive thread again
-                threading.Thread(target=self._receive_data, daemon=True).start()
+                threading.Thread(target=self._receive_data, args=(sock,), daemon=True).start()
                 break
-            except:
-                print("[CLIENT] Reconnection failed, retrying in 5 seconds...")
-                time.sleep(5)
+            except Exception as e:
+                wait = random.uniform(0, delay)
+                print(f"[CLIENT] Reconnection failed ({e}), retrying in {wait:.1f} seconds...")
+                time.sleep(wait)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
     
     def send_drawing_event(self, event):
         """Send a drawing event to the server."""
-        try:
-            if self.sock:
-                message = json.dumps(event).encode('utf-8')
-                # First send the length of the message
-                message_length = struct.pack('!I', len(message))
-                self.sock.sendall(message_length)
-                # Then send the actual message
-                self.sock.sendall(message)
-        except Exception as e:
-            print(f"[CLIENT] Error sending drawing event: {e}")
+        if self.server_version >= POINTS_VERSION:
+            self.batcher.add(event)
+        else:
+            self._send_event(event)
+
+    def _encode(self, codec, version, event):
+        # Events wait in the outbox as drawn and are rewritten for the
+        # server they end up going to.
+        if version < STROKE_STREAM_VERSION:
+            event = without_stroke_ids(event, version)
+        return codec.encode(event)
+
+    def _send_event(self, event):
+        with self.send_lock:
+            self.seq += 1
+            self.outbox.append((self.seq, event))
+            if self.sock is None:
+                return
+            try:
+                send_frame(self.sock, self._encode(self.codec, self.server_version, event), self.compression)
+                self.sent_seq = self.seq
+            except Exception as e:
+                print(f"[CLIENT] Error sending drawing event: {e}")
+                try:
+                    # Wakes up the receive thread, which reconnects.
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock = None
 
 if __name__ == "__main__":
-    DrawingApp().run()
\ No newline at end of file
+    DrawingApp(room=sys.argv[1] if len(sys.argv) > 1 else None).run()
\ No newline at end of file
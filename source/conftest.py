@@ -0,0 +1,2 @@
+# The modules import each other from source/, the directory they are run
+# from; having this file here puts it on the path for the tests as well.
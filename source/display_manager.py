@@ -2,91 +2,126 @@ from kivy.app import App
 from kivy.uix.widget import Widget
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
-from kivy.graphics import Color, Line, Rectangle
+from kivy.graphics import Color, Rectangle
 from kivy.clock import Clock
 import socket
 import json
 import threading
 import struct
-import math
 import sys
-import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.framing import FrameReader
+from utils.png import encode_png
+from utils.protocol import (
+    BINARY_CODEC, DEFAULT_COMPRESS_THRESHOLD, JSON_CODEC, LEGACY_VERSION,
+    SAVE_STREAM_VERSION, answer_hello, decode_event, send_frame, send_payload,
+)
+from utils.strokes import ActiveStrokes, StrokeStore, stroke_ids
+from widgets.layers import StrokeLayers
+
+# Seconds per frame spent applying events; the rest waits for the next frame.
+FRAME_BUDGET = 0.008
+# Events taken off the queue between two checks of the budget.
+DRAIN_BATCH = 256
+DRAW_EVENTS = {"down", "points", "move", "up", "erase", "remove_strokes", "erase_all"}
 
 class CanvasWidget(Widget):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.drawings = []
+        # Lines by stroke ID, which also keys the strokes in ``strokes``.
+        self.drawings = {}
+        self.strokes = StrokeStore()
+        # For strokes from servers that predate stroke IDs.
+        self.stroke_ids = stroke_ids()
+        # Strokes being drawn, however many at once; events from servers
+        # without rooms name no client.
+        self.active_lines = ActiveStrokes()
         with self.canvas.before:
             Color(0, 0, 0, 1)
             self.bg = Rectangle(pos=self.pos, size=self.size)
         self.bind(size=self._update_bg)
+        self.layers = StrokeLayers(self.canvas)
 
     def _update_bg(self, instance, value):
         self.bg.pos = self.pos
         self.bg.size = self.size
         
     def draw_line(self, event):
-        with self.canvas:
-            if event["type"] == "down":
-                Color(*event.get("color", [1, 1, 1, 1]))
-                line = Line(points=[event["x"], event["y"]], width=event.get("width", 2))
-                self.drawings.append(line)
-            elif event["type"] == "move" and self.drawings:
-                self.drawings[-1].points += [event["x"], event["y"]]
-            elif event["type"] == "erase":
-                self.erase_at_point(event["x"], event["y"], event["radius"])
-            elif event["type"] == "erase_all":
-                for line in self.drawings[:]:
-                    self.canvas.remove(line)
-                self.drawings.clear()
+        self.draw_events((event,))
+        
+    def draw_events(self, events):
+        """Apply a run of drawing events in one go."""
+        for event in events:
+            self._draw_event(event)
+                
+    def _draw_event(self, event):
+        client = event.get("client")
+        if event["type"] == "down":
+            stroke_id = event.get("id")
+            if stroke_id is None:
+                # Older servers never send "up"; a new stroke ends the last one.
+                last = self.active_lines.find(event)
+                if last is not None:
+                    self.finish_line(last)
+                stroke_id = next(self.stroke_ids)
+            line = self.layers.add(event.get("color", [1, 1, 1, 1]), event["x"], event["y"], event.get("width", 2))
+            self.drawings[stroke_id] = line
+            self.strokes.add(stroke_id, event["x"], event["y"])
+            self.active_lines.start(stroke_id, client)
+        elif event["type"] in ("points", "move", "up"):
+            stroke_id = self.active_lines.find(event)
+            if stroke_id is None:
+                return
+            if event["type"] == "up":
+                self.finish_line(stroke_id)
+            elif event["type"] == "points":
+                self.extend_line(stroke_id, event["points"])
+            else:
+                self.extend_line(stroke_id, (event["x"], event["y"]))
+        elif event["type"] == "remove_strokes":
+            self.remove_strokes(event["ids"])
+        elif event["type"] == "erase":
+            self.erase_at_point(event["x"], event["y"], event["radius"])
+        elif event["type"] == "erase_all":
+            self.clear()
+
+    def extend_line(self, stroke_id, points):
+        if self.strokes.extend(stroke_id, points) is not None:
+            self.layers.extend(self.drawings[stroke_id], points)
+
+    def finish_line(self, stroke_id):
+        self.active_lines.finish(stroke_id)
+        line = self.drawings.get(stroke_id)
+        if line is not None:
+            self.layers.finish(line)
+
+    def clear(self):
+        self.layers.clear()
+        self.drawings.clear()
+        self.strokes.clear()
+        self.active_lines.clear()
 
     def erase_at_point(self, x, y, radius):
-        lines_to_remove = []
-        for line in self.drawings:
-            if self.line_intersects_circle(line, (x, y), radius):
-                lines_to_remove.append(line)
-                    
-        for line in lines_to_remove:
-            self.canvas.remove(line)
-            self.drawings.remove(line)
-
-    def line_intersects_circle(self, line, center, radius):
-        points = line.points
-        for i in range(0, len(points)-2, 2):
-            ax, ay = points[i], points[i+1]
-            bx, by = points[i+2], points[i+3]
-            
-            vx = bx - ax
-            vy = by - ay
-            wx = center[0] - ax
-            wy = center[1] - ay
-            
-            c1 = wx * vx + wy * vy
-            if c1 <= 0:
-                if math.dist(center, (ax, ay)) <= radius:
-                    return True
-                continue
-                
-            c2 = vx * vx + vy * vy
-            if c2 <= c1:
-                if math.dist(center, (bx, by)) <= radius:
-                    return True
-                continue
-                
-            t = c1 / c2
-            closest = (ax + t * vx, ay + t * vy)
-            if math.dist(center, closest) <= radius:
-                return True
-                
-        return False
+        self.remove_strokes(self.strokes.query(x, y, radius))
+
+    def remove_strokes(self, ids):
+        for stroke_id in ids:
+            line = self.drawings.pop(stroke_id, None)
+            if line is not None:
+                self.layers.remove(line)
+                self.strokes.remove(stroke_id)
 
-    def save_canvas(self, filename):
-        temp_file = f"temp_{filename}.png"
-        self.export_to_png(temp_file)
-        with open(temp_file, 'rb') as f:
-            data = f.read()
-        os.remove(temp_file)
-        return data
+    def grab_pixels(self):
+        """Render the canvas off-screen; returns width, height and RGBA bytes.
+        
+        Rows come top first, the way ``export_to_png`` writes them.
+        """
+        texture = self.export_as_image().texture
+        width, height = texture.size
+        return width, height, texture.pixels
 
 class DisplayLayout(BoxLayout):
     def __init__(self, **kwargs):
@@ -106,32 +141,43 @@ class DisplayLayout(BoxLayout):
         self.title_label.text = title
 
 class DisplayManager(App):
-    def __init__(self, port):
+    def __init__(self, port=None, fd=None):
         super().__init__()
+        # Either a TCP port to listen on, or the descriptor of a connected
+        # socket the server passed down when it started this process.
         self.port = port
+        self.fd = fd
         self.layout = None
         self.server_socket = None
         self.client_connection = None
+        self.codec = JSON_CODEC
+        self.server_version = LEGACY_VERSION
+        self.compression = None
+        # One thread, so saves and the reset after them reach the server in
+        # the order they were asked for.
+        self.saver = ThreadPoolExecutor(max_workers=1)
+        # Filled by the socket thread, drained once per frame by the UI.
+        self.events = deque()
         
     def build(self):
         self.layout = DisplayLayout()
         threading.Thread(target=self.listen_for_events, daemon=True).start()
+        Clock.schedule_interval(self.drain_events, 0)
         return self.layout
 
     def handle_event(self, event):
         try:
             if event["type"] == "save":
-                data = self.layout.canvas_widget.save_canvas(event["filename"])
-                response = {
-                    "type": "save_response",
-                    "data": list(data),
-                    "filename": event["filename"]
-                }
-                data = json.dumps(response).encode()
-                length = struct.pack('!I', len(data))
-                self.client_connection.sendall(length + data)
+                # Only the pixel grab needs the UI thread; encoding does not.
+                pixels = self.layout.canvas_widget.grab_pixels()
+                self.saver.submit(self.send_save_response, event, *pixels)
             elif event["type"] == "set_title":
                 self.layout.set_title(event["title"])
+            elif event["type"] == "reset":
+                # The server hands this display to another client next.
+                self.layout.canvas_widget.clear()
+                self.layout.set_title("Untitled")
+                self.saver.submit(self.send_event, {"type": "reset_done"})
             elif event["type"] == "exit":
                 self.stop()
                 sys.exit()
@@ -139,9 +185,110 @@ class DisplayManager(App):
                 self.layout.canvas_widget.draw_line(event)
         except Exception as e:
             print(f"Error handling event: {e}")
+            
+    def drain_events(self, dt):
+        """Apply what arrived since the last frame, up to FRAME_BUDGET.
+        
+        Whatever is left over is picked up next frame, so a burst cannot
+        hold up rendering.
+        """
+        deadline = time.perf_counter() + FRAME_BUDGET
+        while self.events and time.perf_counter() < deadline:
+            self.handle_events(self.take_batch())
+            
+    def take_batch(self):
+        """Pop up to DRAIN_BATCH events, merging consecutive moves.
+        
+        Moves and points extend one stroke, so a run of them for the same
+        stroke from the same client becomes a single ``points`` update.
+        """
+        batch = []
+        points = None
+        for _ in range(min(len(self.events), DRAIN_BATCH)):
+            event = self.events.popleft()
+            if event["type"] == "move" or event["type"] == "points":
+                client = event.get("client")
+                stroke_id = event.get("id")
+                if (points is None or batch[-1].get("client") != client
+                        or batch[-1].get("id") != stroke_id):
+                    points = []
+                    merged = {"type": "points", "points": points}
+                    if client is not None:
+                        merged["client"] = client
+                    if stroke_id is not None:
+                        merged["id"] = stroke_id
+                    batch.append(merged)
+                if event["type"] == "move":
+                    points.append(event["x"])
+                    points.append(event["y"])
+                else:
+                    points.extend(event["points"])
+            else:
+                points = None
+                batch.append(event)
+        return batch
+        
+    def handle_events(self, batch):
+        drawing = []
+        for event in batch:
+            if event["type"] in DRAW_EVENTS:
+                drawing.append(event)
+                continue
+            self.apply_drawing(drawing)
+            drawing = []
+            self.handle_event(event)
+        self.apply_drawing(drawing)
+        
+    def apply_drawing(self, events):
+        if not events:
+            return
+        try:
+            self.layout.canvas_widget.draw_events(events)
+        except Exception as e:
+            print(f"Error handling event: {e}")
+            
+    def send_save_response(self, event, width, height, pixels):
+        try:
+            data = encode_png(width, height, pixels)
+            if self.server_version >= SAVE_STREAM_VERSION:
+                # Small header frame, then the PNG bytes as they are.
+                response = {
+                    "type": "save_response",
+                    "size": len(data),
+                    "filename": event["filename"]
+                }
+                if "request_id" in event:
+                    response["request_id"] = event["request_id"]
+                send_frame(self.client_connection, BINARY_CODEC.encode(response), self.compression)
+                # PNG data is deflated already, so it goes as it is.
+                send_payload(self.client_connection, data)
+            else:
+                response = {
+                    "type": "save_response",
+                    "data": list(data),
+                    "filename": event["filename"]
+                }
+                data = json.dumps(response).encode()
+                length = struct.pack('!I', len(data))
+                self.client_connection.sendall(length + data)
+        except Exception as e:
+            print(f"Error saving canvas: {e}")
+            
+    def send_event(self, event):
+        try:
+            send_frame(self.client_connection, self.codec.encode(event), self.compression)
+        except Exception as e:
+            print(f"Error sending event: {e}")
         
     def listen_for_events(self):
         try:
+            if self.fd is not None:
+                self.client_connection = socket.socket(fileno=self.fd)
+                self.serve_connection()
+                # The server is gone; nobody else can connect to this display.
+                self.events.append({"type": "exit"})
+                return
+                
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.bind(('localhost', self.port))
             self.server_socket.listen(1)
@@ -150,18 +297,7 @@ class DisplayManager(App):
             while True:
                 self.client_connection, addr = self.server_socket.accept()
                 print(f"Display connected to {addr}")
-                
-                while True:
-                    length_data = self.client_connection.recv(4)
-                    if not length_data:
-                        break
-                        
-                    message_length = struct.unpack('!I', length_data)[0]
-                    data = self.client_connection.recv(message_length)
-                    if data:
-                        event = json.loads(data.decode())
-                        Clock.schedule_once(lambda dt, e=event: self.handle_event(e))
-                
+                self.serve_connection()
                 self.client_connection.close()
                 
         except Exception as e:
@@ -169,6 +305,26 @@ class DisplayManager(App):
         finally:
             self.cleanup()
 
+    def serve_connection(self):
+        self.codec = JSON_CODEC
+        self.server_version = LEGACY_VERSION
+        self.compression = None
+        reader = FrameReader(self.client_connection)
+        
+        while True:
+            data = reader.read_frame()
+            if data is None:
+                break
+                
+            event = decode_event(data)
+            if event["type"] == "hello":
+                self.codec, self.server_version, self.compression = answer_hello(
+                    self.client_connection, event, DEFAULT_COMPRESS_THRESHOLD
+                )
+                reader.compression = self.compression
+                continue
+            self.events.append(event)
+
     def cleanup(self):
         if self.client_connection:
             self.client_connection.close()
@@ -176,16 +332,21 @@ class DisplayManager(App):
             self.server_socket.close()
 
     def on_stop(self):
+        self.saver.shutdown(wait=False)
         self.cleanup()
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: python display_manager.py <port>")
+    if len(sys.argv) == 3 and sys.argv[1] == '--fd':
+        args = {'fd': sys.argv[2]}
+    elif len(sys.argv) == 2:
+        args = {'port': sys.argv[1]}
+    else:
+        print("Usage: python display_manager.py <port> | --fd <descriptor>")
         sys.exit(1)
     
     try:
-        port = int(sys.argv[1])
-        DisplayManager(port).run()
+        args = {name: int(value) for name, value in args.items()}
     except ValueError:
-        print("Port must be a number")
-        sys.exit(1)
\ No newline at end of file
+        print("Port and descriptor must be numbers")
+        sys.exit(1)
+    DisplayManager(**args).run()
\ No newline at end of file
@@ -0,0 +1,313 @@
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from metrics import ConnectionStats, Histogram
+from utils.framing import FrameReader
+from utils.protocol import DEFAULT_COMPRESS_THRESHOLD, HANDSHAKE_TIMEOUT, offer_hello
+
+DISPLAY_SCRIPT = 'display_manager.py'
+DISPLAY_CONNECT_RETRIES = 10
+DISPLAY_RETRY_DELAY = 0.5
+FIRST_DISPLAY_PORT = 5000
+# How long a display started on a socket pair gets to answer the hello:
+# as long as TCP displays get to start listening and then answer.
+DISPLAY_BOOT_TIMEOUT = DISPLAY_CONNECT_RETRIES * DISPLAY_RETRY_DELAY + HANDSHAKE_TIMEOUT
+
+# Displays get one end of a socket pair when the platform has them, and
+# are connected to over loopback TCP otherwise.
+TRANSPORT_UNIX = 'unix'
+TRANSPORT_TCP = 'tcp'
+DEFAULT_TRANSPORT = TRANSPORT_UNIX if hasattr(socket, 'AF_UNIX') else TRANSPORT_TCP
+
+DEFAULT_MIN_SIZE = 1
+DEFAULT_MAX_SIZE = 16
+DEFAULT_IDLE_TIMEOUT = 300.0
+ACQUIRE_TIMEOUT = 30.0
+RESET_TIMEOUT = 5.0
+
+
+class DisplayWorker:
+    """A booted display process and the connection the server keeps to it."""
+
+    def __init__(self, process, port, sock, codec, version, compression=None):
+        self.process = process
+        # None for displays on a socket pair.
+        self.port = port
+        self.name = f"on port {port}" if port is not None else f"with pid {process.pid}"
+        self.sock = sock
+        # Traffic over the display's lifetime, whichever room it was in.
+        self.stats = ConnectionStats(name=self.name, pid=process.pid)
+        self.stats.compression = compression
+        # Kept with the worker: it may hold frames read ahead for the next room.
+        self.reader = FrameReader(sock, compression, stats=self.stats)
+        self.codec = codec
+        self.version = version
+        self.compression = compression
+        self.idle_since = time.monotonic()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.compression is not None and self.compression.raw_bytes:
+            print(f"[POOL] Compression saved {self.compression.saved_bytes} of "
+                  f"{self.compression.raw_bytes} bytes to display {self.name}")
+        self.sock.close()
+        if self.alive():
+            self.process.kill()
+
+
+class DisplayPool:
+    """Keeps display processes booted ahead of time and reuses them.
+
+    ``min_size`` workers are kept idle and ready for the next client, as long
+    as there are fewer than ``max_size`` workers in total.  Workers whose
+    display was reset are put back when their client leaves; idle workers
+    beyond ``min_size`` are stopped after ``idle_timeout`` seconds.
+    Connections to displays are compressed unless ``compress_threshold``
+    is None.  ``transport`` picks how displays are connected to.
+    """
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, script=DISPLAY_SCRIPT,
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD, transport=DEFAULT_TRANSPORT):
+        if min_size > max_size:
+            raise ValueError("min_size cannot be larger than max_size")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.script = script
+        self.compress_threshold = compress_threshold
+        self.transport = transport
+        self.next_display_port = FIRST_DISPLAY_PORT
+        # Most recently released last, so the oldest idle workers time out.
+        self.idle = []
+        self.busy = set()
+        self.starting = 0
+        self.waiting = 0
+        # Seconds from starting a display process to it answering the hello.
+        self.spawn_seconds = Histogram()
+        self.spawn_failures = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            self._refill_locked()
+        threading.Thread(target=self._maintain, daemon=True).start()
+
+    def size(self):
+        return len(self.idle) + len(self.busy) + self.starting
+
+    def stats(self):
+        with self.condition:
+            workers = [(worker, "idle") for worker in self.idle] + [(worker, "busy") for worker in self.busy]
+            result = {
+                "idle": len(self.idle),
+                "busy": len(self.busy),
+                "starting": self.starting,
+                "waiting": self.waiting,
+                "spawn_seconds": self.spawn_seconds.snapshot(buckets=True),
+                "spawn_failures": self.spawn_failures,
+            }
+        result["workers"] = [dict(worker.stats.snapshot(), state=state) for worker, state in workers]
+        return result
+
+    def acquire(self, timeout=ACQUIRE_TIMEOUT):
+        """Hand out a ready worker, or None if none frees up within ``timeout``."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while True:
+                    worker = self._pop_idle_locked()
+                    if worker is not None:
+                        self.busy.add(worker)
+                        break
+                    self._refill_locked()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            # Replace the spare that was just handed out.
+            self._refill_locked()
+        return worker
+
+    def release(self, worker, clean=False):
+        """Take a worker back from a client.
+
+        The server resets the display itself, since it is the one reading
+        the display's connection; ``clean`` says the display confirmed the
+        reset.  Workers that are not clean are stopped.
+        """
+        with self.condition:
+            self.busy.discard(worker)
+            reusable = clean and not self.closed and worker.alive()
+
+        if reusable:
+            try:
+                # asyncio streams may have left the socket non-blocking.
+                worker.sock.setblocking(True)
+            except OSError as e:
+                print(f"[POOL] Display {worker.name} is unusable: {e}")
+                reusable = False
+
+        if not reusable:
+            worker.close()
+
+        with self.condition:
+            if reusable:
+                worker.idle_since = time.monotonic()
+                self.idle.append(worker)
+                self.condition.notify_all()
+            else:
+                self._refill_locked()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            workers = self.idle + list(self.busy)
+            self.idle.clear()
+            self.busy.clear()
+        for worker in workers:
+            worker.close()
+
+    def _pop_idle_locked(self):
+        while self.idle:
+            worker = self.idle.pop()
+            if worker.alive():
+                return worker
+            worker.close()
+        return None
+
+    def _refill_locked(self):
+        if self.closed:
+            return
+        wanted = self.min_size + self.waiting - len(self.idle) - self.starting
+        wanted = min(wanted, self.max_size - self.size())
+        for _ in range(wanted):
+            self.starting += 1
+            threading.Thread(target=self._boot, daemon=True).start()
+
+    def _boot(self):
+        worker = None
+        started = time.perf_counter()
+        try:
+            worker = self._spawn()
+        except Exception as e:
+            print(f"[POOL] Failed to start display: {e}")
+
+        with self.condition:
+            self.starting -= 1
+            if worker is None:
+                self.spawn_failures += 1
+            else:
+                worker.stats.info["spawn_seconds"] = time.perf_counter() - started
+                self.spawn_seconds.observe(worker.stats.info["spawn_seconds"])
+            if worker is not None and self.closed:
+                worker.close()
+            elif worker is not None:
+                self.idle.append(worker)
+            self.condition.notify_all()
+
+    def _allocate_port(self):
+        with self.condition:
+            display_port = self.next_display_port
+            self.next_display_port += 1
+        return display_port
+
+    def _spawn(self):
+        if self.transport == TRANSPORT_UNIX:
+            return self._spawn_paired()
+        return self._spawn_tcp()
+
+    def _spawn_paired(self):
+        """Start a display on one end of a socket pair and keep the other.
+
+        The display inherits its end, so there is no port to pick and
+        nothing to connect to; the hello waits in the pair until the
+        display has booted and reads it.  The display is always one of
+        ours, so one that does not answer in time has failed to start, and
+        is not taken for a legacy display.
+        """
+        display_sock, child_sock = socket.socketpair()
+        try:
+            process = subprocess.Popen(
+                [sys.executable, self.script, '--fd', str(child_sock.fileno())],
+                pass_fds=(child_sock.fileno(),),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError:
+            display_sock.close()
+            raise
+        finally:
+            child_sock.close()
+
+        try:
+            codec, version, compression = offer_hello(
+                display_sock, DISPLAY_BOOT_TIMEOUT, self.compress_threshold, legacy=False
+            )
+        except socket.timeout:
+            display_sock.close()
+            process.kill()
+            raise ConnectionError(f"display did not answer within {DISPLAY_BOOT_TIMEOUT:g}s")
+        except OSError:
+            display_sock.close()
+            process.kill()
+            raise
+        return DisplayWorker(process, None, display_sock, codec, version, compression)
+
+    def _spawn_tcp(self):
+        display_port = self._allocate_port()
+
+        # Workers live for many clients, so their output must not go to a
+        # pipe nobody reads.
+        process = subprocess.Popen(
+            [sys.executable, self.script, str(display_port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+        display_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        retries = 0
+        while retries < DISPLAY_CONNECT_RETRIES:
+            try:
+                display_sock.connect(('localhost', display_port))
+                break
+            except OSError:
+                retries += 1
+                time.sleep(DISPLAY_RETRY_DELAY)
+
+        if retries == DISPLAY_CONNECT_RETRIES:
+            display_sock.close()
+            process.kill()
+            raise ConnectionError(f"display on port {display_port} did not come up")
+
+        codec, version, compression = offer_hello(
+            display_sock, compress_threshold=self.compress_threshold
+        )
+        return DisplayWorker(process, display_port, display_sock, codec, version, compression)
+
+    def _maintain(self):
+        interval = max(min(self.idle_timeout / 4, 5.0), 0.1)
+        while not self.closed:
+            time.sleep(interval)
+            now = time.monotonic()
+            expired = []
+            with self.condition:
+                for worker in self.idle[:]:
+                    if not worker.alive():
+                        self.idle.remove(worker)
+                        expired.append(worker)
+                while (len(self.idle) > self.min_size
+                       and now - self.idle[0].idle_since > self.idle_timeout):
+                    expired.append(self.idle.pop(0))
+                self._refill_locked()
+            for worker in expired:
+                worker.close()
@@ -0,0 +1,231 @@
+"""What a room still has to write to its display, coalesced while it lags.
+
+A display that cannot keep up leaves events waiting in its queue, and the
+queue makes them cheaper to catch up on before it has to hold anyone up:
+
+* ``points`` and ``move`` events of a stroke are merged into one
+  ``points`` event with everything the stroke has gained meanwhile;
+* an ``erase`` drops the waiting erases whose circle lies inside its own,
+  as those cannot remove anything it does not;
+* an ``erase_all`` drops the drawing waiting before it.
+
+Saves, titles and resets are never dropped or moved, and nothing is
+coalesced across them, so a save still captures what had been drawn when
+it was asked for.  Once ``maxsize`` events are waiting, whoever sends the
+next one waits for the display.
+"""
+import collections
+import threading
+import time
+
+from metrics import ConnectionStats
+from rooms import WRITE_BATCH, WRITER_CLOSE_TIMEOUT
+from utils.framing import send_buffers
+from utils.protocol import (
+    POINTS_VERSION, ROOMS_VERSION, decode_event, event_type, pack_frame,
+    stroke_of, tag_sender,
+)
+
+DISPLAY_QUEUE_SIZE = 256
+# Waiting events a new one is checked against for merging or collapsing.
+COALESCE_WINDOW = 64
+# ``points`` events count their points in 16 bits.
+MAX_MERGED_POINTS = 8192
+# Events that only change what is drawn, which an ``erase_all`` makes moot.
+DRAWING_EVENTS = {"down", "move", "points", "up", "erase", "remove_strokes", "erase_all"}
+
+
+class DisplayQueue:
+    """Events waiting for a display whose ``codec`` and ``version`` are given.
+
+    Not thread-safe; the writer that owns it locks around every call.
+    """
+
+    def __init__(self, codec, version, maxsize=DISPLAY_QUEUE_SIZE):
+        self.codec = codec
+        self.version = version
+        self.maxsize = maxsize
+        # [type, sender, body, points, stroke, when queued]; a merged
+        # event has its points and no body until it is taken, and the time
+        # its first part was queued.
+        self.items = collections.deque()
+        self.max_depth = 0
+        self.merged = 0
+        self.collapsed = 0
+        self.discarded = 0
+        self.stalls = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def full(self):
+        return len(self.items) >= self.maxsize
+
+    def push(self, body, client_id=None):
+        kind = event_type(body)
+        stroke_id = None
+        if kind in ("points", "move") and self.version >= POINTS_VERSION:
+            stroke_id = stroke_of(body)
+            if self._merge(client_id, stroke_id, body):
+                return
+        elif kind == "erase":
+            self._collapse(decode_event(body))
+        elif kind == "erase_all":
+            self._discard()
+        self.items.append([kind, client_id, body, None, stroke_id, time.perf_counter()])
+        self.max_depth = max(self.max_depth, len(self.items))
+
+    def take(self, limit=WRITE_BATCH):
+        """Remove up to ``limit`` events from the front.
+
+        Returns ``(body, when queued)`` pairs.
+        """
+        taken = []
+        while self.items and len(taken) < limit:
+            kind, client_id, body, points, stroke_id, queued = self.items.popleft()
+            if body is None:
+                body = self._encode(client_id, stroke_id, points)
+            taken.append((body, queued))
+        return taken
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {
+            "depth": len(self.items),
+            "max_depth": self.max_depth,
+            "merged": self.merged,
+            "collapsed": self.collapsed,
+            "discarded": self.discarded,
+            "stalls": self.stalls,
+        }
+
+    def _waiting(self):
+        """Waiting events from the newest back, up to the last save or reset."""
+        for i, item in enumerate(reversed(self.items)):
+            if i == COALESCE_WINDOW or item[0] not in DRAWING_EVENTS:
+                return
+            yield item
+
+    def _merge(self, client_id, stroke_id, body):
+        # Other strokes in between do not touch this one, but anything
+        # else ends the search.
+        for item in self._waiting():
+            if item[0] not in ("points", "move"):
+                return False
+            if item[1] == client_id and item[4] == stroke_id:
+                break
+        else:
+            return False
+        points = _points(decode_event(body))
+        if item[3] is None:
+            item[3] = _points(decode_event(item[2]))
+        if len(item[3]) + len(points) > MAX_MERGED_POINTS * 2:
+            return False
+        item[0] = "points"
+        item[2] = None
+        item[3].extend(points)
+        self.merged += 1
+        return True
+
+    def _collapse(self, event):
+        x, y, radius = event["x"], event["y"], event["radius"]
+        superseded = []
+        for item in self._waiting():
+            if item[0] != "erase":
+                continue
+            other = decode_event(item[2])
+            distance = ((other["x"] - x) ** 2 + (other["y"] - y) ** 2) ** 0.5
+            if distance + other["radius"] <= radius:
+                superseded.append(item)
+        for item in superseded:
+            self.items.remove(item)
+        self.collapsed += len(superseded)
+
+    def _discard(self):
+        while self.items and self.items[-1][0] in DRAWING_EVENTS:
+            self.items.pop()
+            self.discarded += 1
+
+    def _encode(self, client_id, stroke_id, points):
+        event = {"type": "points", "points": points}
+        # Only set where the display was sent stroke IDs to begin with.
+        if stroke_id is not None:
+            event["id"] = stroke_id
+        body = self.codec.encode(event)
+        if client_id is None or self.version < ROOMS_VERSION:
+            return body
+        return tag_sender(body, client_id)
+
+
+def _points(event):
+    if event["type"] == "move":
+        return [event["x"], event["y"]]
+    return list(event["points"])
+
+
+class DisplayWriter:
+    """Writes a :class:`DisplayQueue` to a display socket from a thread.
+
+    ``put`` only waits while the queue is full, so the clients of a room
+    are not held up by each frame the display is slow to read.  What is
+    written is counted in ``stats``.
+    """
+
+    def __init__(self, sock, codec, version, compression=None, maxsize=DISPLAY_QUEUE_SIZE, stats=None):
+        self.sock = sock
+        self.compression = compression
+        self.queue = DisplayQueue(codec, version, maxsize)
+        self.stats = stats if stats is not None else ConnectionStats()
+        self.stats.depth = self.depth
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def put(self, body, client_id=None):
+        with self.condition:
+            if self.queue.full():
+                self.queue.stalls += 1
+            while self.queue.full() and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise ConnectionError("Display connection closed")
+            self.queue.push(body, client_id)
+            self.condition.notify_all()
+
+    def queue_stats(self):
+        with self.condition:
+            return self.queue.stats()
+
+    def depth(self):
+        return len(self.queue)
+
+    def close(self):
+        """Let the writer send what is already queued, then stop it."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(WRITER_CLOSE_TIMEOUT)
+
+    def _write(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.closed:
+                        self.condition.wait()
+                    if not self.queue:
+                        return
+                    taken = self.queue.take()
+                    self.condition.notify_all()
+                    # Packed here so frames enter the deflate stream in order.
+                    pack = pack_frame if self.compression is None else self.compression.pack
+                    items = [(pack(body), queued) for body, queued in taken]
+                send_buffers(self.sock, [frame for frame, queued in items])
+                self.stats.written(items)
+        except OSError:
+            with self.condition:
+                self.closed = True
+                self.queue.clear()
+                self.condition.notify_all()
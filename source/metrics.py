@@ -0,0 +1,248 @@
+"""Counters the server keeps about its clients, displays and saves.
+
+Every connection has a :class:`ConnectionStats`: frames and bytes in and
+out as they are on the wire, how long frames waited to be written, and
+for clients how long their events took to be passed on.  The thread
+reading a connection is the only one counting what comes in, and its
+writer the only one counting what goes out, so the counters are plain
+attributes without a lock.  Readers of a snapshot may see one counter a
+frame ahead of another, which is fine for what they are for.
+
+Ask a running server for a snapshot with:
+
+    python metrics.py [--host HOST] [--port PORT] [--watch SECONDS]
+"""
+import argparse
+import bisect
+import json
+import os
+import socket
+import threading
+import time
+
+from utils.protocol import (
+    DEFAULT_COMPRESS_THRESHOLD, STATS_VERSION, offer_hello, request_stats,
+)
+
+DEFAULT_METRICS_INTERVAL = 10.0
+# Bucket bounds in seconds: 10 us doubling up to about 20 s.
+LATENCY_BOUNDS = tuple(1e-5 * 2 ** i for i in range(22))
+# Bucket bounds in bytes: 1 KiB doubling up to 32 MiB.
+SIZE_BOUNDS = tuple(1024 * 2 ** i for i in range(16))
+QUANTILES = (50, 90, 99)
+
+
+class Histogram:
+    """Counts of values in fixed buckets, for values that span decades.
+
+    Bucket ``i`` counts values up to ``bounds[i]``; the last one counts
+    whatever is larger.  Percentiles are read off the bucket bounds, so
+    they are only as fine as the buckets.
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self, buckets=False):
+        result = {"count": self.count, "mean": self.total / self.count if self.count else None, "max": self.max}
+        for p in QUANTILES:
+            result[f"p{p}"] = self.percentile(p)
+        if buckets:
+            # Upper bound -> count, the last one open ended.
+            result["buckets"] = [[bound, count] for bound, count in zip(self.bounds + (None,), self.counts)]
+        return result
+
+
+class ConnectionStats:
+    """Traffic through one client or display connection.
+
+    ``queued`` times frames from being queued for the connection to being
+    written to it.  ``relay`` times a client's events from being read to
+    having been queued for the journal, the display and the room.
+    ``depth``, if set, returns how many frames are waiting to go out.
+    ``compression`` is the connection's :class:`StreamCompression`, if it
+    has one, whose byte counts go in snapshots.  ``info`` is copied into
+    snapshots as it is.
+    """
+
+    def __init__(self, **info):
+        self.started = time.monotonic()
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+        self.queued = Histogram()
+        self.relay = Histogram()
+        self.depth = None
+        self.compression = None
+        # Bytes through the deflate streams of merged connections, before
+        # and after compression.
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.info = info
+
+    def received(self, size, frames=1):
+        self.frames_in += frames
+        self.bytes_in += size
+
+    def written(self, items):
+        """Count ``(frame, time queued)`` pairs that were just written."""
+        now = time.perf_counter()
+        for frame, queued in items:
+            self.frames_out += 1
+            self.bytes_out += len(frame)
+            self.queued.observe(now - queued)
+
+    def merge(self, other):
+        self.frames_in += other.frames_in
+        self.bytes_in += other.bytes_in
+        self.frames_out += other.frames_out
+        self.bytes_out += other.bytes_out
+        self.queued.merge(other.queued)
+        self.relay.merge(other.relay)
+        raw, wire = other.compressed_bytes()
+        self.raw_bytes += raw
+        self.wire_bytes += wire
+
+    def compressed_bytes(self):
+        """Bytes through the deflate streams, before and after compression."""
+        raw, wire = self.raw_bytes, self.wire_bytes
+        if self.compression is not None:
+            raw += self.compression.raw_bytes
+            wire += self.compression.wire_bytes
+        return raw, wire
+
+    def snapshot(self, buckets=False):
+        result = dict(self.info)
+        result.update({
+            "seconds": time.monotonic() - self.started,
+            "frames_in": self.frames_in,
+            "bytes_in": self.bytes_in,
+            "frames_out": self.frames_out,
+            "bytes_out": self.bytes_out,
+            "queue_depth": self.depth() if self.depth is not None else 0,
+            "queued_seconds": self.queued.snapshot(buckets),
+        })
+        if self.relay.count:
+            result["relay_seconds"] = self.relay.snapshot(buckets)
+        raw, wire = self.compressed_bytes()
+        if raw:
+            result["compression"] = {"raw_bytes": raw, "wire_bytes": wire, "saved_bytes": raw - wire}
+        return result
+
+
+def merged(stats):
+    total = ConnectionStats()
+    for item in stats:
+        total.merge(item)
+    return total
+
+
+class Metrics:
+    """The server's counters: one :class:`ConnectionStats` per client
+    connection, and the saves.
+
+    Clients that left are folded into one total so the totals cover the
+    whole uptime.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.departed = ConnectionStats()
+        self.save_seconds = Histogram()
+        self.save_bytes = Histogram(SIZE_BOUNDS)
+
+    def connect(self, connection):
+        stats = ConnectionStats()
+        with self.lock:
+            self.clients[connection] = stats
+        return stats
+
+    def disconnect(self, connection):
+        with self.lock:
+            stats = self.clients.pop(connection, None)
+            if stats is not None:
+                self.departed.merge(stats)
+
+    def saved(self, seconds, size):
+        with self.lock:
+            if seconds is not None:
+                self.save_seconds.observe(seconds)
+            self.save_bytes.observe(size)
+
+    def snapshot(self):
+        with self.lock:
+            clients = list(self.clients.items())
+            total = merged([self.departed] + [stats for _, stats in clients])
+            saves = {
+                "seconds": self.save_seconds.snapshot(buckets=True),
+                "bytes": self.save_bytes.snapshot(buckets=True),
+            }
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "clients": [dict(stats.snapshot(), connection=connection) for connection, stats in clients],
+            "client_totals": total.snapshot(buckets=True),
+            "saves": saves,
+        }
+
+
+def write_metrics_file(path, snapshot):
+    """Replace ``path`` with ``snapshot`` as JSON, so readers never see half of one."""
+    partial = f"{path}.part"
+    with open(partial, 'w') as f:
+        json.dump(snapshot, f, indent=2)
+        f.write('\n')
+    os.replace(partial, path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Print a drawing server's stats")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--watch', type=float, help="ask again every this many seconds")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with socket.create_connection((args.host, args.port)) as sock:
+        codec, version, compression = offer_hello(sock, compress_threshold=DEFAULT_COMPRESS_THRESHOLD)
+        if version < STATS_VERSION:
+            raise SystemExit("The server is too old to report stats")
+        while True:
+            print(json.dumps(request_stats(sock, codec, compression), indent=2), flush=True)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
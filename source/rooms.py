@@ -0,0 +1,309 @@
+import itertools
+import queue
+import socket
+import threading
+import time
+
+from metrics import ConnectionStats
+from utils.framing import send_buffers
+from utils.protocol import (
+    BINARY_CODEC, JSON_CODEC, JSON_MARKER, POINTS_VERSION, ROOMS_VERSION,
+    SAVE_ID_VERSION, STROKE_STREAM_VERSION, decode_event, event_type,
+    expand_points, pack_frame, sender_of, strip_sender, strip_stroke_ids,
+    tag_sender, transcode,
+)
+from utils.strokes import stroke_ids
+
+OUTBOUND_QUEUE_SIZE = 1024
+WRITER_CLOSE_TIMEOUT = 1.0
+# Queued frames a writer sends in one system call.
+WRITE_BATCH = 64
+# Events every other member of a room gets a copy of.
+BROADCAST_EVENTS = {"down", "move", "points", "up", "erase", "remove_strokes", "erase_all"}
+
+
+class Member:
+    """A client in a room and the frames still to be sent to it.
+
+    A writer thread per member empties the queue, so a slow client only
+    holds up itself.  A client that falls ``queue_size`` frames behind is
+    disconnected.  What is written is counted in ``stats``.
+    """
+
+    def __init__(self, client_id, conn, codec, version, compression=None,
+                 queue_size=OUTBOUND_QUEUE_SIZE, stats=None):
+        self.client_id = client_id
+        self.conn = conn
+        self.codec = codec
+        self.version = version
+        self.compression = compression
+        # (frame, when it was queued)
+        self.queue = queue.Queue(queue_size)
+        self.stats = stats if stats is not None else ConnectionStats()
+        self.stats.depth = self.queue.qsize
+        self.stats.compression = compression
+        # Frames enter the deflate stream in the order they are queued.
+        self.lock = threading.Lock()
+        self.dropped = False
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def send(self, frame):
+        try:
+            self.queue.put_nowait((frame, time.perf_counter()))
+        except queue.Full:
+            self.drop()
+
+    def send_body(self, body):
+        """Queue a frame body, compressed if the connection is."""
+        if self.compression is None:
+            self.send(pack_frame(body))
+            return
+        with self.lock:
+            self.send(self.compression.pack(body))
+
+    def drop(self):
+        if self.dropped:
+            return
+        self.dropped = True
+        print(f"[SERVER] Client {self.client_id} fell too far behind, disconnecting")
+        self.disconnect()
+
+    def disconnect(self):
+        try:
+            # Wakes up the client's read loop, which then leaves the room.
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Let the writer send what is already queued, then stop it."""
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            return
+        self.thread.join(WRITER_CLOSE_TIMEOUT)
+
+    def _write(self):
+        try:
+            while True:
+                items = [self.queue.get()]
+                # Whatever else is already queued goes out with it.
+                while len(items) < WRITE_BATCH and items[-1] is not None:
+                    try:
+                        items.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                closing = items[-1] is None
+                if closing:
+                    items.pop()
+                send_buffers(self.conn, [frame for frame, queued in items])
+                self.stats.written(items)
+                if closing:
+                    break
+        except OSError:
+            pass
+
+
+class Room:
+    """Clients drawing together on one display.
+
+    The server owning the room fills in ``worker`` and ``display``, the
+    writer whose ``put`` queues a frame body for the display, and sets
+    ``ready`` once it has tried to get a display.  ``reset_done`` is set by whoever reads the
+    display when it confirms a reset.  Named rooms keep a ``journal`` of
+    their events so displays and members that arrive later can catch up.
+    """
+
+    def __init__(self, name, ready, reset_done, journal=None):
+        self.name = name
+        self.ready = ready
+        self.reset_done = reset_done
+        self.journal = journal
+        self.worker = None
+        self.display = None
+        self.members = {}
+        # IDs of members that lost their connection but may resume.
+        self.held = set()
+        # Where the journal ended when each held member lost its connection.
+        self.detached_at = {}
+        self.closed = False
+        # Events reach the journal, the display and the members in the
+        # same order, and joining happens between two events.
+        self.lock = threading.RLock()
+        self.save_ids = itertools.count(1)
+        # For strokes from clients that predate stroke IDs.
+        self.stroke_ids = stroke_ids()
+        # save ID given to the display -> (client ID, the client's request ID,
+        # when it was asked for)
+        self.pending_saves = {}
+
+    def add(self, member):
+        """Add a member; returns False if the room has closed meanwhile.
+
+        Members that take pushed events first get what has been drawn so
+        far, or, resuming a session, what was drawn while they were away.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            since = self.detached_at.pop(member.client_id, None)
+            if since is None and member.client_id in self.members and self.journal is not None:
+                # Taking over from a connection the server has not seen
+                # drop yet; everything up to now was queued for that one.
+                since = self.journal.position()
+            if self.journal is not None and member.version >= ROOMS_VERSION:
+                self.catch_up(member, since)
+            self.held.discard(member.client_id)
+            self.members[member.client_id] = member
+            return True
+
+    def detach(self, client_id):
+        """Keep the place of a member whose connection dropped."""
+        with self.lock:
+            self.members.pop(client_id, None)
+            self.held.add(client_id)
+            if self.journal is not None:
+                self.detached_at[client_id] = self.journal.position()
+
+    def remove(self, client_id):
+        """Remove a member; returns True if that was the last one."""
+        with self.lock:
+            self.members.pop(client_id, None)
+            self.held.discard(client_id)
+            self.detached_at.pop(client_id, None)
+            if self.members or self.held or self.closed:
+                return False
+            self.closed = True
+            return True
+
+    def send(self, body, client_id=None):
+        with self.lock:
+            self.display.put(body, client_id)
+
+    def relay(self, client_id, body):
+        """Pass a member's event on to the journal, the display and others.
+
+        Only drawing events go to the other members.
+        """
+        kind = event_type(body)
+        with self.lock:
+            if kind == "down":
+                body = self.stamp_stroke(body)
+            tagged = tag_sender(body, client_id)
+            if self.journal is not None:
+                self.journal.append(tagged)
+            self.to_display(tagged)
+            if kind in BROADCAST_EVENTS:
+                self.broadcast(client_id, tagged)
+
+    def stamp_stroke(self, body):
+        """Give a stroke that was started without an ID one of the room's."""
+        event = decode_event(body)
+        if "id" in event:
+            return body
+        event["id"] = next(self.stroke_ids)
+        codec = JSON_CODEC if body[0] == JSON_MARKER else BINARY_CODEC
+        return codec.encode(event)
+
+    def to_display(self, tagged):
+        # The sender goes along even where the display is not told, so the
+        # display's queue only merges points of the same stroke.
+        client_id = sender_of(tagged)
+        version = self.worker.version
+        if version < STROKE_STREAM_VERSION:
+            tagged = strip_stroke_ids(tagged, version)
+        if version < ROOMS_VERSION:
+            tagged = strip_sender(tagged)
+            if version < POINTS_VERSION and event_type(tagged) == "points":
+                for event in expand_points(decode_event(tagged)):
+                    self.send(JSON_CODEC.encode(event), client_id)
+                return
+        self.send(transcode(tagged, self.worker.codec), client_id)
+
+    def broadcast(self, client_id, tagged):
+        """Queue an event for every other member that takes pushed events.
+
+        The frame is built once per codec and stroke ID support in use, and
+        the same bytes are queued for every member it suits.  Only bodies
+        long enough to be compressed are packed per member, each through
+        the stream of its connection.
+        """
+        bodies = {}
+        frames = {}
+        for member in list(self.members.values()):
+            if member.client_id == client_id or member.version < ROOMS_VERSION:
+                continue
+            key = (member.codec, min(member.version, STROKE_STREAM_VERSION))
+            body = bodies.get(key)
+            if body is None:
+                body = tagged if key[1] == STROKE_STREAM_VERSION else strip_stroke_ids(tagged, key[1])
+                body = bodies[key] = transcode(body, member.codec)
+            if member.compression is not None and len(body) >= member.compression.threshold:
+                member.send_body(body)
+                continue
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = pack_frame(body)
+            member.send(frame)
+
+    def replay_to_display(self):
+        """Redraw what the journal holds on a display that just joined."""
+        if self.journal is None:
+            return
+        with self.lock:
+            for body in self.journal.replay_frames():
+                self.to_display(body)
+
+    def catch_up(self, member, since=None):
+        # The chunks are frames as the journal stores them, which go out
+        # uncompressed on any connection.
+        if since is not None:
+            # A resumed member still shows the board, strokes it drew
+            # offline and is about to send again included, so it only
+            # misses what the others drew since ``since``.
+            for chunk in self.journal.replay(member.codec, member.version, since, member.client_id):
+                member.send(chunk)
+            return
+        # Clears whatever a client that could not resume still shows before
+        # the session is drawn again.
+        cleared = False
+        for chunk in self.journal.replay(member.codec, member.version):
+            if not cleared:
+                member.send_body(member.codec.encode({"type": "erase_all"}))
+                cleared = True
+            member.send(chunk)
+
+    def request_save(self, client_id, body):
+        """Forward a save under an ID that is unique within the room."""
+        event = decode_event(body)
+        # Under the lock, so displays that answer saves in order answer
+        # them in the order they are pending.
+        with self.lock:
+            save_id = next(self.save_ids)
+            self.pending_saves[save_id] = (client_id, event.get("request_id"), time.perf_counter())
+            event["request_id"] = save_id
+            # JSON, which displays of every version can decode.
+            self.send(JSON_CODEC.encode(event))
+
+    def finish_save(self, response, filepath):
+        """Tell the member that asked for a save where it was written.
+
+        Returns the seconds since the save was asked for, or None for a
+        save the room did not ask for.
+        """
+        save_id = response.get("request_id")
+        with self.lock:
+            if save_id not in self.pending_saves:
+                # Displays that predate request IDs answer saves in order.
+                if not self.pending_saves:
+                    return None
+                save_id = next(iter(self.pending_saves))
+            client_id, request_id, asked = self.pending_saves.pop(save_id)
+        seconds = time.perf_counter() - asked
+
+        member = self.members.get(client_id)
+        if member is not None and member.version >= SAVE_ID_VERSION:
+            event = {"type": "save_done", "request_id": request_id, "path": filepath}
+            member.send_body(member.codec.encode(event))
+        return seconds
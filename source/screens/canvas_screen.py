@@ -1,3 +1,4 @@
+import itertools
 import os
 from kivy.uix.screenmanager import Screen
 from kivy.uix.boxlayout import BoxLayout
@@ -18,6 +19,7 @@ class CanvasScreen(Screen):
     def __init__(self, send_to_server_callback=None, **kwargs):
         super().__init__(**kwargs)
         self.send_to_server_callback = send_to_server_callback
+        self.save_ids = itertools.count(1)
         self.draw_input = DrawInput(send_to_server_callback=send_to_server_callback)
         
         main_layout = BoxLayout(
@@ -111,7 +113,8 @@ class CanvasScreen(Screen):
         if self.send_to_server_callback:
             self.send_to_server_callback({
                 "type": "save",
-                "filename": self.current_name
+                "filename": self.current_name,
+                "request_id": next(self.save_ids)
             })
 
     def exit_app(self, instance):
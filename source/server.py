@@ -1,68 +1,79 @@
+import argparse
+import hashlib
+import itertools
+import re
 import socket
-import json
 import threading
-import struct
-import subprocess
-import sys
-import time
 import os
+import time
+import uuid
+
+from display_pool import (
+    DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_SIZE, DEFAULT_MIN_SIZE, DEFAULT_TRANSPORT,
+    DISPLAY_SCRIPT, RESET_TIMEOUT, TRANSPORT_TCP, TRANSPORT_UNIX, DisplayPool,
+)
+from display_queue import DisplayWriter
+from metrics import DEFAULT_METRICS_INTERVAL, Metrics, write_metrics_file
+from rooms import Member, Room
+from sessions import SESSION_TIMEOUT, Session
+from utils.framing import FrameReader
+from utils.journal import Journal
+from utils.protocol import (
+    DEFAULT_COMPRESS_THRESHOLD, JSON_CODEC, LEGACY_VERSION, RESET_VERSION,
+    answer_hello, decode_event, event_type, send_frame,
+)
 
 PORT = 9999
 HOST = "0.0.0.0"
 
 class DrawingServer:
-    def __init__(self, host=HOST, port=PORT):
+    mode = "threaded"
+
+    def __init__(self, host=HOST, port=PORT, pool=None, compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 metrics_file=None, metrics_interval=DEFAULT_METRICS_INTERVAL):
         self.host = host
         self.port = port
+        # None turns compression off for client connections.
+        self.compress_threshold = compress_threshold
+        self.metrics = Metrics()
+        # Rewritten with a snapshot of stats() every metrics_interval seconds.
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
         self.connections = {}
-        self.displays = {}
-        self.next_display_port = 5000
-        self.processes = {}
+        # Named rooms; a client that does not join one gets its own.
+        self.rooms = {}
+        self.rooms_lock = threading.Lock()
+        # Journals outlive their rooms so a room that empties and is joined
+        # again picks up where it was.
+        self.journals = {}
+        # Resumable sessions by token.
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.pool = pool or DisplayPool()
+        self.client_ids = itertools.count()
         self.save_dir = "server_pics"
         if not os.path.exists(self.save_dir):
             os.makedirs(self.save_dir)
+        self.journal_dir = "server_journals"
+        if not os.path.exists(self.journal_dir):
+            os.makedirs(self.journal_dir)
         
     def start(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.bind((self.host, self.port))
         server_socket.listen(5)
+        self.pool.start()
+        if self.metrics_file:
+            threading.Thread(target=self.write_metrics, daemon=True).start()
         print(f"[SERVER] Listening on {self.host}:{self.port}...")
 
         try:
             while True:
                 conn, addr = server_socket.accept()
-                client_id = len(self.connections)
+                client_id = next(self.client_ids)
                 print(f"[SERVER] Connected by {addr} (ID: {client_id})")
                 
-                display_port = self.next_display_port
-                self.next_display_port += 1
-                
-                process = subprocess.Popen(
-                    [sys.executable, 'display_manager.py', str(display_port)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-                self.processes[client_id] = process
-                
-                display_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                retries = 0
-                while retries < 10:
-                    try:
-                        display_sock.connect(('localhost', display_port))
-                        break
-                    except:
-                        retries += 1
-                        time.sleep(0.5)
-                
-                if retries == 10:
-                    print(f"[SERVER] Failed to connect to display for client {client_id}")
-                    process.kill()
-                    conn.close()
-                    continue
-                
                 self.connections[client_id] = conn
-                self.displays[client_id] = display_sock
-                
                 threading.Thread(target=self.handle_client, args=(client_id,), daemon=True).start()
                 
         except KeyboardInterrupt:
@@ -71,64 +82,440 @@ class DrawingServer:
             self.cleanup()
             server_socket.close()
         
-    def handle_client(self, client_id):
-        conn = self.connections[client_id]
-        display = self.displays[client_id]
+    def save_path(self, filename):
+        # Only the last path component, so a name cannot escape save_dir.
+        return os.path.join(self.save_dir, f"{os.path.basename(filename)}.png")
+
+    def save_drawing(self, response, display):
+        """Write a save response to disk as it comes off the display socket.
+
+        Current displays send the PNG as raw bytes after the header; older
+        ones put it in the response as a list of ints.
+        """
+        filepath = self.save_path(response['filename'])
+        # Unique per save so concurrent saves of one name never interleave.
+        partial = f"{filepath}.{uuid.uuid4().hex}.part"
+        with open(partial, 'wb') as f:
+            if "size" in response:
+                display.read_payload_into(response["size"], f)
+            else:
+                f.write(bytes(response["data"]))
+        os.replace(partial, filepath)
+        print(f"[SERVER] Saved drawing to {filepath}")
+        return filepath
+
+    def finish_save(self, room, response, filepath):
+        seconds = room.finish_save(response, filepath)
+        self.metrics.saved(seconds, response["size"] if "size" in response else len(response["data"]))
         
+    def journal_for(self, name):
+        """Return the journal of a named room, opening it the first time.
+        
+        Only named rooms have one.  A client's own board can only be found
+        again through its session, and sessions do not outlive the server,
+        so its history could never be replayed to anyone; while the server
+        runs, the board's display keeps it for a resumed session.
+        """
+        journal = self.journals.get(name)
+        if journal is None:
+            # Room names come from clients; keep them to safe characters and
+            # tell apart names that only differ in the characters dropped.
+            digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:12]
+            safe = re.sub(r'[^A-Za-z0-9_-]', '_', name)[:40]
+            path = os.path.join(self.journal_dir, f"{safe}-{digest}.journal")
+            journal = self.journals[name] = Journal(path)
+        return journal
+        
+    def join_room(self, name, member):
+        """Put a member in a room, opening the room and its display if needed.
+        
+        Returns the room, or None if no display became available.
+        """
+        while True:
+            with self.rooms_lock:
+                room = self.rooms.get(name) if name is not None else None
+                opening = room is None
+                if opening:
+                    room = Room(name, threading.Event(), threading.Event())
+                    if name is not None:
+                        room.journal = self.journal_for(name)
+                        self.rooms[name] = room
+                        
+            if opening:
+                self.open_room(room)
+            else:
+                room.ready.wait()
+                
+            with self.rooms_lock:
+                if room.worker is None:
+                    return None
+                if room.add(member):
+                    return room
+            # The room closed while we waited for it; open a new one.
+            
+    def open_room(self, room):
+        worker = self.pool.acquire()
+        if worker is not None:
+            room.worker = worker
+            room.display = DisplayWriter(worker.sock, worker.codec, worker.version, worker.compression,
+                                         stats=worker.stats)
+            threading.Thread(target=self.relay_display, args=(room,), daemon=True).start()
+            try:
+                room.replay_to_display()
+            except Exception as e:
+                print(f"[SERVER] Could not replay room {room.name!r}: {e}")
+        else:
+            with self.rooms_lock:
+                if self.rooms.get(room.name) is room:
+                    del self.rooms[room.name]
+        room.ready.set()
+        
+    def leave_room(self, room, client_id):
+        with self.rooms_lock:
+            if not room.remove(client_id):
+                return
+            if self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
+        clean = self.reset_display(room)
+        room.display.close()
+        self.report_display_queue(room)
+        self.pool.release(room.worker, clean)
+
+    def report_display_queue(self, room):
+        stats = room.display.queue_stats()
+        if stats["merged"] or stats["collapsed"] or stats["discarded"] or stats["stalls"]:
+            print(f"[SERVER] Display {room.worker.name} queue: up to {stats['max_depth']} waiting, "
+                  f"{stats['merged']} merged, {stats['collapsed'] + stats['discarded']} dropped, "
+                  f"{stats['stalls']} stalls")
+        
+    def relay_display(self, room):
+        """Handle what a room's display sends back.
+        
+        Runs next to the members' relay loops so drawing keeps flowing while
+        a save is written out.  Ends when the display confirms a reset,
+        which it only does after any saves that were still in progress.
+        """
+        worker = room.worker
         try:
             while True:
-                length_data = conn.recv(4)
-                if not length_data:
+                data = worker.reader.read_frame()
+                if data is None:
                     break
                     
-                message_length = struct.unpack('!I', length_data)[0]
-                data = conn.recv(message_length)
-                if not data:
+                response = decode_event(data)
+                if response["type"] == "save_response":
+                    filepath = self.save_drawing(response, worker.reader)
+                    self.finish_save(room, response, filepath)
+                elif response["type"] == "reset_done":
+                    room.reset_done.set()
                     break
-                
-                event = json.loads(data.decode())
-                if event["type"] == "save":
-                    display.sendall(length_data + data)
                     
-                    resp_length = struct.unpack('!I', display.recv(4))[0]
-                    resp_data = display.recv(resp_length)
-                    response = json.loads(resp_data.decode())
+        except Exception as e:
+            print(f"[SERVER] Error reading from display {worker.name}: {e}")
+            
+    def handle_client(self, client_id):
+        conn = self.connections[client_id]
+        stats = self.metrics.connect(client_id)
+        reader = FrameReader(conn, stats=stats)
+        client_codec = JSON_CODEC
+        client_version = LEGACY_VERSION
+        compression = None
+        session = None
+        member = None
+        
+        try:
+            # The hello is answered before the display is started so the
+            # client does not time out waiting for it while the display boots.
+            data = reader.read_frame()
+            if data is not None and event_type(data) == "hello":
+                client_codec, client_version, compression = answer_hello(
+                    conn, decode_event(data), self.compress_threshold
+                )
+                reader.compression = compression
+                data = reader.read_frame()
+                
+            if data is not None and event_type(data) == "stats":
+                # Only asking for stats: no session, room or display.
+                while data is not None and event_type(data) == "stats":
+                    send_frame(conn, client_codec.encode(self.stats()), compression)
+                    data = reader.read_frame()
+                return
+                
+            resumed = False
+            if data is not None and event_type(data) == "session":
+                session, resumed = self.attach_session(decode_event(data).get("token"), client_id)
+                send_frame(conn, client_codec.encode({
+                    "type": "session",
+                    "token": session.token,
+                    "last_seq": session.last_seq,
+                    "resumed": resumed
+                }), compression)
+            elif data is not None:
+                session = Session(client_id, resumable=False)
+                session.connection = client_id
+            else:
+                return
+                
+            stats.info["client"] = session.client_id
+            member = Member(session.client_id, conn, client_codec, client_version, compression, stats=stats)
+            if resumed:
+                if not session.room.add(member):
+                    # Closed since the session was attached; the client
+                    # reconnects and then gets a new session.
+                    print(f"[SERVER] Client {session.client_id} could not resume, its room has closed")
+                    return
+                print(f"[SERVER] Client {session.client_id} resumed after event {session.last_seq}")
+                data = reader.read_frame()
+            else:
+                if event_type(data) == "session":
+                    data = reader.read_frame()
+                room_name = None
+                if data is not None and event_type(data) == "join":
+                    room_name = decode_event(data)["room"]
+                elif data is None:
+                    return
                     
-                    if response["type"] == "save_response":
-                        filename = f"{response['filename']}.png"
-                        filepath = os.path.join(self.save_dir, filename)
-                        with open(filepath, 'wb') as f:
-                            f.write(bytes(response["data"]))
-                        print(f"[SERVER] Saved drawing to {filepath}")
-                        
-                elif event["type"] == "exit":
-                    display.sendall(length_data + data)
+                room = self.join_room(room_name, member)
+                if room is None:
+                    print(f"[SERVER] No display available for client {client_id}")
+                    return
+                session.room = room
+                if room_name is not None:
+                    print(f"[SERVER] Client {session.client_id} joined room {room_name!r}")
+                    data = reader.read_frame()
+            session.member = member
+            stats.info["room"] = session.room.name
+            
+            while data is not None:
+                received = time.perf_counter()
+                if not self.apply_event(session, client_id, data):
                     break
-                else:
-                    display.sendall(length_data + data)
+                stats.relay.observe(time.perf_counter() - received)
+                data = reader.read_frame()
                     
         except Exception as e:
             print(f"[SERVER] Error handling client {client_id}: {e}")
         finally:
-            self.cleanup_client(client_id)
+            self.cleanup_client(client_id, member, session)
+
+    def attach_session(self, token, connection):
+        """Find the session a client asks to resume, or start a new one.
+        
+        Returns the session and whether it was resumed.  Only sessions
+        whose room is still open are resumed, as the client then goes on
+        without asking to join it again.
+        """
+        with self.sessions_lock:
+            session = self.sessions.get(token) if token else None
+            resumed = (session is not None and not session.ended
+                       and session.room is not None and not session.room.closed)
+            if not resumed:
+                session = Session(connection)
+                self.sessions[session.token] = session
+                
+        with session.lock:
+            previous = session.member if session.connection is not None else None
+            session.connection = connection
+        if previous is not None:
+            # The old connection has not noticed it is gone yet.
+            previous.disconnect()
+        return session, resumed
+
+    def apply_event(self, session, connection, data):
+        """Apply the next event of a session; returns False once it is done."""
+        kind = event_type(data)
+        with session.lock:
+            # A newer connection may have taken the session over.
+            if not session.owned_by(connection):
+                return False
+            session.last_seq += 1
+            if kind == "exit":
+                session.ended = True
+                return False
+            if kind == "save":
+                session.room.request_save(session.client_id, data)
+            elif kind == "stats":
+                session.member.send_body(session.member.codec.encode(self.stats()))
+            else:
+                session.room.relay(session.client_id, data)
+        return True
+
+    def detach_session(self, session, connection):
+        """Keep a dropped client's place for SESSION_TIMEOUT seconds.
+        
+        Returns True if the client has left for good instead.
+        """
+        with session.lock:
+            if session.connection != connection:
+                # Taken over by a newer connection.
+                return False
+            session.connection = None
+            if session.ended or session.token is None:
+                return True
+            session.detached += 1
+            session.room.detach(session.client_id)
+            self.schedule_expiry(session, session.detached)
+        return False
 
-    def cleanup_client(self, client_id):
+    def schedule_expiry(self, session, detached):
+        timer = threading.Timer(SESSION_TIMEOUT, self.expire_session, args=(session, detached))
+        timer.daemon = True
+        timer.start()
+
+    def session_expired(self, session, detached):
+        """Ends a session nobody resumed since its ``detached``-th disconnect."""
+        with session.lock:
+            if session.connection is not None or session.detached != detached:
+                return False
+            session.ended = True
+        print(f"[SERVER] Session of client {session.client_id} expired")
+        self.forget_session(session)
+        return True
+
+    def expire_session(self, session, detached):
+        if self.session_expired(session, detached):
+            self.leave_room(session.room, session.client_id)
+
+    def forget_session(self, session):
+        with self.sessions_lock:
+            self.sessions.pop(session.token, None)
+
+    def end_session(self, session):
+        self.forget_session(session)
+        self.leave_room(session.room, session.client_id)
+
+    def reset_display(self, room):
+        """Ask the room's display to clear itself and wait until it confirms."""
+        worker = room.worker
+        try:
+            if worker.version < RESET_VERSION:
+                # Displays this old cannot be reused, so let them exit.
+                room.send(worker.codec.encode({"type": "exit"}))
+                return False
+            room.send(worker.codec.encode({"type": "reset"}))
+        except OSError:
+            return False
+        return room.reset_done.wait(RESET_TIMEOUT)
+
+    def cleanup_client(self, client_id, member=None, session=None):
+        if session is not None:
+            if session.room is None:
+                self.forget_session(session)
+            elif self.detach_session(session, client_id):
+                self.end_session(session)
+        if member is not None:
+            member.close()
+            if member.compression is not None:
+                print(f"[SERVER] Compression saved {member.compression.saved_bytes} of "
+                      f"{member.compression.raw_bytes} bytes for client {client_id}")
+        
         if client_id in self.connections:
             self.connections[client_id].close()
             del self.connections[client_id]
-        
-        if client_id in self.displays:
-            self.displays[client_id].close()
-            del self.displays[client_id]
-            
-        if client_id in self.processes:
-            self.processes[client_id].kill()
-            del self.processes[client_id]
+        self.metrics.disconnect(client_id)
+
+    def stats(self):
+        """A snapshot of the server's counters, as answered to ``stats``."""
+        snapshot = self.metrics.snapshot()
+        displays = self.pool.stats()
+        # How each busy display's queue is coping: the events it merged or
+        # dropped and how often it held its room up.
+        with self.rooms_lock:
+            rooms = list(self.rooms.values())
+        queues = {
+            room.worker.name: dict(room.display.queue_stats(), room=room.name)
+            for room in rooms if room.worker is not None and room.display is not None
+        }
+        for worker in displays["workers"]:
+            if worker["name"] in queues:
+                worker["queue"] = queues[worker["name"]]
+        snapshot.update({
+            "type": "stats",
+            "mode": self.mode,
+            "threads": threading.active_count(),
+            # This one and its displays.
+            "processes": 1 + displays["idle"] + displays["busy"] + displays["starting"],
+            "sessions": len(self.sessions),
+            "rooms": len(self.rooms),
+            "displays": displays,
+        })
+        return snapshot
+
+    def write_metrics(self):
+        while True:
+            time.sleep(self.metrics_interval)
+            try:
+                write_metrics_file(self.metrics_file, self.stats())
+            except Exception as e:
+                print(f"[SERVER] Could not write metrics to {self.metrics_file}: {e}")
 
     def cleanup(self):
         for client_id in list(self.connections.keys()):
             self.cleanup_client(client_id)
+        self.pool.close()
+        self.close_journals()
+
+    def close_journals(self):
+        for journal in self.journals.values():
+            journal.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drawing relay server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument(
+        '--mode', choices=('threaded', 'asyncio'), default='threaded',
+        help="one OS thread per client, or a single asyncio event loop"
+    )
+    parser.add_argument(
+        '--min-displays', type=int, default=DEFAULT_MIN_SIZE,
+        help="display processes kept booted and waiting for a client"
+    )
+    parser.add_argument(
+        '--max-displays', type=int, default=DEFAULT_MAX_SIZE,
+        help="upper bound on display processes, busy or idle"
+    )
+    parser.add_argument(
+        '--display-idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+        help="seconds before a spare display beyond --min-displays is stopped"
+    )
+    parser.add_argument(
+        '--display-transport', choices=(TRANSPORT_UNIX, TRANSPORT_TCP), default=DEFAULT_TRANSPORT,
+        help="hand each display one end of a socket pair, or connect to it over loopback TCP"
+    )
+    parser.add_argument(
+        '--display-script', default=DISPLAY_SCRIPT,
+        help="program each display runs; stub_display.py only counts frames, for load tests"
+    )
+    parser.add_argument(
+        '--compress-threshold', type=int, default=DEFAULT_COMPRESS_THRESHOLD,
+        help="smallest frame, in bytes, worth compressing"
+    )
+    parser.add_argument(
+        '--no-compression', action='store_true',
+        help="never compress client or display connections"
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help="JSON file to keep a snapshot of the server's stats in"
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=DEFAULT_METRICS_INTERVAL,
+        help="seconds between two snapshots written to --metrics-file"
+    )
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    server = DrawingServer()
+    args = parse_args()
+    threshold = None if args.no_compression else args.compress_threshold
+    pool = DisplayPool(args.min_displays, args.max_displays, args.display_idle_timeout,
+                       script=args.display_script, compress_threshold=threshold,
+                       transport=args.display_transport)
+    if args.mode == 'asyncio':
+        from async_server import AsyncDrawingServer
+        server = AsyncDrawingServer(args.host, args.port, pool, threshold,
+                                    args.metrics_file, args.metrics_interval)
+    else:
+        server = DrawingServer(args.host, args.port, pool, threshold,
+                               args.metrics_file, args.metrics_interval)
     server.start()
\ No newline at end of file
@@ -0,0 +1,31 @@
+import secrets
+import threading
+
+# How long a disconnected client keeps its place in a room.
+SESSION_TIMEOUT = 60.0
+
+
+class Session:
+    """What the server keeps of a client between its connections.
+
+    ``client_id`` is what the room knows the client by, so strokes it was
+    drawing carry on after a reconnect.  ``connection`` is the connection
+    currently driving the session, or None while the client is away, and
+    ``last_seq`` counts the events applied so far.  Sessions without a
+    token belong to clients that cannot resume.
+    """
+
+    def __init__(self, client_id, resumable=True):
+        self.token = secrets.token_urlsafe(16) if resumable else None
+        self.client_id = client_id
+        self.connection = None
+        self.last_seq = 0
+        self.room = None
+        self.member = None
+        self.ended = False
+        # Bumped on every disconnect so a stale expiry timer can tell.
+        self.detached = 0
+        self.lock = threading.Lock()
+
+    def owned_by(self, connection):
+        return self.connection == connection and not self.ended
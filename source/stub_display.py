@@ -0,0 +1,124 @@
+"""A display that draws nothing, for load tests.
+
+Started the same way as display_manager.py and speaking the same protocol,
+it only counts what it is sent and answers what the server waits for:
+saves get a blank PNG, resets a ``reset_done``.  That takes Kivy, and the
+cost of drawing, out of a load test of the server.
+
+    python server.py --display-script stub_display.py
+"""
+import socket
+import sys
+import time
+from collections import Counter
+
+from utils.framing import FrameReader
+from utils.png import encode_png
+from utils.protocol import (
+    BINARY_CODEC, DEFAULT_COMPRESS_THRESHOLD, JSON_CODEC, LEGACY_VERSION,
+    SAVE_STREAM_VERSION, answer_hello, decode_event, event_type, send_frame,
+    send_payload,
+)
+
+# What a save sends back: a blank canvas the size of a display's window.
+SAVE_SIZE = (1280, 720)
+
+
+class StubDisplay:
+    def __init__(self, port=None, fd=None):
+        self.port = port
+        self.fd = fd
+        self.connection = None
+        self.codec = JSON_CODEC
+        self.server_version = LEGACY_VERSION
+        self.compression = None
+        width, height = SAVE_SIZE
+        self.image = encode_png(width, height, bytes(width * height * 4))
+        self.frames = 0
+        self.bytes = 0
+        self.types = Counter()
+        self.started = time.monotonic()
+
+    def run(self):
+        try:
+            if self.fd is not None:
+                self.connection = socket.socket(fileno=self.fd)
+                self.serve_connection()
+                return
+
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.bind(('localhost', self.port))
+            server_socket.listen(1)
+            print(f"Stub display listening on port {self.port}")
+            while True:
+                self.connection, addr = server_socket.accept()
+                self.serve_connection()
+                self.connection.close()
+        except SystemExit:
+            pass
+        finally:
+            self.report()
+
+    def serve_connection(self):
+        self.codec = JSON_CODEC
+        self.server_version = LEGACY_VERSION
+        self.compression = None
+        reader = FrameReader(self.connection)
+
+        while True:
+            data = reader.read_frame()
+            if data is None:
+                return
+            kind = event_type(data)
+            self.frames += 1
+            self.bytes += len(data)
+            self.types[kind] += 1
+            if kind == "hello":
+                self.codec, self.server_version, self.compression = answer_hello(
+                    self.connection, decode_event(data), DEFAULT_COMPRESS_THRESHOLD
+                )
+                reader.compression = self.compression
+            elif kind == "save":
+                self.send_save_response(decode_event(data))
+            elif kind == "reset":
+                self.report()
+                self.send_event({"type": "reset_done"})
+            elif kind == "exit":
+                sys.exit()
+
+    def send_save_response(self, event):
+        if self.server_version < SAVE_STREAM_VERSION:
+            response = {"type": "save_response", "data": list(self.image), "filename": event["filename"]}
+            send_frame(self.connection, JSON_CODEC.encode(response))
+            return
+        response = {"type": "save_response", "size": len(self.image), "filename": event["filename"]}
+        if "request_id" in event:
+            response["request_id"] = event["request_id"]
+        send_frame(self.connection, BINARY_CODEC.encode(response), self.compression)
+        send_payload(self.connection, self.image)
+
+    def send_event(self, event):
+        send_frame(self.connection, self.codec.encode(event), self.compression)
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        counts = ", ".join(f"{kind} {count}" for kind, count in self.types.most_common())
+        print(f"Stub display: {self.frames} frames, {self.bytes} bytes in {elapsed:.1f}s"
+              + (f" ({counts})" if counts else ""))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--fd':
+        args = {'fd': sys.argv[2]}
+    elif len(sys.argv) == 2:
+        args = {'port': sys.argv[1]}
+    else:
+        print("Usage: python stub_display.py <port> | --fd <descriptor>")
+        sys.exit(1)
+
+    try:
+        args = {name: int(value) for name, value in args.items()}
+    except ValueError:
+        print("Port and descriptor must be numbers")
+        sys.exit(1)
+    StubDisplay(**args).run()
@@ -0,0 +1,66 @@
+import io
+import random
+
+from utils.framing import FrameReader
+from utils.protocol import StreamCompression, pack_frame
+
+
+class TrickleSocket:
+    """Hands out what was written to it a few bytes per ``recv_into``."""
+
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+
+    def recv_into(self, view):
+        count = min(next(self.sizes), len(view), len(self.data))
+        view[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+
+def bodies(rng, count=200):
+    # Long runs of a few letters, so bodies over the threshold compress.
+    return [bytes(rng.choice(b'ab{') for _ in range(rng.choice((1, 5, 30, 100, 3000))))
+            for _ in range(count)]
+
+
+def read_all(reader):
+    frames = []
+    while True:
+        frame = reader.read_frame()
+        if frame is None:
+            return frames
+        frames.append(bytes(frame))
+
+
+def test_split_frames_with_a_tiny_buffer():
+    rng = random.Random(1)
+    sent = bodies(rng)
+    sizes = iter(lambda: rng.randint(1, 7), None)
+    reader = FrameReader(TrickleSocket(b''.join(map(pack_frame, sent)), sizes), buffer_size=8)
+    assert read_all(reader) == sent
+
+
+def test_compressed_frames_with_a_tiny_buffer():
+    rng = random.Random(2)
+    sent = bodies(rng)
+    sender = StreamCompression(threshold=24)
+    data = b''.join(sender.pack(body) for body in sent)
+    assert sender.sent_wire < sender.sent_raw
+    sizes = iter(lambda: rng.randint(1, 7), None)
+    receiver = StreamCompression(threshold=24)
+    reader = FrameReader(TrickleSocket(data, sizes), receiver, buffer_size=8)
+    assert read_all(reader) == sent
+    assert (receiver.received_raw, receiver.received_wire) == (sender.sent_raw, sender.sent_wire)
+
+
+def test_payload_after_a_frame():
+    payload = bytes(range(256)) * 40
+    data = pack_frame(b'{"type": "save_response"}') + payload + pack_frame(b'{}')
+    reader = FrameReader(TrickleSocket(data, iter(lambda: 100, None)), buffer_size=16)
+    assert bytes(reader.read_frame()) == b'{"type": "save_response"}'
+    file = io.BytesIO()
+    reader.read_payload_into(len(payload), file)
+    assert file.getvalue() == payload
+    assert bytes(reader.read_frame()) == b'{}'
@@ -0,0 +1,58 @@
+import pytest
+
+from utils.protocol import (
+    BINARY_CODEC, CODECS, DELTA_CODEC, JSON_CODEC, decode_event, event_type,
+    sender_of, stroke_of, tag_sender,
+)
+
+# Values every codec carries exactly: float32 coordinates on the delta
+# codec's 1/8 pixel grid and colours whose channels are whole bytes.
+EVENTS = [
+    {"type": "down", "x": 10.5, "y": 20.25, "color": [1.0, 0.0, 0.0, 1.0], "width": 2.0},
+    {"type": "down", "id": 2 ** 40 + 7, "x": 10.5, "y": 20.25, "color": [0.0, 1.0, 1.0, 1.0], "width": 4.0},
+    {"type": "move", "x": 11.125, "y": -3.5},
+    {"type": "move", "id": 9, "x": 11.125, "y": -3.5},
+    {"type": "points", "points": [1.0, 2.0, 3.5, 4.25, -7.875, 1000.0]},
+    {"type": "points", "id": 9, "points": [1.0, 2.0, 3.5, 4.25]},
+    {"type": "up"},
+    {"type": "up", "id": 9},
+    {"type": "erase", "x": 50.0, "y": 60.0, "radius": 30.0},
+    {"type": "remove_strokes", "ids": [1, 2 ** 63 + 5], "x": 5.0, "y": 6.0, "radius": 30.0},
+    {"type": "remove_strokes", "ids": [3], "x": 5.0, "y": 6.0, "radius": 30.0,
+     "path": [1.0, 2.0, 3.5, 4.0, 5.0, 6.0]},
+    {"type": "erase_all"},
+    {"type": "set_title", "title": "Room é"},
+    {"type": "save", "filename": "drawing.png"},
+    {"type": "save", "filename": "drawing.png", "request_id": 4},
+    {"type": "save_response", "size": 12345, "filename": "drawing.png"},
+    {"type": "save_done", "request_id": 4, "path": "server_pics/drawing.png"},
+    {"type": "exit"},
+    {"type": "join", "room": "lobby"},
+    {"type": "session", "token": None},
+    {"type": "stats"},
+]
+
+
+@pytest.mark.parametrize("codec", list(CODECS.values()), ids=list(CODECS))
+@pytest.mark.parametrize("event", EVENTS, ids=lambda event: event["type"])
+def test_round_trip(codec, event):
+    body = codec.encode(event)
+    assert decode_event(body) == event
+    assert event_type(body) == event["type"]
+
+
+@pytest.mark.parametrize("codec", list(CODECS.values()), ids=list(CODECS))
+@pytest.mark.parametrize("event", EVENTS, ids=lambda event: event["type"])
+def test_tagged_round_trip(codec, event):
+    body = tag_sender(codec.encode(event), 77)
+    assert decode_event(body) == dict(event, client=77)
+    assert event_type(body) == event["type"]
+    assert sender_of(body) == 77
+    if event["type"] in ("points", "move", "up"):
+        assert stroke_of(body) == event.get("id")
+
+
+def test_binary_records_are_smaller():
+    event = {"type": "points", "points": [100.0 + i * 0.5 for i in range(64)]}
+    sizes = [len(codec.encode(event)) for codec in (JSON_CODEC, BINARY_CODEC, DELTA_CODEC)]
+    assert sizes == sorted(sizes, reverse=True)
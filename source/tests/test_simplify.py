@@ -0,0 +1,64 @@
+import math
+import random
+
+import pytest
+
+from utils.simplify import StrokeSimplifier
+from utils.spatial import segment_hits_circle
+
+
+def walk(rng, count):
+    x = y = 500.0
+    heading = 0.0
+    points = [(x, y)]
+    for _ in range(count):
+        heading += rng.uniform(-0.4, 0.4)
+        step = rng.uniform(0.5, 6.0)
+        x += step * math.cos(heading)
+        y += step * math.sin(heading)
+        points.append((x, y))
+    return points
+
+
+def simplify(points, tolerance):
+    simplifier = StrokeSimplifier(*points[0], tolerance)
+    kept = [points[0]]
+    for x, y in points[1:]:
+        flat = simplifier.add(x, y)
+        kept.extend(zip(flat[0::2], flat[1::2]))
+    flat = simplifier.finish()
+    kept.extend(zip(flat[0::2], flat[1::2]))
+    return kept
+
+
+@pytest.mark.parametrize("tolerance", [0.25, 0.75, 3.0])
+@pytest.mark.parametrize("seed", range(20))
+def test_deviation_within_tolerance(seed, tolerance):
+    points = walk(random.Random(seed), 400)
+    kept = simplify(points, tolerance)
+    assert len(kept) < len(points)
+
+    # Kept points are drawn points, in order; the ones dropped between two
+    # of them lie within tolerance of the segment joining those two.
+    indices = [i for i, point in enumerate(points) if point in kept]
+    assert [points[i] for i in indices] == kept
+    assert indices[0] == 0 and indices[-1] == len(points) - 1
+    for first, last in zip(indices, indices[1:]):
+        (ax, ay), (bx, by) = points[first], points[last]
+        for x, y in points[first + 1:last]:
+            assert segment_hits_circle(ax, ay, bx, by, x, y, tolerance)
+
+
+def test_straight_line_keeps_only_its_ends():
+    points = [(float(i), 2.0 * i) for i in range(50)]
+    assert simplify(points, 0.75) == [points[0], points[-1]]
+
+
+def test_pending_points_are_bounded():
+    simplifier = StrokeSimplifier(0.0, 0.0, max_pending=8)
+    kept = []
+    for i in range(1, 30):
+        kept.extend(simplifier.add(float(i), 0.0))
+        assert len(simplifier.pending) <= 8
+    # A straight line is only cut where the pending points ran out.
+    assert kept == [8.0, 0.0, 16.0, 0.0, 24.0, 0.0]
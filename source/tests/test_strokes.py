@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+from utils import strokes
+from utils.spatial import segment_hits_circle, segments_within
+from utils.strokes import StrokeStore
+
+
+def random_walk(rng, count, size=1000.0):
+    x, y = rng.uniform(0, size), rng.uniform(0, size)
+    points = [x, y]
+    for _ in range(count):
+        x += rng.uniform(-15, 15)
+        y += rng.uniform(-15, 15)
+        points += [x, y]
+    return points
+
+
+def filled_store(rng, count=150):
+    store = StrokeStore()
+    for key in range(count):
+        points = random_walk(rng, rng.choice((1, 3, 20, 120)))
+        store.add(key, points[0], points[1])
+        store.extend(key, points[2:])
+    return store
+
+
+def brute_force_path(store, path, radius):
+    """Every stroke segment against every path segment, without the grid."""
+    hits = set()
+    for key, stroke in store.strokes.items():
+        coords = stroke.coords
+        for i in range(0, len(coords) - 2, 2):
+            for j in range(0, len(path) - 2, 2):
+                if segments_within(*coords[i:i + 4], *path[j:j + 4], radius):
+                    hits.add(key)
+    return hits
+
+
+def brute_force_circle(store, x, y, radius):
+    return {key for key, stroke in store.strokes.items()
+            if any(segment_hits_circle(*stroke.coords[i:i + 4], x, y, radius)
+                   for i in range(0, len(stroke.coords) - 2, 2))}
+
+
+def cases(seed, count, strokes=150):
+    rng = random.Random(seed)
+    store = filled_store(rng, strokes)
+    for _ in range(count):
+        path = random_walk(rng, rng.randint(1, 12), 1000.0)
+        yield store, path, rng.choice((2.0, 10.0, 30.0, 80.0))
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_query_path_matches_brute_force(seed, monkeypatch):
+    monkeypatch.setattr(strokes, "numpy", None)
+    for store, path, radius in cases(seed, 25, 40):
+        assert set(store.query_path(path, radius)) == brute_force_path(store, path, radius)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_query_matches_brute_force(seed, monkeypatch):
+    monkeypatch.setattr(strokes, "numpy", None)
+    for store, path, radius in cases(seed, 25, 40):
+        assert set(store.query(path[0], path[1], radius)) == brute_force_circle(store, path[0], path[1], radius)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_query_path_vectorised_matches_loop(seed, monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    for store, path, radius in cases(seed, 200):
+        vectorised = set(store.query_path(path, radius))
+        monkeypatch.setattr(strokes, "numpy", None)
+        assert vectorised == set(store.query_path(path, radius))
+        monkeypatch.setattr(strokes, "numpy", numpy)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_query_vectorised_matches_loop(seed, monkeypatch):
+    numpy = pytest.importorskip("numpy")
+    for store, path, radius in cases(seed, 200):
+        vectorised = set(store.query(path[0], path[1], radius))
+        monkeypatch.setattr(strokes, "numpy", None)
+        assert vectorised == set(store.query(path[0], path[1], radius))
+        monkeypatch.setattr(strokes, "numpy", numpy)
+
+
+def test_removed_strokes_are_not_hit():
+    store = StrokeStore()
+    store.add(1, 0.0, 0.0)
+    store.extend(1, [100.0, 0.0])
+    store.add(2, 0.0, 10.0)
+    store.extend(2, [100.0, 10.0])
+    assert sorted(store.query_path([50.0, -20.0, 50.0, 20.0], 1.0)) == [1, 2]
+    store.remove(1)
+    assert store.query_path([50.0, -20.0, 50.0, 20.0], 1.0) == [2]
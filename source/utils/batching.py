@@ -0,0 +1,59 @@
+"""Outbound coalescing of stroke points on the client."""
+import time
+
+MAX_BATCH_POINTS = 64
+MAX_BATCH_DELAY = 0.005
+
+
+class PointBatcher:
+    """Collects consecutive ``move`` events into ``points`` frames.
+
+    Moves of each stroke are batched apart, so strokes drawn at the same
+    time with several fingers do not break up each other's batches.  A
+    stroke's batch is flushed once it holds ``max_points`` points; every
+    batch is flushed once its oldest point is ``max_delay`` seconds old, or
+    as soon as any other event is sent so that ``down``/``up``/``erase``
+    keep their order relative to the points.  ``schedule(delay, callback)``
+    is used to flush batches that stop growing before either limit is
+    reached.
+    """
+
+    def __init__(self, send, max_points=MAX_BATCH_POINTS,
+                 max_delay=MAX_BATCH_DELAY, schedule=None):
+        self.send = send
+        self.max_points = max_points
+        self.max_delay = max_delay
+        self.schedule = schedule
+        # stroke ID -> flat points; moves that name no stroke are under None
+        self.batches = {}
+        self.started = 0
+
+    def add(self, event):
+        if event["type"] != "move":
+            self.flush()
+            self.send(event)
+            return
+
+        if not self.batches:
+            self.started = time.monotonic()
+            if self.schedule:
+                self.schedule(self.max_delay, self.flush)
+        stroke_id = event.get("id")
+        points = self.batches.setdefault(stroke_id, [])
+        points += (event["x"], event["y"])
+
+        if len(points) >= self.max_points * 2:
+            self._send(stroke_id, self.batches.pop(stroke_id))
+        elif time.monotonic() - self.started >= self.max_delay:
+            self.flush()
+
+    def flush(self, *args):
+        batches, self.batches = self.batches, {}
+        for stroke_id, points in batches.items():
+            self._send(stroke_id, points)
+
+    def _send(self, stroke_id, points):
+        event = {"type": "points", "points": points}
+        if stroke_id is not None:
+            event["id"] = stroke_id
+        self.send(event)
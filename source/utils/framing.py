@@ -0,0 +1,114 @@
+"""Length-prefixed framing over blocking sockets.
+
+``FrameReader`` reads through one preallocated buffer with ``recv_into``
+and hands out as many frames as each call brought in, as ``memoryview``
+slices of that buffer.  ``send_buffers`` gathers a length prefix and its
+body, or several whole frames, into one ``sendmsg`` call.
+"""
+import struct
+
+LENGTH = struct.Struct('!I')
+# Set in the length of a frame whose body is compressed.
+COMPRESSED_FLAG = 0x80000000
+READ_BUFFER_SIZE = 64 * 1024
+# Buffers passed to one ``sendmsg``, well under any platform's IOV_MAX.
+MAX_GATHER = 512
+
+
+def frame_body(size, body, compression):
+    """Finish reading a body whose length field was ``size``."""
+    if compression is not None:
+        return compression.unpack(body, size & COMPRESSED_FLAG)
+    if size & COMPRESSED_FLAG:
+        raise ConnectionError("Compressed frame on a connection without compression")
+    return body
+
+
+def send_buffers(sock, buffers):
+    """Send buffers back to back, in as few system calls as possible."""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + MAX_GATHER])
+        # Skip what went out; a partial send leaves the rest of one view.
+        while first < len(views) and sent >= views[first].nbytes:
+            sent -= views[first].nbytes
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+
+
+class FrameReader:
+    """Reads frames from a socket through a buffer of its own.
+
+    A frame returned by :meth:`read_frame` is a view into that buffer and
+    is only valid until the next read.  Frames larger than the buffer grow
+    it.  ``compression`` can be set once the connection has agreed on it.
+    ``stats``, if given, counts frames and bytes as they were on the wire.
+    """
+
+    def __init__(self, sock, compression=None, buffer_size=READ_BUFFER_SIZE, stats=None):
+        self.sock = sock
+        self.compression = compression
+        self.stats = stats
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Bytes from ``start`` to ``end`` have been received but not used.
+        self.start = 0
+        self.end = 0
+
+    def read_frame(self):
+        """Return the next frame body, or None if the peer closed."""
+        if not self._fill(LENGTH.size):
+            return None
+        size = LENGTH.unpack_from(self.buffer, self.start)[0]
+        length = size & ~COMPRESSED_FLAG
+        if not self._fill(LENGTH.size + length):
+            return None
+        start = self.start + LENGTH.size
+        self.start = start + length
+        if self.stats is not None:
+            self.stats.received(LENGTH.size + length)
+        return frame_body(size, self.view[start:self.start], self.compression)
+
+    def read_payload_into(self, size, file):
+        """Copy ``size`` raw bytes that follow a frame into ``file``."""
+        remaining = size
+        while remaining:
+            if self.start == self.end:
+                self.start = self.end = 0
+                count = self.sock.recv_into(self.view)
+                if not count:
+                    raise ConnectionError("Connection closed during payload")
+                self.end = count
+            take = min(remaining, self.end - self.start)
+            file.write(self.view[self.start:self.start + take])
+            self.start += take
+            remaining -= take
+        if self.stats is not None:
+            self.stats.received(size, frames=0)
+
+    def _fill(self, count):
+        """Buffer ``count`` bytes from ``start``; False if the peer closed first."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        while self.end - self.start < count:
+            if self.start + count > len(self.buffer):
+                self._make_room(count)
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end += received
+        return True
+
+    def _make_room(self, count):
+        pending = bytes(self.view[self.start:self.end])
+        if count > len(self.buffer):
+            self.buffer = bytearray(max(count, len(self.buffer) * 2))
+            self.view = memoryview(self.buffer)
+        self.view[:len(pending)] = pending
+        self.start = 0
+        self.end = len(pending)
@@ -0,0 +1,259 @@
+"""Append-only journal of a room's events, with snapshots for fast replay.
+
+The journal is a file of frames in the wire format: a length prefix and a
+binary record tagged with the client that sent it.  Every
+``snapshot_every`` records a background thread rebuilds the board from the
+previous snapshot and the journal after it, and writes the result as a new
+snapshot: a header holding the journal offset it covers, followed by the
+records that redraw the board from scratch.  Replaying a session is then
+the snapshot plus the journal from that offset on, both read through
+``mmap``, so it costs what was drawn since the last snapshot rather than
+the whole session.
+"""
+import contextlib
+import mmap
+import os
+import struct
+import threading
+import uuid
+
+from utils.protocol import (
+    DELTA_CODEC, JSON_MARKER, LENGTH, PROTOCOL_VERSION, STROKE_STREAM_VERSION,
+    decode_event, pack_frame, sender_of, strip_stroke_ids, tag_sender,
+    transcode,
+)
+from utils.strokes import ActiveStrokes, StrokeStore, stroke_ids
+
+SNAPSHOT_EVERY = 10000
+SNAPSHOT_SUFFIX = '.snapshot'
+SNAPSHOT_MAGIC = b'DSNP'
+# Magic, then the journal offset the snapshot brings a board up to.
+SNAPSHOT_HEADER = struct.Struct('!4sQ')
+# Size of the pieces a replay is handed out in.
+REPLAY_CHUNK = 1024 * 1024
+# ``points`` records count their points in 16 bits.
+MAX_RECORD_POINTS = 8192
+
+
+def _tag(event, client_id):
+    body = DELTA_CODEC.encode(event)
+    return body if client_id is None else tag_sender(body, client_id)
+
+
+def to_record(body):
+    """Re-encode a tagged event as a binary record where there is one."""
+    if body[0] != JSON_MARKER:
+        return body
+    event = decode_event(body)
+    return _tag(event, event.pop("client", None))
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    """Map a whole file read-only; yields None if it is missing or empty."""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        yield None
+        return
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield None
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield data
+
+
+def _frames(data, start, end):
+    offset = start
+    while offset < end:
+        size = LENGTH.unpack_from(data, offset)[0]
+        offset += LENGTH.size
+        yield data[offset:offset + size]
+        offset += size
+
+
+class CanvasState:
+    """What is on a board, rebuilt from events without drawing anything.
+
+    Uses the same stroke store and hit-test as the displays, so an erase
+    removes the same strokes here as it does on screen.
+    """
+
+    def __init__(self):
+        self.strokes = StrokeStore()
+        # stroke ID -> (client ID, color, width)
+        self.styles = {}
+        self.active = ActiveStrokes()
+        self.title = None
+        # Journals written before stroke IDs have strokes without one.
+        self.keys = stroke_ids()
+
+    def apply(self, event):
+        kind = event["type"]
+        client = event.get("client")
+        if kind == "down":
+            key = event["id"] if "id" in event else next(self.keys)
+            self.strokes.add(key, event["x"], event["y"])
+            self.styles[key] = (client, event.get("color", [1, 1, 1, 1]), event.get("width", 2))
+            self.active.start(key, client)
+        elif kind in ("points", "move", "up"):
+            key = self.active.find(event)
+            if key is None:
+                return
+            if kind == "up":
+                self.active.finish(key)
+            elif kind == "points":
+                self.strokes.extend(key, event["points"])
+            else:
+                self.strokes.extend(key, (event["x"], event["y"]))
+        elif kind == "erase":
+            self.remove(self.strokes.query(event["x"], event["y"], event["radius"]))
+        elif kind == "remove_strokes":
+            self.remove(event["ids"])
+        elif kind == "erase_all":
+            self.strokes.clear()
+            self.styles.clear()
+            self.active.clear()
+        elif kind == "set_title":
+            self.title = event["title"]
+
+    def remove(self, keys):
+        for key in keys:
+            if key in self.strokes:
+                self.strokes.remove(key)
+                del self.styles[key]
+
+    def records(self):
+        """Tagged records that redraw this state on an empty board."""
+        if self.title is not None:
+            yield DELTA_CODEC.encode({"type": "set_title", "title": self.title})
+        for key, stroke in self.strokes.strokes.items():
+            client, color, width = self.styles[key]
+            coords = stroke.coords
+            yield _tag({"type": "down", "id": key, "x": coords[0], "y": coords[1],
+                        "color": color, "width": width}, client)
+            for i in range(2, len(coords), MAX_RECORD_POINTS * 2):
+                points = coords[i:i + MAX_RECORD_POINTS * 2].tolist()
+                yield _tag({"type": "points", "id": key, "points": points}, client)
+            # Strokes still being drawn stay open for the moves that follow.
+            if key not in self.active:
+                yield _tag({"type": "up", "id": key}, client)
+
+
+class Journal:
+    """One room's journal file and its latest snapshot."""
+
+    def __init__(self, path, snapshot_every=SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_path = path + SNAPSHOT_SUFFIX
+        self.snapshot_every = snapshot_every
+        self.file = open(path, 'ab')
+        self.lock = threading.Lock()
+        self.since_snapshot = 0
+        self.snapshotting = False
+
+    def append(self, body):
+        """Add a tagged event to the end of the journal."""
+        frame = pack_frame(to_record(body))
+        with self.lock:
+            self.file.write(frame)
+            self.since_snapshot += 1
+            due = self.since_snapshot >= self.snapshot_every and not self.snapshotting
+            if due:
+                self.since_snapshot = 0
+                self.snapshotting = True
+        if due:
+            threading.Thread(target=self.snapshot, daemon=True).start()
+
+    def replay_frames(self, end=None):
+        """Yield the record bodies that bring an empty board up to date."""
+        for data, start, stop in self._segments(end):
+            yield from _frames(data, start, stop)
+
+    def position(self):
+        """Where the journal ends now, for a later :meth:`replay` to start at."""
+        return self._flushed_size()
+
+    def replay(self, codec=DELTA_CODEC, version=PROTOCOL_VERSION, since=None, exclude=None):
+        """Yield the same as :meth:`replay_frames` as chunks of whole frames.
+
+        Peers using the delta codec, which decodes every record, get the
+        files' bytes as they are; other peers get each record re-encoded.
+        Given a ``since`` from :meth:`position`, only the records appended
+        after it are replayed, and ``exclude`` leaves out those of one
+        client.
+        """
+        segments = self._segments() if since is None else self._tail(since)
+        with_ids = version >= STROKE_STREAM_VERSION
+        if codec is DELTA_CODEC and with_ids and exclude is None:
+            for data, start, stop in segments:
+                for offset in range(start, stop, REPLAY_CHUNK):
+                    yield data[offset:min(offset + REPLAY_CHUNK, stop)]
+            return
+
+        chunk = bytearray()
+        for data, start, stop in segments:
+            for body in _frames(data, start, stop):
+                if exclude is not None and sender_of(body) == exclude:
+                    continue
+                if not with_ids:
+                    body = strip_stroke_ids(body, version)
+                chunk += pack_frame(transcode(body, codec))
+                if len(chunk) >= REPLAY_CHUNK:
+                    yield bytes(chunk)
+                    chunk.clear()
+        if chunk:
+            yield bytes(chunk)
+
+    def snapshot(self):
+        """Write the board as it is now so replays can skip what came before."""
+        try:
+            state = CanvasState()
+            end = self._flushed_size()
+            for body in self.replay_frames(end):
+                state.apply(decode_event(body))
+
+            partial = f"{self.snapshot_path}.{uuid.uuid4().hex}.part"
+            with open(partial, 'wb') as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, end))
+                for body in state.records():
+                    f.write(pack_frame(body))
+            os.replace(partial, self.snapshot_path)
+        except Exception as e:
+            print(f"[SERVER] Could not snapshot {self.path}: {e}")
+        finally:
+            with self.lock:
+                self.snapshotting = False
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _flushed_size(self):
+        with self.lock:
+            self.file.flush()
+            return self.file.tell()
+
+    def _segments(self, end=None):
+        # Rooms replay with their lock held, so nothing is appended while
+        # they read.  The snapshot thread does not hold it and passes the
+        # offset it stops at instead.
+        if end is None:
+            end = self._flushed_size()
+        start = 0
+        with _mapped(self.snapshot_path) as snapshot:
+            if snapshot is not None and snapshot[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC:
+                start = min(SNAPSHOT_HEADER.unpack_from(snapshot)[1], end)
+                yield snapshot, SNAPSHOT_HEADER.size, len(snapshot)
+        with _mapped(self.path) as journal:
+            if journal is not None and start < end:
+                yield journal, start, end
+
+    def _tail(self, start):
+        # The journal is only ever appended to, so whatever a snapshot
+        # covers since is still there.
+        end = self._flushed_size()
+        with _mapped(self.path) as journal:
+            if journal is not None and start < end:
+                yield journal, start, end
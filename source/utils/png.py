@@ -0,0 +1,38 @@
+"""Minimal PNG encoder for RGBA pixel buffers.
+
+Only needs the standard library, and ``zlib`` releases the GIL while it
+compresses, so the display can encode saves on a worker thread while Kivy
+keeps drawing.
+"""
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def _chunk(tag, data):
+    return (struct.pack('!I', len(data)) + tag + data
+            + struct.pack('!I', zlib.crc32(data, zlib.crc32(tag))))
+
+
+def encode_png(width, height, rgba, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """Encode 8-bit RGBA pixels, top row first, as a PNG file in memory."""
+    stride = width * 4
+    view = memoryview(rgba)
+    if len(view) != stride * height:
+        raise ValueError("pixel buffer does not match the image size")
+
+    # Every scanline starts with its filter type; 0 means unfiltered.
+    rows = []
+    for offset in range(0, stride * height, stride):
+        rows.append(b'\x00')
+        rows.append(view[offset:offset + stride])
+
+    header = struct.pack('!IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b''.join((
+        PNG_SIGNATURE,
+        _chunk(b'IHDR', header),
+        _chunk(b'IDAT', zlib.compress(b''.join(rows), compress_level)),
+        _chunk(b'IEND', b''),
+    ))
@@ -0,0 +1,727 @@
+"""Wire protocol shared by the client, the server and the display processes.
+
+Every frame is a 4-byte big-endian length followed by a body.  The body is
+either a JSON document (what older peers speak) or a binary record: a
+one-byte opcode followed by a fixed layout.  JSON bodies always start with
+``{`` and no opcode uses that byte, so a receiver can decode either kind
+without knowing what the sender picked.
+
+A connection starts out in JSON.  The connecting side sends a ``hello``
+listing the codecs it understands and the accepting side answers with the
+one it picked.  Peers that never answer, or never send a hello, keep
+talking JSON.  The hello can also turn on deflate compression for the
+connection, after which a length with its top bit set marks a compressed
+body.
+"""
+import asyncio
+import itertools
+import json
+import socket
+import struct
+import zlib
+
+from utils.framing import COMPRESSED_FLAG, LENGTH, frame_body, send_buffers
+
+PROTOCOL_VERSION = 10
+# What a peer that never takes part in the handshake is assumed to speak.
+LEGACY_VERSION = 0
+# First version that understands ``points`` and ``up`` events.
+POINTS_VERSION = 2
+# First version whose displays can be reset and reused for another client.
+RESET_VERSION = 3
+# First version that streams saved PNGs as raw bytes after a small header.
+SAVE_STREAM_VERSION = 4
+# First version whose saves carry a request ID and end in a ``save_done``.
+SAVE_ID_VERSION = 5
+# First version that takes part in rooms: events relayed to it name the
+# client they came from, and clients accept events pushed by the server.
+ROOMS_VERSION = 6
+# First version that can resume a session after reconnecting.  Events are
+# numbered implicitly: the n-th event frame after the session handshake
+# has sequence number n.
+SESSION_VERSION = 7
+# First version whose ``down`` events carry a stroke ID and which erases
+# with ``remove_strokes``, naming the strokes to delete, instead of
+# ``erase``, which every receiver has to hit-test for itself.
+STROKE_ID_VERSION = 8
+# First version whose ``points``, ``move`` and ``up`` events name their
+# stroke too, so one client can draw several strokes at once.
+STROKE_STREAM_VERSION = 9
+# First version that answers a ``stats`` event with the server's counters.
+# A connection may send it instead of a session to only ask for stats.
+STATS_VERSION = 10
+HANDSHAKE_TIMEOUT = 2.0
+
+CHUNK_SIZE = 64 * 1024
+
+COMPRESSION = "deflate"
+# Bodies shorter than this are sent as they are.  Delta-coded stroke
+# records are mostly 30 to 50 bytes, and deflate takes about a quarter off
+# them once the stream has seen a few; ``up``s and the like are too short
+# to be worth it.
+DEFAULT_COMPRESS_THRESHOLD = 24
+COMPRESS_LEVEL = 6
+# Raw deflate with a 4 KiB window keeps each connection's streams small.
+COMPRESS_WBITS = -12
+# Every sync flush ends with these bytes, so they are left off the wire.
+_SYNC_TAIL = b'\x00\x00\xff\xff'
+
+OP_DOWN = 1
+OP_MOVE = 2
+OP_ERASE = 3
+OP_ERASE_ALL = 4
+OP_SET_TITLE = 5
+OP_SAVE = 6
+OP_EXIT = 7
+OP_POINTS = 8
+OP_UP = 9
+OP_SAVE_RESPONSE = 10
+OP_FROM = 11
+OP_DELTA_POINTS = 12
+OP_STROKE_DOWN = 13
+OP_REMOVE_STROKES = 14
+OP_STROKE = 15
+
+JSON_MARKER = ord('{')
+
+_DOWN = struct.Struct('!Bff4Bf')
+_STROKE_DOWN = struct.Struct('!BQff4Bf')
+_MOVE = struct.Struct('!Bff')
+_ERASE = struct.Struct('!Bfff')
+# The eraser's circle, kept for peers that predate stroke IDs, and a count
+# of the 64-bit stroke IDs that follow.  The path the eraser was dragged
+# along, if it was, fills the rest as delta-encoded points.
+_REMOVE_STROKES = struct.Struct('!BfffH')
+_OPCODE = struct.Struct('!B')
+_POINTS = struct.Struct('!BH')
+_DELTA_POINTS = struct.Struct('!BH')
+_SAVE_RESPONSE = struct.Struct('!BI')
+# Prefix naming the client a relayed record came from.
+_FROM = struct.Struct('!BI')
+# Prefix naming the stroke a points, move or up record belongs to.
+_STROKE = struct.Struct('!BQ')
+# Events that continue or end a stroke someone started with ``down``.
+STROKE_EVENTS = {"points", "move", "up"}
+# Delta-encoded points are fixed point with this many steps per pixel.
+POINT_SCALE = 8
+
+
+def _pack_color(color):
+    return [max(0, min(255, round(c * 255))) for c in color]
+
+
+def _unpack_color(rgba):
+    return [c / 255 for c in rgba]
+
+
+def pack_deltas(points, scale=POINT_SCALE):
+    """Quantize flat points and write each as zig-zag varint deltas.
+
+    The first point is a delta from the origin, so a record can be decoded
+    on its own.
+    """
+    out = bytearray()
+    previous_x = previous_y = 0
+    for i in range(0, len(points) - 1, 2):
+        x = round(points[i] * scale)
+        y = round(points[i + 1] * scale)
+        for delta in (x - previous_x, y - previous_y):
+            value = (delta << 1) ^ (delta >> 63)
+            while value > 0x7f:
+                out.append(value & 0x7f | 0x80)
+                value >>= 7
+            out.append(value)
+        previous_x = x
+        previous_y = y
+    return bytes(out)
+
+
+def unpack_deltas(data, offset=0, scale=POINT_SCALE):
+    """Decode what :func:`pack_deltas` wrote back into flat points."""
+    values = []
+    value = shift = 0
+    for byte in memoryview(data)[offset:]:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append((value >> 1) ^ -(value & 1))
+        value = shift = 0
+
+    # Undo the deltas for all xs and all ys at once, then interleave.
+    points = [0.0] * len(values)
+    points[0::2] = [x / scale for x in itertools.accumulate(values[0::2])]
+    points[1::2] = [y / scale for y in itertools.accumulate(values[1::2])]
+    return points
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, event):
+        return json.dumps(event).encode('utf-8')
+
+    def decode(self, body):
+        return decode_event(body)
+
+
+class BinaryCodec:
+    """Typed binary records for the event types that make up the traffic.
+
+    Event types without a record of their own are sent as JSON, which the
+    receiving side recognises by its first byte.
+    """
+    name = "binary"
+
+    def encode(self, event):
+        kind = event["type"]
+        if kind in STROKE_EVENTS and "id" in event:
+            event = dict(event)
+            return _STROKE.pack(OP_STROKE, event.pop("id")) + self.encode(event)
+        if kind == "move":
+            return _MOVE.pack(OP_MOVE, event["x"], event["y"])
+        if kind == "points":
+            points = event["points"]
+            return _POINTS.pack(OP_POINTS, len(points) // 2) + struct.pack(f'!{len(points)}f', *points)
+        if kind == "down" and "id" in event:
+            return _STROKE_DOWN.pack(
+                OP_STROKE_DOWN, event["id"], event["x"], event["y"],
+                *_pack_color(event.get("color", (1, 1, 1, 1))),
+                event.get("width", 2)
+            )
+        if kind == "down":
+            return _DOWN.pack(
+                OP_DOWN, event["x"], event["y"],
+                *_pack_color(event.get("color", (1, 1, 1, 1))),
+                event.get("width", 2)
+            )
+        if kind == "erase":
+            return _ERASE.pack(OP_ERASE, event["x"], event["y"], event["radius"])
+        if kind == "remove_strokes":
+            ids = event["ids"]
+            return (_REMOVE_STROKES.pack(OP_REMOVE_STROKES, event["x"], event["y"], event["radius"], len(ids))
+                    + struct.pack(f'!{len(ids)}Q', *ids) + pack_deltas(event.get("path", ())))
+        if kind == "erase_all":
+            return _OPCODE.pack(OP_ERASE_ALL)
+        if kind == "set_title":
+            return _OPCODE.pack(OP_SET_TITLE) + event["title"].encode('utf-8')
+        # Saves that carry a request ID go as JSON, which every version
+        # decodes; they are rare enough that the size does not matter.
+        if kind == "save" and "request_id" not in event:
+            return _OPCODE.pack(OP_SAVE) + event["filename"].encode('utf-8')
+        if kind == "up":
+            return _OPCODE.pack(OP_UP)
+        if kind == "save_response" and "size" in event and "request_id" not in event:
+            return _SAVE_RESPONSE.pack(OP_SAVE_RESPONSE, event["size"]) + event["filename"].encode('utf-8')
+        if kind == "exit":
+            return _OPCODE.pack(OP_EXIT)
+        return JSON_CODEC.encode(event)
+
+    def decode(self, body):
+        return decode_event(body)
+
+
+class DeltaCodec(BinaryCodec):
+    """Binary records with stroke points quantized and delta-encoded.
+
+    Points are sent as ``1 / POINT_SCALE`` pixel fixed point, each one a
+    pair of zig-zag varint deltas from the point before it, so the small
+    steps between touch samples take a byte or two per coordinate.
+    """
+    name = "delta"
+
+    def encode(self, event):
+        if event["type"] == "points" and "id" not in event:
+            points = event["points"]
+            return _DELTA_POINTS.pack(OP_DELTA_POINTS, len(points) // 2) + pack_deltas(points)
+        return super().encode(event)
+
+
+def _decode_binary(body):
+    opcode = body[0]
+    if opcode == OP_MOVE:
+        _, x, y = _MOVE.unpack(body)
+        return {"type": "move", "x": x, "y": y}
+    if opcode == OP_POINTS:
+        count = _POINTS.unpack_from(body)[1] * 2
+        return {"type": "points",
+                "points": list(struct.unpack_from(f'!{count}f', body, _POINTS.size))}
+    if opcode == OP_DELTA_POINTS:
+        return {"type": "points", "points": unpack_deltas(body, _DELTA_POINTS.size)}
+    if opcode == OP_DOWN:
+        _, x, y, r, g, b, a, width = _DOWN.unpack(body)
+        return {"type": "down", "x": x, "y": y,
+                "color": _unpack_color((r, g, b, a)), "width": width}
+    if opcode == OP_STROKE_DOWN:
+        _, stroke_id, x, y, r, g, b, a, width = _STROKE_DOWN.unpack(body)
+        return {"type": "down", "id": stroke_id, "x": x, "y": y,
+                "color": _unpack_color((r, g, b, a)), "width": width}
+    if opcode == OP_ERASE:
+        _, x, y, radius = _ERASE.unpack(body)
+        return {"type": "erase", "x": x, "y": y, "radius": radius}
+    if opcode == OP_REMOVE_STROKES:
+        _, x, y, radius, count = _REMOVE_STROKES.unpack_from(body)
+        event = {"type": "remove_strokes", "x": x, "y": y, "radius": radius,
+                 "ids": list(struct.unpack_from(f'!{count}Q', body, _REMOVE_STROKES.size))}
+        end = _REMOVE_STROKES.size + count * 8
+        if len(body) > end:
+            event["path"] = unpack_deltas(body, end)
+        return event
+    if opcode == OP_ERASE_ALL:
+        return {"type": "erase_all"}
+    if opcode == OP_SET_TITLE:
+        return {"type": "set_title", "title": bytes(body[1:]).decode('utf-8')}
+    if opcode == OP_SAVE:
+        return {"type": "save", "filename": bytes(body[1:]).decode('utf-8')}
+    if opcode == OP_UP:
+        return {"type": "up"}
+    if opcode == OP_SAVE_RESPONSE:
+        _, size = _SAVE_RESPONSE.unpack_from(body)
+        return {"type": "save_response", "size": size,
+                "filename": bytes(body[_SAVE_RESPONSE.size:]).decode('utf-8')}
+    if opcode == OP_EXIT:
+        return {"type": "exit"}
+    if opcode == OP_FROM:
+        event = decode_event(body[_FROM.size:])
+        event["client"] = _FROM.unpack_from(body)[1]
+        return event
+    if opcode == OP_STROKE:
+        event = decode_event(body[_STROKE.size:])
+        event["id"] = _STROKE.unpack_from(body)[1]
+        return event
+    raise ValueError(f"Unknown opcode {opcode}")
+
+
+_OPCODE_TYPES = {
+    OP_DOWN: "down",
+    OP_MOVE: "move",
+    OP_ERASE: "erase",
+    OP_ERASE_ALL: "erase_all",
+    OP_SET_TITLE: "set_title",
+    OP_SAVE: "save",
+    OP_EXIT: "exit",
+    OP_POINTS: "points",
+    OP_UP: "up",
+    OP_SAVE_RESPONSE: "save_response",
+    OP_DELTA_POINTS: "points",
+    OP_STROKE_DOWN: "down",
+    OP_REMOVE_STROKES: "remove_strokes",
+}
+
+
+def decode_event(body):
+    """Decode a frame body written by either codec."""
+    if body[0] == JSON_MARKER:
+        return json.loads(bytes(body).decode('utf-8'))
+    return _decode_binary(body)
+
+
+def event_type(body):
+    """Return the type of the event in ``body`` without decoding binary records."""
+    if body[0] == JSON_MARKER:
+        return json.loads(bytes(body).decode('utf-8'))["type"]
+    if body[0] == OP_FROM:
+        return event_type(body[_FROM.size:])
+    if body[0] == OP_STROKE:
+        return event_type(body[_STROKE.size:])
+    return _OPCODE_TYPES[body[0]]
+
+
+def tag_sender(body, client_id):
+    """Mark an encoded event as coming from ``client_id``.
+
+    Binary records get a prefix and are otherwise passed on as they are.
+    """
+    if body[0] == JSON_MARKER:
+        event = decode_event(body)
+        event["client"] = client_id
+        return JSON_CODEC.encode(event)
+    return _FROM.pack(OP_FROM, client_id) + body
+
+
+def sender_of(body):
+    """Return the client a tagged event came from, or None."""
+    if body[0] == JSON_MARKER:
+        return decode_event(body).get("client")
+    if body[0] == OP_FROM:
+        return _FROM.unpack_from(body)[1]
+    return None
+
+
+def stroke_of(body):
+    """Return the stroke a points, move or up event names, or None."""
+    if body[0] == JSON_MARKER:
+        return decode_event(body).get("id")
+    offset = _FROM.size if body[0] == OP_FROM else 0
+    if body[offset] == OP_STROKE:
+        return _STROKE.unpack_from(body, offset)[1]
+    return None
+
+
+def strip_sender(body):
+    """Undo :func:`tag_sender` for peers that predate rooms."""
+    if body[0] == JSON_MARKER:
+        event = decode_event(body)
+        event.pop("client", None)
+        return JSON_CODEC.encode(event)
+    if body[0] == OP_FROM:
+        return body[_FROM.size:]
+    return body
+
+
+def _opcode(body):
+    offset = _FROM.size if body[0] == OP_FROM else 0
+    if body[offset] == OP_STROKE:
+        offset += _STROKE.size
+    return body[offset]
+
+
+def transcode(body, codec):
+    """Return ``body`` in a form a peer using ``codec`` can decode."""
+    if body[0] == JSON_MARKER:
+        return body
+    if codec is JSON_CODEC:
+        return JSON_CODEC.encode(decode_event(body))
+    if codec is BINARY_CODEC and _opcode(body) == OP_DELTA_POINTS:
+        event = decode_event(body)
+        client = event.pop("client", None)
+        body = BINARY_CODEC.encode(event)
+        return body if client is None else tag_sender(body, client)
+    return body
+
+
+def without_stroke_ids(event, version=LEGACY_VERSION):
+    """Rewrite an event for a peer of ``version``, which predates stroke streams.
+
+    Stroke events lose their stroke ID.  Below ``STROKE_ID_VERSION``,
+    ``down`` loses it too and ``remove_strokes`` goes back to the ``erase``
+    it came from, which such peers hit-test themselves.
+    """
+    kind = event["type"]
+    if kind == "remove_strokes" and version < STROKE_ID_VERSION:
+        erase = {"type": "erase", "x": event["x"], "y": event["y"], "radius": event["radius"]}
+        if "client" in event:
+            erase["client"] = event["client"]
+        return erase
+    if "id" in event and (kind in STROKE_EVENTS or kind == "down" and version < STROKE_ID_VERSION):
+        event = dict(event)
+        del event["id"]
+    return event
+
+
+def strip_stroke_ids(body, version=LEGACY_VERSION):
+    """:func:`without_stroke_ids` for an encoded, possibly tagged, event."""
+    if body[0] == JSON_MARKER:
+        event = decode_event(body)
+        if "id" not in event and event["type"] != "remove_strokes":
+            return body
+        return JSON_CODEC.encode(without_stroke_ids(event, version))
+    offset = _FROM.size if body[0] == OP_FROM else 0
+    if body[offset] == OP_STROKE:
+        # The bulk of the traffic, so the prefix is cut out without decoding.
+        return b''.join((body[:offset], body[offset + _STROKE.size:]))
+    if version >= STROKE_ID_VERSION or body[offset] not in (OP_STROKE_DOWN, OP_REMOVE_STROKES):
+        return body
+    event = without_stroke_ids(decode_event(body), version)
+    client = event.pop("client", None)
+    body = BINARY_CODEC.encode(event)
+    return body if client is None else tag_sender(body, client)
+
+
+def expand_points(event):
+    """Split a ``points`` event into the ``move`` events legacy peers expect."""
+    points = event["points"]
+    return [{"type": "move", "x": points[i], "y": points[i + 1]}
+            for i in range(0, len(points) - 1, 2)]
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+DELTA_CODEC = DeltaCodec()
+
+CODECS = {
+    DELTA_CODEC.name: DELTA_CODEC,
+    BINARY_CODEC.name: BINARY_CODEC,
+    JSON_CODEC.name: JSON_CODEC,
+}
+
+# Most preferred first.
+PREFERRED_CODECS = (DELTA_CODEC.name, BINARY_CODEC.name, JSON_CODEC.name)
+
+
+def get_codec(name):
+    return CODECS.get(name, JSON_CODEC)
+
+
+def pack_frame(body):
+    return LENGTH.pack(len(body)) + body
+
+
+class StreamCompression:
+    """The deflate streams of one connection, one for each direction.
+
+    Every compressed frame ends in a sync flush so the receiver can inflate
+    it as soon as it arrives; bodies shorter than ``threshold`` skip the
+    stream.  Frames must be packed in the order they are sent.
+    """
+
+    def __init__(self, threshold=DEFAULT_COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.deflater = zlib.compressobj(level, zlib.DEFLATED, COMPRESS_WBITS)
+        self.inflater = zlib.decompressobj(COMPRESS_WBITS)
+        # Bodies that went through each stream, before and after
+        # compression.  Each direction is counted only where its stream is
+        # used, so neither needs a lock of its own.  Frames sent as they are
+        # are not counted, so those can be built without the streams.
+        self.sent_raw = 0
+        self.sent_wire = 0
+        self.received_raw = 0
+        self.received_wire = 0
+
+    @property
+    def raw_bytes(self):
+        return self.sent_raw + self.received_raw
+
+    @property
+    def wire_bytes(self):
+        return self.sent_wire + self.received_wire
+
+    @property
+    def saved_bytes(self):
+        return self.raw_bytes - self.wire_bytes
+
+    def pack(self, body):
+        if len(body) < self.threshold:
+            return pack_frame(body)
+        self.sent_raw += len(body)
+        data = self.deflater.compress(body) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-len(_SYNC_TAIL)]
+        self.sent_wire += len(data)
+        return LENGTH.pack(len(data) | COMPRESSED_FLAG) + data
+
+    def unpack(self, data, compressed):
+        if not compressed:
+            return data
+        self.received_wire += len(data)
+        data = self.inflater.decompress(data) + self.inflater.decompress(_SYNC_TAIL)
+        self.received_raw += len(data)
+        return data
+
+
+def send_frame(sock, body, compression=None):
+    if compression is not None:
+        sock.sendall(compression.pack(body))
+        return
+    # The prefix and body go out together without being copied into one.
+    send_buffers(sock, (LENGTH.pack(len(body)), body))
+
+
+def recv_exact(sock, size):
+    """Read exactly ``size`` bytes, or return None if the peer closed."""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            return None
+        received += count
+    return bytes(buffer)
+
+
+def send_payload(sock, data):
+    """Send raw bytes that follow a header frame, one chunk at a time."""
+    view = memoryview(data)
+    for offset in range(0, len(view), CHUNK_SIZE):
+        sock.sendall(view[offset:offset + CHUNK_SIZE])
+
+
+def recv_payload_into(sock, size, file):
+    """Copy ``size`` raw bytes from the socket into ``file`` chunk by chunk."""
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    remaining = size
+    while remaining:
+        count = sock.recv_into(view, min(remaining, CHUNK_SIZE))
+        if not count:
+            raise ConnectionError("Connection closed during payload")
+        file.write(view[:count])
+        remaining -= count
+
+
+def recv_frame(sock, compression=None):
+    """Read one frame body, or return None if the peer closed.
+
+    Never reads past the frame, so a :class:`utils.framing.FrameReader`
+    can take the socket over after a handshake.
+    """
+    header = recv_exact(sock, LENGTH.size)
+    if header is None:
+        return None
+    size = LENGTH.unpack(header)[0]
+    body = recv_exact(sock, size & ~COMPRESSED_FLAG)
+    if body is None:
+        return None
+    return frame_body(size, body, compression)
+
+
+def hello_event(codec=None, compress=False):
+    """Build a hello: an offer when ``codec`` is None, otherwise an answer.
+
+    ``compress`` offers compression, or accepts it in an answer.
+    """
+    event = {"type": "hello", "version": PROTOCOL_VERSION}
+    if codec is None:
+        event["codecs"] = list(PREFERRED_CODECS)
+        if compress:
+            event["compression"] = [COMPRESSION]
+    else:
+        event["codec"] = codec
+        if compress:
+            event["compression"] = COMPRESSION
+    return event
+
+
+def choose_codec(offered):
+    for name in PREFERRED_CODECS:
+        if name in offered:
+            return name
+    return JSON_CODEC.name
+
+
+def _answer_body(event, compress_threshold):
+    name = choose_codec(event.get("codecs", ()))
+    compress = compress_threshold is not None and COMPRESSION in event.get("compression", ())
+    body = JSON_CODEC.encode(hello_event(name, compress))
+    compression = StreamCompression(compress_threshold) if compress else None
+    return body, get_codec(name), event.get("version", LEGACY_VERSION), compression
+
+
+def _read_answer(body, compress_threshold):
+    if body is None:
+        raise ConnectionError("Connection closed during handshake")
+    event = decode_event(body)
+    if event.get("type") != "hello":
+        return JSON_CODEC, LEGACY_VERSION, None
+    compression = None
+    if compress_threshold is not None and event.get("compression") == COMPRESSION:
+        compression = StreamCompression(compress_threshold)
+    return get_codec(event.get("codec")), event.get("version", LEGACY_VERSION), compression
+
+
+def answer_hello(sock, event, compress_threshold=None):
+    """Reply to a received hello offer.
+
+    Returns the codec that was picked, the protocol version of the peer and
+    the connection's :class:`StreamCompression`, or None if it is off.
+    Compression is only accepted given a ``compress_threshold``.
+    """
+    body, codec, version, compression = _answer_body(event, compress_threshold)
+    send_frame(sock, body)
+    return codec, version, compression
+
+
+def offer_hello(sock, timeout=HANDSHAKE_TIMEOUT, compress_threshold=None, legacy=True):
+    """Send a hello offer and wait for the answer.
+
+    Returns the same as :func:`answer_hello`.  Compression is offered given
+    a ``compress_threshold``.  A peer that does not answer within
+    ``timeout`` seconds is treated as a legacy JSON peer, or, if ``legacy``
+    is false, the timeout is raised.
+    """
+    send_frame(sock, JSON_CODEC.encode(hello_event(compress=compress_threshold is not None)))
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        body = recv_frame(sock)
+    except socket.timeout:
+        if not legacy:
+            raise
+        return JSON_CODEC, LEGACY_VERSION, None
+    finally:
+        sock.settimeout(previous)
+    return _read_answer(body, compress_threshold)
+
+
+def request_session(sock, codec, token=None, compression=None, timeout=HANDSHAKE_TIMEOUT):
+    """Ask to resume the session ``token``, or to start one if it is None.
+
+    Returns the server's answer: the session's token, the sequence number
+    of the last event it applied and whether it was resumed.
+    """
+    send_frame(sock, codec.encode({"type": "session", "token": token}), compression)
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        body = recv_frame(sock, compression)
+    finally:
+        sock.settimeout(previous)
+    if body is None:
+        raise ConnectionError("Connection closed during session handshake")
+    return decode_event(body)
+
+
+def request_stats(sock, codec, compression=None, timeout=HANDSHAKE_TIMEOUT):
+    """Ask the server for its counters and return its ``stats`` answer."""
+    send_frame(sock, codec.encode({"type": "stats"}), compression)
+    previous = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        body = recv_frame(sock, compression)
+    finally:
+        sock.settimeout(previous)
+    if body is None:
+        raise ConnectionError("Connection closed before the stats arrived")
+    return decode_event(body)
+
+
+async def read_frame(reader, compression=None, stats=None):
+    """Read one frame body from an asyncio stream, or None if it closed.
+
+    ``stats``, if given, counts the frame as it was on the wire.
+    """
+    try:
+        header = await reader.readexactly(LENGTH.size)
+        size = LENGTH.unpack(header)[0]
+        body = await reader.readexactly(size & ~COMPRESSED_FLAG)
+    except asyncio.IncompleteReadError:
+        return None
+    if stats is not None:
+        stats.received(LENGTH.size + len(body))
+    return frame_body(size, body, compression)
+
+
+def write_frame(writer, body, compression=None):
+    writer.write(pack_frame(body) if compression is None else compression.pack(body))
+
+
+async def read_payload(reader, size, stats=None):
+    """Yield the ``size`` raw bytes following a header frame in chunks."""
+    remaining = size
+    while remaining:
+        chunk = await reader.read(min(remaining, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError("Connection closed during payload")
+        remaining -= len(chunk)
+        if stats is not None:
+            stats.received(len(chunk), frames=0)
+        yield chunk
+
+
+async def answer_hello_async(writer, event, compress_threshold=None):
+    """asyncio counterpart of :func:`answer_hello`."""
+    body, codec, version, compression = _answer_body(event, compress_threshold)
+    write_frame(writer, body)
+    await writer.drain()
+    return codec, version, compression
+
+
+async def offer_hello_async(reader, writer, timeout=HANDSHAKE_TIMEOUT, compress_threshold=None):
+    """asyncio counterpart of :func:`offer_hello`."""
+    write_frame(writer, JSON_CODEC.encode(hello_event(compress=compress_threshold is not None)))
+    await writer.drain()
+    try:
+        body = await asyncio.wait_for(read_frame(reader), timeout)
+    except asyncio.TimeoutError:
+        return JSON_CODEC, LEGACY_VERSION, None
+    return _read_answer(body, compress_threshold)
@@ -0,0 +1,58 @@
+"""Online simplification of stroke points as they are drawn.
+
+Douglas-Peucker needs the whole polyline before it can choose which points
+to keep, and a stroke that is still being drawn does not have one yet.
+``StrokeSimplifier`` gives the same guarantee as it goes: a point is only
+dropped while every point since the last kept one lies within ``tolerance``
+of the segment from that point to the newest one, so the kept polyline never
+strays further than ``tolerance`` from what was drawn.
+"""
+from utils.spatial import segment_hits_circle
+
+DEFAULT_TOLERANCE = 0.75
+# Bounds both the work per point and how long a point can stay undecided.
+MAX_PENDING_POINTS = 64
+
+
+class StrokeSimplifier:
+    """Thins the points of one stroke that starts at (x, y).
+
+    ``add`` returns the points that have become final.  The newest point,
+    ``tail``, is drawn but may still be dropped for a later one;
+    ``finish`` returns it once the stroke ends.
+    """
+
+    def __init__(self, x, y, tolerance=DEFAULT_TOLERANCE, max_pending=MAX_PENDING_POINTS):
+        self.tolerance = tolerance
+        self.max_pending = max_pending
+        self.anchor = (x, y)
+        # Points since the anchor, the tail last.
+        self.pending = []
+
+    @property
+    def tail(self):
+        return self.pending[-1] if self.pending else None
+
+    def add(self, x, y):
+        """Take the next point; returns the flat coordinates now final."""
+        if self.pending and (len(self.pending) >= self.max_pending or not self._covers(x, y)):
+            kept = self.pending[-1]
+            self.anchor = kept
+            self.pending = [(x, y)]
+            return list(kept)
+        self.pending.append((x, y))
+        return []
+
+    def finish(self):
+        """End the stroke; returns the tail's coordinates, if there is one."""
+        tail = self.tail
+        self.pending = []
+        return [] if tail is None else list(tail)
+
+    def _covers(self, x, y):
+        ax, ay = self.anchor
+        tolerance = self.tolerance
+        for px, py in self.pending:
+            if not segment_hits_circle(ax, ay, x, y, px, py, tolerance):
+                return False
+        return True
@@ -0,0 +1,113 @@
+"""Spatial index over stroke segments for eraser hit-testing.
+
+Every segment is filed in the cells of a uniform grid that its bounding box
+overlaps, so an erase probe only has to test the segments in the few cells
+around the cursor instead of every point on the canvas.
+"""
+import math
+
+DEFAULT_CELL_SIZE = 64
+
+
+def segment_hits_circle(ax, ay, bx, by, cx, cy, radius):
+    """Return True if segment A-B passes within ``radius`` of C."""
+    vx = bx - ax
+    vy = by - ay
+    wx = cx - ax
+    wy = cy - ay
+
+    c1 = wx * vx + wy * vy
+    if c1 <= 0:
+        return math.hypot(wx, wy) <= radius
+
+    c2 = vx * vx + vy * vy
+    if c2 <= c1:
+        return math.hypot(cx - bx, cy - by) <= radius
+
+    t = c1 / c2
+    return math.hypot(cx - (ax + t * vx), cy - (ay + t * vy)) <= radius
+
+
+def segments_within(ax, ay, bx, by, cx, cy, dx, dy, radius):
+    """Return True if segments A-B and C-D come within ``radius`` of each other.
+
+    That is, if A-B touches the capsule a circle of ``radius`` sweeps when
+    it moves from C to D.
+    """
+    # Segments that cross are no distance apart.
+    d1 = (dx - cx) * (ay - cy) - (dy - cy) * (ax - cx)
+    d2 = (dx - cx) * (by - cy) - (dy - cy) * (bx - cx)
+    d3 = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    d4 = (bx - ax) * (dy - ay) - (by - ay) * (dx - ax)
+    if d1 * d2 < 0 and d3 * d4 < 0:
+        return True
+    # Otherwise the closest pair of points has an end point in it.
+    return (segment_hits_circle(ax, ay, bx, by, cx, cy, radius)
+            or segment_hits_circle(ax, ay, bx, by, dx, dy, radius)
+            or segment_hits_circle(cx, cy, dx, dy, ax, ay, radius)
+            or segment_hits_circle(cx, cy, dx, dy, bx, by, radius))
+
+
+def stroke_hits_circle(points, center, radius):
+    """Test every segment of a flat ``[x0, y0, x1, y1, ...]`` point list."""
+    cx, cy = center
+    for i in range(0, len(points) - 2, 2):
+        if segment_hits_circle(points[i], points[i + 1], points[i + 2],
+                               points[i + 3], cx, cy, radius):
+            return True
+    return False
+
+
+class SegmentGrid:
+    """Uniform grid of stroke segments, updated as strokes grow and go.
+
+    The grid only records which segments of which stroke lie in which cell;
+    the coordinates stay with the caller (see ``utils.strokes``).
+    """
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        # (column, row) -> {key: [segment index, ...]}
+        self.cells = {}
+        self.key_cells = {}
+
+    def insert(self, key, points, first_segment=0):
+        """Index the segments of flat ``points`` from ``first_segment`` on."""
+        cells = self.cells
+        key_cells = self.key_cells.setdefault(key, set())
+        size = self.cell_size
+        for i in range(first_segment * 2, len(points) - 2, 2):
+            ax, ay, bx, by = points[i], points[i + 1], points[i + 2], points[i + 3]
+            segment = i // 2
+            for column in range(math.floor(min(ax, bx) / size), math.floor(max(ax, bx) / size) + 1):
+                for row in range(math.floor(min(ay, by) / size), math.floor(max(ay, by) / size) + 1):
+                    cell = (column, row)
+                    cells.setdefault(cell, {}).setdefault(key, []).append(segment)
+                    key_cells.add(cell)
+
+    def remove(self, key):
+        for cell in self.key_cells.pop(key, ()):
+            entries = self.cells[cell]
+            del entries[key]
+            if not entries:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.key_cells.clear()
+
+    def candidates(self, x, y, radius):
+        """Return ``{key: {segment, ...}}`` for segments near (x, y)."""
+        return self.candidates_in(x - radius, y - radius, x + radius, y + radius)
+
+    def candidates_in(self, left, bottom, right, top):
+        """Return ``{key: {segment, ...}}`` for segments near a box."""
+        size = self.cell_size
+        found = {}
+        for column in range(math.floor(left / size), math.floor(right / size) + 1):
+            for row in range(math.floor(bottom / size), math.floor(top / size) + 1):
+                entries = self.cells.get((column, row))
+                if entries:
+                    for key, segments in entries.items():
+                        found.setdefault(key, set()).update(segments)
+        return found
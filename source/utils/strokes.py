@@ -0,0 +1,284 @@
+"""Stroke model kept alongside the Kivy instructions that draw it.
+
+Coordinates live in growable contiguous float32 buffers (``array('f')``),
+so appending a point is amortised O(1) and never rebuilds a Python list.
+Hit-tests use NumPy when it is installed: the candidate segments returned by
+the spatial grid are tested with one vectorised point-to-segment distance
+computation instead of a Python loop per segment.
+"""
+import itertools
+import random
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils.spatial import (
+    DEFAULT_CELL_SIZE, SegmentGrid, segment_hits_circle, segments_within,
+    stroke_hits_circle,
+)
+
+# Below this many segments the NumPy call overhead outweighs the plain loop.
+NUMPY_MIN_SEGMENTS = 32
+
+
+def segment_distances_sq(starts, ends, x, y):
+    """Squared distances from (x, y) to each segment, as (n, 2) NumPy arrays."""
+    return point_distances_sq(numpy.array((x, y), dtype=starts.dtype), starts, ends)
+
+
+def point_distances_sq(points, starts, ends):
+    """Squared distances from each point to the segment in the same row."""
+    direction = ends - starts
+    offset = points - starts
+    length_sq = numpy.einsum('ij,ij->i', direction, direction)
+    t = numpy.einsum('ij,ij->i', offset, direction)
+    numpy.divide(t, length_sq, out=t, where=length_sq > 0)
+    t[length_sq == 0] = 0
+    numpy.clip(t, 0, 1, out=t)
+    gap = offset - direction * t[:, None]
+    return numpy.einsum('ij,ij->i', gap, gap)
+
+
+def stroke_ids():
+    """Yield 64-bit IDs for the strokes one drawer starts.
+
+    The top 32 bits are picked at random, so drawers that never talk to
+    each other still hand out IDs that do not collide.
+    """
+    return itertools.count(random.getrandbits(32) << 32)
+
+
+def capsule_distances_sq(starts, ends, a, b):
+    """Squared distances between each segment and the path segment a-b.
+
+    All four are (n, 2) arrays, one pair of segments per row.
+    """
+    distances = numpy.minimum(
+        numpy.minimum(point_distances_sq(a, starts, ends), point_distances_sq(b, starts, ends)),
+        numpy.minimum(point_distances_sq(starts, a, b), point_distances_sq(ends, a, b)),
+    )
+    # Segments that cross are no distance apart.
+    path = b - a
+    direction = ends - starts
+    d1 = _cross(path, starts - a)
+    d2 = _cross(path, ends - a)
+    d3 = _cross(direction, a - starts)
+    d4 = _cross(direction, b - starts)
+    distances[(d1 * d2 < 0) & (d3 * d4 < 0)] = 0
+    return distances
+
+
+def _cross(u, v):
+    return u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+
+
+class ActiveStrokes:
+    """The strokes still being drawn on a board, by stroke ID.
+
+    Events that name their stroke are matched by its ID, so any number of
+    strokes can be drawn at once.  Events from peers that predate stroke
+    streams are matched by the client that sent them instead, to its newest
+    stroke.
+    """
+
+    def __init__(self):
+        # stroke ID -> ID of the client drawing it
+        self.clients = {}
+        # client ID -> ID of the newest stroke it started
+        self.latest = {}
+
+    def __contains__(self, stroke_id):
+        return stroke_id in self.clients
+
+    def start(self, stroke_id, client_id=None):
+        self.clients[stroke_id] = client_id
+        self.latest[client_id] = stroke_id
+
+    def find(self, event):
+        """Return the ID of the stroke a stroke event is for, or None."""
+        stroke_id = event.get("id")
+        if stroke_id is None:
+            stroke_id = self.latest.get(event.get("client"))
+        return stroke_id if stroke_id in self.clients else None
+
+    def finish(self, stroke_id):
+        client_id = self.clients.pop(stroke_id, None)
+        if self.latest.get(client_id) == stroke_id:
+            del self.latest[client_id]
+
+    def clear(self):
+        self.clients.clear()
+        self.latest.clear()
+
+
+class Stroke:
+    __slots__ = ("coords",)
+
+    def __init__(self, x, y):
+        self.coords = array('f', (x, y))
+
+    def __len__(self):
+        return len(self.coords) // 2
+
+    def vertices(self):
+        """Zero-copy (n, 2) NumPy view of the points.
+
+        Drop the view before appending again: a buffer that is being viewed
+        cannot grow.
+        """
+        return numpy.frombuffer(self.coords, dtype=numpy.float32).reshape(-1, 2)
+
+    def hits_circle(self, center, radius):
+        if numpy is None or len(self) <= NUMPY_MIN_SEGMENTS:
+            return stroke_hits_circle(self.coords, center, radius)
+        vertices = self.vertices()
+        distances = segment_distances_sq(vertices[:-1], vertices[1:], *center)
+        return bool((distances <= radius * radius).any())
+
+
+class StrokeStore:
+    """Strokes by key plus the grid that locates their segments.
+
+    Keys are whatever the caller uses to find its drawing instructions again.
+    """
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.strokes = {}
+        self.grid = SegmentGrid(cell_size)
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def __contains__(self, key):
+        return key in self.strokes
+
+    def get(self, key):
+        return self.strokes.get(key)
+
+    def add(self, key, x, y):
+        stroke = Stroke(x, y)
+        self.strokes[key] = stroke
+        return stroke
+
+    def extend(self, key, points):
+        """Append a flat run of points; returns the stroke or None if unknown."""
+        stroke = self.strokes.get(key)
+        if stroke is None:
+            return None
+        first_segment = len(stroke) - 1
+        stroke.coords.extend(points)
+        self.grid.insert(key, stroke.coords, first_segment)
+        return stroke
+
+    def remove(self, key):
+        self.strokes.pop(key, None)
+        self.grid.remove(key)
+
+    def clear(self):
+        self.strokes.clear()
+        self.grid.clear()
+
+    def query(self, x, y, radius):
+        """Return the keys of all strokes that come within ``radius`` of (x, y)."""
+        candidates = self.grid.candidates(x, y, radius)
+        if numpy is not None and sum(map(len, candidates.values())) >= NUMPY_MIN_SEGMENTS:
+            return self._query_vectorised(candidates, x, y, radius)
+
+        hits = []
+        for key, segments in candidates.items():
+            coords = self.strokes[key].coords
+            for segment in segments:
+                i = segment * 2
+                if segment_hits_circle(coords[i], coords[i + 1], coords[i + 2],
+                                       coords[i + 3], x, y, radius):
+                    hits.append(key)
+                    break
+        return hits
+
+    def query_path(self, path, radius):
+        """Return the keys of strokes that come within ``radius`` of a path.
+
+        ``path`` is a flat run of points; each segment of it is tested as
+        the capsule an eraser of ``radius`` sweeps along it, so a fast drag
+        leaves no gaps between its points.
+        """
+        if len(path) < 4:
+            return self.query(path[0], path[1], radius)
+
+        # (path segment, {key: segments}) for every segment of the path.
+        work = []
+        total = 0
+        for i in range(0, len(path) - 2, 2):
+            ax, ay, bx, by = path[i:i + 4]
+            candidates = self.grid.candidates_in(min(ax, bx) - radius, min(ay, by) - radius,
+                                                 max(ax, bx) + radius, max(ay, by) + radius)
+            if candidates:
+                work.append(((ax, ay, bx, by), candidates))
+                total += sum(map(len, candidates.values()))
+        if numpy is not None and total >= NUMPY_MIN_SEGMENTS:
+            return self._query_path_vectorised(work, radius)
+
+        hits = set()
+        for (ax, ay, bx, by), candidates in work:
+            for key, segments in candidates.items():
+                if key in hits:
+                    continue
+                coords = self.strokes[key].coords
+                for segment in segments:
+                    i = segment * 2
+                    if segments_within(coords[i], coords[i + 1], coords[i + 2], coords[i + 3],
+                                       ax, ay, bx, by, radius):
+                        hits.add(key)
+                        break
+        return list(hits)
+
+    def _query_path_vectorised(self, work, radius):
+        # Every candidate segment is paired with the path segment it was
+        # found for, and all pairs are tested in one go.
+        keys = []
+        starts = []
+        ends = []
+        path_starts = []
+        path_ends = []
+        counts = []
+        for (ax, ay, bx, by), candidates in work:
+            for key, segments in candidates.items():
+                first = min(segments)
+                last = max(segments)
+                vertices = self.strokes[key].vertices()[first:last + 2]
+                count = last - first + 1
+                keys.append(key)
+                starts.append(vertices[:-1])
+                ends.append(vertices[1:])
+                path_starts.append(numpy.broadcast_to(numpy.array((ax, ay), dtype=numpy.float32), (count, 2)))
+                path_ends.append(numpy.broadcast_to(numpy.array((bx, by), dtype=numpy.float32), (count, 2)))
+                counts.append(count)
+        distances = capsule_distances_sq(
+            numpy.concatenate(starts), numpy.concatenate(ends),
+            numpy.concatenate(path_starts), numpy.concatenate(path_ends),
+        )
+        owners = numpy.repeat(numpy.arange(len(keys)), counts)
+        return list({keys[owner] for owner in numpy.unique(owners[distances <= radius * radius])})
+
+    def _query_vectorised(self, candidates, x, y, radius):
+        # Test the span between each stroke's first and last candidate
+        # segment: slicing is a view, which is cheaper than gathering the
+        # exact segments even though a few extra ones get tested.
+        keys = list(candidates)
+        starts = []
+        ends = []
+        counts = []
+        for key in keys:
+            segments = candidates[key]
+            first = min(segments)
+            last = max(segments)
+            vertices = self.strokes[key].vertices()[first:last + 2]
+            starts.append(vertices[:-1])
+            ends.append(vertices[1:])
+            counts.append(last - first + 1)
+        distances = segment_distances_sq(numpy.concatenate(starts), numpy.concatenate(ends), x, y)
+        owners = numpy.repeat(numpy.arange(len(keys)), counts)
+        return [keys[owner] for owner in numpy.unique(owners[distances <= radius * radius])]
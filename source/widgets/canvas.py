@@ -1,8 +1,11 @@
-import math
 from kivy.metrics import dp
 from kivy.uix.widget import Widget
-from kivy.graphics import Color, Rectangle, Line, Ellipse
+from kivy.graphics import Color, Rectangle, Ellipse
 from kivy.core.window import Window
+from kivy.clock import Clock
+from utils.simplify import DEFAULT_TOLERANCE, StrokeSimplifier
+from utils.strokes import ActiveStrokes, StrokeStore, stroke_ids
+from widgets.layers import StrokeLayers
 
 class DrawInput(Widget):
     def __init__(self, send_to_server_callback=None, **kwargs):
@@ -11,101 +14,189 @@ class DrawInput(Widget):
         self.eraser_mode = False
         self.eraser_size = 30
         self.pencil_size = 2
-        self.drawings = []
+        # How far, in pixels, a thinned stroke may stray from the touch path.
+        self.simplify_tolerance = DEFAULT_TOLERANCE
+        # Lines by stroke ID, which also keys the strokes in ``strokes``.
+        self.drawings = {}
+        self.strokes = StrokeStore()
+        self.stroke_ids = stroke_ids()
+        # Strokes other members of the room are drawing.
+        self.remote_lines = ActiveStrokes()
+        # Eraser path of each touch since the last frame, flat, starting
+        # where the path erased last frame ended.
+        self.eraser_paths = {}
+        # Touches whose path has grown since it was last erased.
+        self.eraser_moved = set()
         self.send_to_server_callback = send_to_server_callback
         
         with self.canvas.before:
             Color(0, 0, 0, 1)
             self.bg_rect = Rectangle(pos=self.pos, size=self.size)
         self.bind(pos=self.update_bg, size=self.update_bg)
+        self.layers = StrokeLayers(self.canvas)
 
     def update_bg(self, *args):
         self.bg_rect.pos = self.pos
         self.bg_rect.size = self.size
     
-    def erase_at_point(self, pos):
+    def erase_at_point(self, pos, touch=None):
+        """Extend the eraser's path, which is erased once per frame."""
+        key = None if touch is None else touch.uid
+        if not self.eraser_moved:
+            Clock.schedule_once(self.erase_paths)
+        self.eraser_paths.setdefault(key, []).extend(pos)
+        self.eraser_moved.add(key)
+
+    def erase_paths(self, *args):
+        for key in self.eraser_moved:
+            path = self.eraser_paths.get(key)
+            if path:
+                self.erase_along(path)
+                self.eraser_paths[key] = path[-2:]
+        self.eraser_moved.clear()
+
+    def erase_along(self, path):
+        # Only this side hit-tests; everyone else deletes the same strokes by ID.
+        ids = self.strokes.query_path(path, self.eraser_size)
+        if not ids:
+            return
+        self.remove_strokes(ids)
         if self.send_to_server_callback:
-            self.send_to_server_callback({
-                "type": "erase",
-                "x": pos[0],
-                "y": pos[1],
+            event = {
+                "type": "remove_strokes",
+                "ids": ids,
+                "x": path[-2],
+                "y": path[-1],
                 "radius": self.eraser_size
-            })
-            
-        lines_to_remove = []
-        for line in self.drawings:
-            if self.line_intersects_circle(line, pos, self.eraser_size):
-                lines_to_remove.append(line)
-                    
-        for line in lines_to_remove:
-            self.canvas.remove(line)
-            self.drawings.remove(line)
-
-    def line_intersects_circle(self, line, center, radius):
-        points = line.points
-        for i in range(0, len(points)-2, 2):
-            ax, ay = points[i], points[i+1]
-            bx, by = points[i+2], points[i+3]
-            
-            vx = bx - ax
-            vy = by - ay
-            wx = center[0] - ax
-            wy = center[1] - ay
-            
-            c1 = wx * vx + wy * vy
-            if c1 <= 0:
-                if math.dist(center, (ax, ay)) <= radius:
-                    return True
-                continue
-                
-            c2 = vx * vx + vy * vy
-            if c2 <= c1:
-                if math.dist(center, (bx, by)) <= radius:
-                    return True
-                continue
-                
-            t = c1 / c2
-            closest = (ax + t * vx, ay + t * vy)
-            if math.dist(center, closest) <= radius:
-                return True
-                
-        return False
+            }
+            if len(path) > 2:
+                event["path"] = path
+            self.send_to_server_callback(event)
+
+    def remove_lines_at(self, x, y, radius):
+        self.remove_strokes(self.strokes.query(x, y, radius))
+
+    def remove_strokes(self, ids):
+        for stroke_id in ids:
+            line = self.drawings.pop(stroke_id, None)
+            if line is not None:
+                self.layers.remove(line)
+                self.strokes.remove(stroke_id)
 
     def on_touch_down(self, touch):
         if self.collide_point(*touch.pos):
             if self.eraser_mode:
-                self.erase_at_point(touch.pos)
+                self.erase_at_point(touch.pos, touch)
             else:
-                with self.canvas:
-                    Color(*self.current_color)
-                    line = Line(points=(touch.x, touch.y), width=self.pencil_size)
-                    touch.ud["line"] = line
-                    self.drawings.append(line)
-                    if self.send_to_server_callback:
-                        self.send_to_server_callback({
-                            "type": "down",
-                            "x": touch.x,
-                            "y": touch.y,
-                            "color": self.current_color,
-                            "width": self.pencil_size,
-                        })
+                stroke_id = next(self.stroke_ids)
+                line = self.layers.add(self.current_color, touch.x, touch.y, self.pencil_size)
+                touch.ud["line"] = line
+                touch.ud["stroke"] = stroke_id
+                touch.ud["simplifier"] = StrokeSimplifier(touch.x, touch.y, self.simplify_tolerance)
+                self.drawings[stroke_id] = line
+                self.strokes.add(stroke_id, touch.x, touch.y)
+                if self.send_to_server_callback:
+                    self.send_to_server_callback({
+                        "type": "down",
+                        "id": stroke_id,
+                        "x": touch.x,
+                        "y": touch.y,
+                        "color": self.current_color,
+                        "width": self.pencil_size,
+                    })
 
     def on_touch_move(self, touch):
         if self.collide_point(*touch.pos):
             if self.eraser_mode:
-                self.erase_at_point(touch.pos)
+                self.erase_at_point(touch.pos, touch)
             elif "line" in touch.ud:
-                touch.ud["line"].points += (touch.x, touch.y)
-                if self.send_to_server_callback:
+                line = touch.ud["line"]
+                simplifier = touch.ud["simplifier"]
+                stroke_id = touch.ud["stroke"]
+                kept = simplifier.add(touch.x, touch.y)
+                stroke = self.strokes.extend(stroke_id, kept) if kept else self.strokes.get(stroke_id)
+                if stroke is not None:
+                    # The line ends in the tail until a later point
+                    # replaces it, or makes it final and follows it.
+                    if len(line.points) > len(stroke.coords):
+                        self.layers.move_end(line, *simplifier.tail)
+                    else:
+                        self.layers.extend(line, simplifier.tail)
+                if kept and self.send_to_server_callback:
                     self.send_to_server_callback({
                         "type": "move",
-                        "x": touch.x,
-                        "y": touch.y,
+                        "id": stroke_id,
+                        "x": kept[0],
+                        "y": kept[1],
                     })
-    def erase_all(self):
-        for line in self.drawings[:]:  
-            self.canvas.remove(line)
+
+    def on_touch_up(self, touch):
+        if touch.uid in self.eraser_paths:
+            self.erase_paths()
+            del self.eraser_paths[touch.uid]
+        if "line" not in touch.ud:
+            return
+        line = touch.ud["line"]
+        tail = touch.ud["simplifier"].finish()
+        if tail:
+            # Already drawn as the line's last point.
+            self.strokes.extend(touch.ud["stroke"], tail)
+        self.layers.finish(line)
+        if self.send_to_server_callback:
+            if tail:
+                self.send_to_server_callback({
+                    "type": "move",
+                    "id": touch.ud["stroke"],
+                    "x": tail[0],
+                    "y": tail[1],
+                })
+            self.send_to_server_callback({
+                "type": "up",
+                "id": touch.ud["stroke"]
+            })
+
+    def draw_received_line(self, event):
+        """Apply a drawing event that another member of the room sent."""
+        client = event.get("client")
+        if event["type"] == "down":
+            # Servers that predate stroke IDs send none; a local one will do.
+            stroke_id = event.get("id")
+            if stroke_id is None:
+                stroke_id = next(self.stroke_ids)
+            line = self.layers.add(event.get("color", (1, 1, 1, 1)), event["x"], event["y"], event.get("width", 2))
+            self.drawings[stroke_id] = line
+            self.strokes.add(stroke_id, event["x"], event["y"])
+            self.remote_lines.start(stroke_id, client)
+        elif event["type"] in ("points", "move"):
+            stroke_id = self.remote_lines.find(event)
+            if stroke_id is None:
+                return
+            points = event["points"] if event["type"] == "points" else (event["x"], event["y"])
+            if self.strokes.extend(stroke_id, points) is not None:
+                self.layers.extend(self.drawings[stroke_id], points)
+        elif event["type"] == "up":
+            stroke_id = self.remote_lines.find(event)
+            if stroke_id is None:
+                return
+            self.remote_lines.finish(stroke_id)
+            line = self.drawings.get(stroke_id)
+            if line is not None:
+                self.layers.finish(line)
+        elif event["type"] == "remove_strokes":
+            self.remove_strokes(event["ids"])
+        elif event["type"] == "erase":
+            self.remove_lines_at(event["x"], event["y"], event["radius"])
+        elif event["type"] == "erase_all":
+            self.clear_lines()
+
+    def clear_lines(self):
+        self.layers.clear()
         self.drawings.clear()
+        self.strokes.clear()
+        self.remote_lines.clear()
+
+    def erase_all(self):
+        self.clear_lines()
         if self.send_to_server_callback:
             self.send_to_server_callback({
                 "type": "erase_all"
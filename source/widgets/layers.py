@@ -0,0 +1,158 @@
+"""Layered stroke rendering: recent strokes live, older ones baked.
+
+Every ``Line`` left on a canvas is re-submitted each frame, so frame time
+grows with the length of a session.  ``StrokeLayers`` keeps only the most
+recent finished strokes (and those still being drawn) as live instructions
+and bakes older ones into tiles, each an ``Fbo`` drawn as a single textured
+rectangle.  An ``Fbo`` only renders again when its own instructions change,
+so erasing a baked stroke re-renders just the tiles it touched.
+"""
+import math
+
+from kivy.graphics import (
+    ClearBuffers, ClearColor, Color, Fbo, InstructionGroup, Line, Rectangle,
+    Translate,
+)
+
+DEFAULT_LIVE_STROKES = 64
+DEFAULT_TILE_SIZE = 512
+
+
+class Tile:
+    """One square of baked strokes, rendered into its own ``Fbo``."""
+
+    def __init__(self, column, row, size):
+        origin = (column * size, row * size)
+        self.fbo = Fbo(size=(size, size))
+        with self.fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+            Translate(-origin[0], -origin[1])
+        # key -> (Color, Line) drawn into this tile
+        self.strokes = {}
+
+        self.group = InstructionGroup()
+        self.group.add(self.fbo)
+        self.group.add(Color(1, 1, 1, 1))
+        self.group.add(Rectangle(texture=self.fbo.texture, pos=origin, size=(size, size)))
+
+    def add(self, key, rgba, points, width):
+        color = Color(*rgba)
+        line = Line(points=points, width=width)
+        self.fbo.add(color)
+        self.fbo.add(line)
+        self.strokes[key] = (color, line)
+
+    def remove(self, key):
+        for instruction in self.strokes.pop(key, ()):
+            self.fbo.remove(instruction)
+
+
+class StrokeLayers:
+    """Draws strokes on ``canvas``, baking all but the newest into tiles.
+
+    Strokes are keyed by the live ``Line`` that ``add`` returns, so callers
+    can keep using it with ``StrokeStore`` after the stroke has been baked.
+    Once more than ``live_limit`` finished strokes are live, the oldest is
+    baked.
+    """
+
+    def __init__(self, canvas, live_limit=DEFAULT_LIVE_STROKES, tile_size=DEFAULT_TILE_SIZE):
+        self.live_limit = live_limit
+        self.tile_size = tile_size
+        # Baked tiles are added first so they stay under the live strokes.
+        self.baked_group = InstructionGroup()
+        self.live_group = InstructionGroup()
+        canvas.add(self.baked_group)
+        canvas.add(self.live_group)
+        # line -> Color drawn before it
+        self.live = {}
+        # Finished live strokes, oldest first.
+        self.finished = {}
+        # line -> tile keys it was baked into
+        self.baked = {}
+        self.tiles = {}
+
+    def add(self, rgba, x, y, width):
+        color = Color(*rgba)
+        line = Line(points=[x, y], width=width)
+        self.live_group.add(color)
+        self.live_group.add(line)
+        self.live[line] = color
+        return line
+
+    def extend(self, line, points):
+        """Add flat ``points`` to the end of a stroke being drawn.
+
+        ``Line.points`` hands out the list the line draws from, so only the
+        new points are copied; the line is rebuilt once, on the next frame.
+        """
+        line.points.extend(points)
+        line.flag_data_update()
+
+    def move_end(self, line, x, y):
+        """Move the last point of a stroke being drawn to (x, y)."""
+        line.points[-2:] = (x, y)
+        line.flag_data_update()
+
+    def finish(self, line):
+        """Mark a stroke as complete, baking the oldest if over the limit."""
+        if line not in self.live or line in self.finished:
+            return
+        self.finished[line] = None
+        while len(self.finished) > self.live_limit:
+            oldest = next(iter(self.finished))
+            del self.finished[oldest]
+            self._bake(oldest)
+
+    def remove(self, line):
+        color = self.live.pop(line, None)
+        if color is not None:
+            self.finished.pop(line, None)
+            self.live_group.remove(color)
+            self.live_group.remove(line)
+            return
+
+        for tile_key in self.baked.pop(line, ()):
+            tile = self.tiles[tile_key]
+            tile.remove(line)
+            if not tile.strokes:
+                self.baked_group.remove(tile.group)
+                del self.tiles[tile_key]
+
+    def clear(self):
+        self.live_group.clear()
+        self.baked_group.clear()
+        self.live.clear()
+        self.finished.clear()
+        self.baked.clear()
+        self.tiles.clear()
+
+    def _bake(self, line):
+        color = self.live.pop(line)
+        self.live_group.remove(color)
+        self.live_group.remove(line)
+
+        points = line.points
+        if not points:
+            return
+        rgba = color.rgba
+        width = line.width
+        tile_keys = self._tiles_covering(points, width)
+        for tile_key in tile_keys:
+            tile = self.tiles.get(tile_key)
+            if tile is None:
+                tile = self.tiles[tile_key] = Tile(*tile_key, self.tile_size)
+                self.baked_group.add(tile.group)
+            tile.add(line, rgba, points, width)
+        self.baked[line] = tile_keys
+
+    def _tiles_covering(self, points, width):
+        xs = points[0::2]
+        ys = points[1::2]
+        size = self.tile_size
+        return [
+            (column, row)
+            for column in range(math.floor((min(xs) - width) / size), math.floor((max(xs) + width) / size) + 1)
+            for row in range(math.floor((min(ys) - width) / size), math.floor((max(ys) + width) / size) + 1)
+        ]